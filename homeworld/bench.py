@@ -0,0 +1,1056 @@
+"""
+End-to-end load generator and benchmark for a Core and its Satellites.
+
+Run a benchmark and save the results:
+
+  python bench.py run --publishers 4 --subscribers 4 --rate 2000 \\
+      --output results.json
+
+Add --transport unix or --transport shm to connect the satellites over the
+Core's UNIX socket, or through shared-memory rings, instead of loopback TCP.
+
+Check that the client entry point imports quickly and stays small:
+
+  python bench.py startup --budget-ms 50 --budget-rss-kb 4096
+
+Trace a sample of the events through each stage of delivery, and show where
+the time goes:
+
+  python bench.py run --trace-sample 0.01 --trace-file traces.jsonl
+  python bench.py trace traces.jsonl
+
+Hand the Core over to a second Core process half way through a run, and
+measure the gap in deliveries:
+
+  python bench.py run --duration 4 --handoff-at 2
+
+Compare two saved runs:
+
+  python bench.py compare baseline.json results.json
+"""
+from argparse import ArgumentParser
+import json
+from math import ceil
+from multiprocessing import Pipe, Process
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+from six import b
+
+from events import Event
+from eventqueue import EventQueue
+from satellite import Backoff, BackpressureError, ConnectionError, Satellite
+from tracing import FileHook, default_bounds_ms, histogram, read_traces, \
+                    stage_latencies
+
+
+default_bench_port = 51200
+
+
+class BenchConfig(object):
+  """
+  Parameters of a single benchmark run.
+  """
+
+  def __init__(self, publishers=2, subscribers=2, rate=1000, size=64,
+               types=4, fanout=1, duration=5.0, relays=4,
+               port=default_bench_port, settle=1.0, drain=1.0,
+               queue_size=None, queue_policy=EventQueue.block,
+               send_timeout=None, high_fraction=0.0, devices=0,
+               conflate=False, transport='tcp', trace_sample=0.0,
+               trace_file=None, handoff_at=None):
+    # Number of publishing and subscribing satellites.
+    self.publishers = publishers
+    self.subscribers = subscribers
+    # Aggregate event rate (events per second) over all publishers.
+    self.rate = rate
+    # Size in bytes of the padding property carried by each event.
+    self.size = size
+    # Number of distinct event types published.
+    self.types = types
+    # Number of event types each subscriber registers for.
+    self.fanout = min(fanout, types)
+    # Length of the measured publishing window in seconds.
+    self.duration = duration
+    # Number of relays in the Core.
+    self.relays = relays
+    self.port = port
+    # Time to wait for connections and registrations to take effect, and for
+    # in-flight events to arrive after publishing stops.
+    self.settle = settle
+    self.drain = drain
+    # Bound and full-queue policy of the Core's global event queue.
+    self.queue_size = queue_size
+    self.queue_policy = queue_policy
+    # Seconds a publisher waits for the Core to accept an event before giving
+    # up on it.  None blocks until it is accepted.
+    self.send_timeout = send_timeout
+    # Fraction of events published with high priority.  The rest are low
+    # priority bulk events.
+    self.high_fraction = high_fraction
+    # Number of distinct devices each publisher reports for, in a "device"
+    # property.  With conflate, the Core keeps only the latest waiting event
+    # per type and device.
+    self.devices = devices
+    self.conflate = conflate
+    # How satellites reach the Core: loopback 'tcp', a 'unix' domain socket,
+    # or 'shm' ring buffers behind a UNIX socket.
+    self.transport = transport
+    # Fraction of published events traced, and the file subscribers append
+    # the traces they receive to.
+    self.trace_sample = trace_sample
+    self.trace_file = trace_file
+    # Seconds into the publishing window at which a second Core takes over
+    # from the first.  None runs one Core throughout.
+    self.handoff_at = handoff_at
+
+  def to_dict(self):
+    return dict(self.__dict__)
+
+
+def percentile(sorted_values, pct):
+  # Nearest-rank percentile of an already sorted list.
+  if not len(sorted_values):
+    return None
+  rank = int(ceil(pct / 100.0 * len(sorted_values))) - 1
+  rank = max(0, min(len(sorted_values) - 1, rank))
+  return sorted_values[rank]
+
+
+def _event_type(index):
+  return 'bench-%d' % index
+
+
+def _subscriber_types(index, config):
+  # Spread subscriptions over the types so each type has a similar fan-out.
+  return [_event_type((index + k) % config.types)
+          for k in range(config.fanout)]
+
+
+def _reconnect(config):
+  # Across a hand-off, a satellite that does lose its connection comes back,
+  # and is counted.
+  return None if config.handoff_at is None else Backoff()
+
+
+def _rss_kb():
+  # Current resident set size of this process in kilobytes, if available.
+  try:
+    with open('/proc/self/statm') as statm:
+      pages = int(statm.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+  except (IOError, OSError, ValueError):
+    return None
+
+
+def _max_rss_kb():
+  try:
+    import resource
+  except ImportError:
+    return None
+  max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # macOS reports bytes, Linux kilobytes.
+  return max_rss // 1024 if sys.platform == 'darwin' else max_rss
+
+
+def _usage_since(start_times, start_wall):
+  end_times = os.times()
+  wall = time.time() - start_wall
+  user = end_times[0] - start_times[0]
+  system = end_times[1] - start_times[1]
+  return {
+    'cpu_user_s': user,
+    'cpu_system_s': system,
+    'cpu_percent': 100.0 * (user + system) / wall if wall > 0 else None,
+    'rss_kb': _rss_kb(),
+    'max_rss_kb': _max_rss_kb(),
+  }
+
+
+def _core_main(core_kwargs, conn):
+  # Entry point of the Core process.  Waits for the parent to mark the start
+  # and end of the measured window and reports its resource usage.
+  from core import Core
+  core = Core(**core_kwargs)
+  core.start()
+  conn.send('ready')
+  conn.recv()
+  start_times = os.times()
+  start_wall = time.time()
+  conn.recv()
+  usage = _usage_since(start_times, start_wall)
+  usage['queue'] = core.queue_stats
+  if core.handoff_pause is not None:
+    usage['handoff_pause_ms'] = core.handoff_pause * 1000.0
+  conn.send(usage)
+  # Stay up until the satellites have disconnected.
+  conn.recv()
+  core.shutdown()
+
+
+class _Subscriber(object):
+  """
+  Subscribing satellite that records delivery latencies.
+  """
+
+  def __init__(self, config, trace_hook=None):
+    self.satellite = Satellite(reconnect=_reconnect(config),
+                               trace_hook=trace_hook)
+    self.latencies = []
+    self.latencies_by_priority = dict()
+    self.received = 0
+    # Longest wait between two deliveries.
+    self.max_gap = 0.0
+    self._last_received = None
+    self._lock = threading.Lock()
+
+  def launch(self, launch_args, event_types):
+    self.satellite.event_callback(self._on_event)
+    self.satellite.launch(**launch_args)
+    for event_type in event_types:
+      self.satellite.register(event_type)
+
+  def _on_event(self, event):
+    now = time.time()
+    if not event.properties or b('ts') not in event.properties:
+      return
+    latency = now - float(event.properties[b('ts')])
+    with self._lock:
+      self.latencies.append(latency)
+      self.latencies_by_priority.setdefault(event.priority, []).append(latency)
+      self.received += 1
+      if self._last_received is not None:
+        self.max_gap = max(self.max_gap, now - self._last_received)
+      self._last_received = now
+
+
+class _Publisher(threading.Thread):
+  """
+  Publishing satellite that sends events at a fixed rate.
+  """
+
+  def __init__(self, index, config, start_time):
+    threading.Thread.__init__(self)
+    self.satellite = Satellite(reconnect=_reconnect(config),
+                               trace_sample=config.trace_sample)
+    self.sent = 0
+    self.backpressured = 0
+    self.sent_per_type = [0] * config.types
+    self._index = index
+    self._config = config
+    self._start_time = start_time
+    self._padding = b('x') * config.size
+
+  def launch(self, launch_args):
+    self.satellite.launch(**launch_args)
+
+  def run(self):
+    config = self._config
+    interval = float(config.publishers) / config.rate
+    end_time = self._start_time + config.duration
+    # Stagger the publishers so their sends don't all land at once.
+    next_send = self._start_time + interval * self._index / config.publishers
+    type_index = self._index % config.types
+    # Accumulates high_fraction per event and sends a high priority event
+    # whenever it passes one.
+    high_credit = 0.0
+    while True:
+      now = time.time()
+      if now >= end_time:
+        break
+      if now < next_send:
+        time.sleep(next_send - now)
+      priority = None
+      if config.high_fraction:
+        high_credit += config.high_fraction
+        priority = Event.low_priority
+        if high_credit >= 1.0:
+          high_credit -= 1.0
+          priority = Event.high_priority
+      properties = {b('ts'): b(repr(time.time())), b('pad'): self._padding}
+      if config.devices:
+        properties[b('device')] = b('%d-%d' % (self._index,
+                                               self.sent % config.devices))
+      event = Event(type=b(_event_type(type_index)), priority=priority,
+                    properties=properties)
+      try:
+        self.satellite.send_event(event, timeout=config.send_timeout)
+      except BackpressureError:
+        self.backpressured += 1
+        type_index = (type_index + 1) % config.types
+        next_send += interval
+        continue
+      self.sent += 1
+      self.sent_per_type[type_index] += 1
+      type_index = (type_index + 1) % config.types
+      next_send += interval
+
+
+def _terminate_all(satellites):
+  # Each terminate waits for its listener thread to notice, so terminate the
+  # satellites in parallel.
+  threads = [threading.Thread(target=sat.terminate) for sat in satellites]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+
+def _start_core(core_kwargs):
+  # Start a Core in a child process and wait until it is listening.
+  parent_conn, child_conn = Pipe()
+  core_proc = Process(target=_core_main, args=(core_kwargs, child_conn))
+  core_proc.start()
+  if not parent_conn.poll(10):
+    core_proc.terminate()
+    raise RuntimeError('Core did not start on port %d' % core_kwargs['port'])
+  parent_conn.recv()
+  return core_proc, parent_conn
+
+
+def _unix_path(port):
+  return os.path.join(tempfile.gettempdir(), 'homeworld-bench-%d.sock' % port)
+
+
+def _handoff_path(port):
+  return os.path.join(tempfile.gettempdir(),
+                      'homeworld-bench-%d.handoff' % port)
+
+
+def run_benchmark(config):
+  """
+  Run a benchmark with the given configuration and return the results dict.
+  """
+  conflate = None
+  if config.conflate:
+    conflate = dict((b(_event_type(i)), b('device'))
+                    for i in range(config.types))
+  core_kwargs = dict(
+    port=config.port, num_relays=config.relays, queue_size=config.queue_size,
+    queue_policy=config.queue_policy, conflate=conflate)
+  launch_args = dict(core_port=config.port)
+  if config.transport != 'tcp':
+    core_kwargs['unix_path'] = _unix_path(config.port)
+    launch_args = dict(address='%s://%s' % (config.transport,
+                                            core_kwargs['unix_path']))
+  if config.handoff_at is not None:
+    core_kwargs['handoff_path'] = _handoff_path(config.port)
+  core_proc, parent_conn = _start_core(core_kwargs)
+  trace_hook = None
+  if config.trace_file:
+    trace_hook = FileHook(config.trace_file)
+  subscribers = [_Subscriber(config, trace_hook)
+                 for i in range(config.subscribers)]
+  subscriptions = [_subscriber_types(i, config)
+                   for i in range(config.subscribers)]
+  for subscriber, event_types in zip(subscribers, subscriptions):
+    subscriber.launch(launch_args, event_types)
+  # Publishers start together once everything has settled.
+  start_time = time.time() + config.settle
+  publishers = [_Publisher(i, config, start_time)
+                for i in range(config.publishers)]
+  for publisher in publishers:
+    publisher.launch(launch_args)
+  time.sleep(max(0, start_time - time.time()))
+  parent_conn.send('start')
+  client_times = os.times()
+  for publisher in publishers:
+    publisher.start()
+  handoff_usage = None
+  if config.handoff_at is not None:
+    time.sleep(max(0, start_time + config.handoff_at - time.time()))
+    # The new Core takes over as it starts.  The old one reports on its part
+    # of the run and exits.
+    new_proc, new_conn = _start_core(core_kwargs)
+    parent_conn.send('stop')
+    handoff_usage = parent_conn.recv()
+    parent_conn.send('exit')
+    core_proc.join(5)
+    core_proc, parent_conn = new_proc, new_conn
+    parent_conn.send('start')
+  for publisher in publishers:
+    publisher.join()
+  publish_elapsed = time.time() - start_time
+  time.sleep(config.drain)
+  parent_conn.send('stop')
+  core_usage = parent_conn.recv()
+  client_usage = _usage_since(client_times, start_time)
+  _terminate_all([p.satellite for p in publishers] +
+                 [s.satellite for s in subscribers])
+  if trace_hook is not None:
+    trace_hook.close()
+  parent_conn.send('exit')
+  core_proc.join(5)
+  results = _summarize(config, publishers, subscribers, subscriptions,
+                       publish_elapsed, core_usage, client_usage)
+  if handoff_usage is not None:
+    satellites = [p.satellite for p in publishers] + \
+                 [s.satellite for s in subscribers]
+    results['results']['handoff'] = {
+      'pause_ms': handoff_usage.get('handoff_pause_ms'),
+      'reconnects': sum(sat.reconnects for sat in satellites),
+    }
+  return results
+
+
+class StormConfig(object):
+  """
+  Parameters of a reconnect-storm run.
+  """
+
+  def __init__(self, satellites=200, backlog=1024, relays=4,
+               port=default_bench_port, connect_timeout=2.0, deadline=60.0,
+               restart=False, backoff_initial=0.1, backoff_max=5.0):
+    # Number of satellites connecting at the same moment.
+    self.satellites = satellites
+    # Listen backlog of the Core's public socket.
+    self.backlog = backlog
+    self.relays = relays
+    self.port = port
+    # Satellite connect timeout, and how long to keep retrying altogether.
+    self.connect_timeout = connect_timeout
+    self.deadline = deadline
+    # With restart, the satellites connect first and the storm is measured
+    # from a Core restart, using the satellites' own reconnect backoff.
+    self.restart = restart
+    self.backoff_initial = backoff_initial
+    self.backoff_max = backoff_max
+
+  def to_dict(self):
+    return dict(self.__dict__)
+
+
+class _StormDevice(threading.Thread):
+  """
+  Satellite that connects as soon as the storm starts, retrying on failure
+  like a real device would, and then subscribes to the probe event.
+  """
+
+  def __init__(self, config, gate, start_time):
+    threading.Thread.__init__(self)
+    reconnect = None
+    if config.restart:
+      reconnect = Backoff(config.backoff_initial, config.backoff_max)
+    self.satellite = Satellite(timeout=config.connect_timeout,
+                               reconnect=reconnect)
+    self.retries = 0
+    self.connected_at = None
+    self.probed_at = None
+    self._config = config
+    self._gate = gate
+    self._start_time = start_time
+
+  def run(self):
+    self._gate.wait()
+    deadline = self._start_time[0] + self._config.deadline
+    while time.time() < deadline:
+      try:
+        self.satellite.launch(core_port=self._config.port)
+      except (ConnectionError, IOError, OSError):
+        self.retries += 1
+        time.sleep(0.05)
+        continue
+      self.connected_at = time.time()
+      self.satellite.event_callback(self._on_event)
+      self.satellite.register('storm-probe')
+      return
+
+  def _on_event(self, event):
+    if self.probed_at is None:
+      self.probed_at = time.time()
+
+
+def _probe_devices(config, devices, deadline):
+  # Keep sending probe events until every device has received one.  Devices
+  # that reconnect are marked connected as they are seen.
+  probe = Satellite()
+  probe.launch(core_port=config.port)
+  while time.time() < deadline:
+    now = time.time()
+    for device in devices:
+      if device.connected_at is None and device.satellite.reconnects:
+        device.connected_at = now
+    if all(device.probed_at is not None for device in devices):
+      break
+    probe.send_event(Event(type=b('storm-probe')))
+    time.sleep(0.01)
+  return probe
+
+
+def run_storm(config):
+  """
+  Connect many satellites at once and measure how long until all of them
+  are connected and receiving events.
+  """
+  core_kwargs = dict(port=config.port, num_relays=config.relays,
+                     backlog=config.backlog)
+  core_proc, parent_conn = _start_core(core_kwargs)
+  gate = threading.Event()
+  start_time = [time.time()]
+  devices = [_StormDevice(config, gate, start_time)
+             for i in range(config.satellites)]
+  for device in devices:
+    device.start()
+  if config.restart:
+    # Connect the swarm, then restart the Core underneath it.
+    gate.set()
+    for device in devices:
+      device.join(config.deadline)
+    probe = _probe_devices(config, devices, time.time() + config.deadline)
+    _terminate_all([probe])
+    parent_conn.send('start')
+    parent_conn.send('stop')
+    parent_conn.recv()
+    parent_conn.send('exit')
+    core_proc.join(5)
+    for device in devices:
+      device.connected_at = None
+      device.probed_at = None
+    core_proc, parent_conn = _start_core(core_kwargs)
+  parent_conn.send('start')
+  start_time[0] = time.time()
+  gate.set()
+  deadline = start_time[0] + config.deadline
+  probe = _probe_devices(config, devices, deadline)
+  for device in devices:
+    device.join(max(0, deadline - time.time()))
+  parent_conn.send('stop')
+  core_usage = parent_conn.recv()
+  _terminate_all([probe] + [device.satellite for device in devices
+                            if device.satellite.connected])
+  parent_conn.send('exit')
+  core_proc.join(5)
+  start = start_time[0]
+  connect_times = sorted(device.connected_at - start for device in devices
+                         if device.connected_at is not None)
+  probe_times = sorted(device.probed_at - start for device in devices
+                       if device.probed_at is not None)
+  to_ms = lambda x: None if x is None else x * 1000.0
+  return {
+    'config': config.to_dict(),
+    'meta': {
+      'timestamp': time.time(),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+    },
+    'results': {
+      'satellites': config.satellites,
+      'connected': len(connect_times),
+      'receiving': len(probe_times),
+      'retries': sum(device.retries for device in devices),
+      'connect_ms': {
+        'p50': to_ms(percentile(connect_times, 50)),
+        'p99': to_ms(percentile(connect_times, 99)),
+        'max': to_ms(connect_times[-1]) if connect_times else None,
+      },
+      'recovery_s': {
+        'all_connected': connect_times[-1]
+                         if len(connect_times) == config.satellites else None,
+        'all_receiving': probe_times[-1]
+                         if len(probe_times) == config.satellites else None,
+      },
+      'core': core_usage,
+    },
+  }
+
+
+class StartupConfig(object):
+  """
+  Parameters of a client start-up run.
+  """
+
+  def __init__(self, module='client', runs=5, budget_ms=None,
+               budget_rss_kb=None):
+    # Module imported by each fresh interpreter.
+    self.module = module
+    # Number of fresh interpreters to time.  Medians are reported.
+    self.runs = runs
+    # Import time, and resident memory over a bare interpreter, allowed
+    # before the run fails.  None skips the check.
+    self.budget_ms = budget_ms
+    self.budget_rss_kb = budget_rss_kb
+
+  def to_dict(self):
+    return dict(self.__dict__)
+
+
+# Modules that must stay out of a client's import graph.
+_server_modules = ('core', 'groundcontrol', 'relay', 'spaceport',
+                   'eventqueue', 'outbox', 'ring', 'unittest')
+
+# Run in a fresh interpreter: times the statement and reports the resident
+# memory and loaded modules just after it.
+_startup_probe = """
+import sys, time
+start = time.time()
+%s
+elapsed = time.time() - start
+modules = sorted(sys.modules)
+rss = None
+try:
+  with open('/proc/self/status') as status:
+    for line in status:
+      if line.startswith('VmRSS:'):
+        rss = int(line.split()[1])
+except (IOError, OSError):
+  pass
+import json
+sys.stdout.write(json.dumps({'import_s': elapsed, 'rss_kb': rss,
+                             'modules': modules}))
+"""
+
+
+def _probe_startup(statement, importtime=False):
+  # Start a fresh interpreter in this directory and run the probe in it.
+  import subprocess
+  args = [sys.executable]
+  if importtime:
+    args += ['-X', 'importtime']
+  args += ['-c', _startup_probe % statement]
+  start = time.time()
+  proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+  out, err = proc.communicate()
+  wall = time.time() - start
+  if proc.returncode:
+    raise RuntimeError('start-up probe failed:\n%s' % err.decode('utf-8',
+                                                                 'replace'))
+  result = json.loads(out.decode('utf-8'))
+  result['wall_s'] = wall
+  result['importtime'] = err.decode('utf-8', 'replace')
+  return result
+
+
+def _slowest_imports(importtime, count=10):
+  # Parse python -X importtime output into the modules with the largest
+  # cumulative import time, in milliseconds.
+  times = []
+  for line in importtime.splitlines():
+    fields = line.split('|')
+    if len(fields) != 3 or not fields[1].strip().isdigit():
+      continue
+    times.append((fields[2].strip(), int(fields[1]) / 1000.0))
+  times.sort(key=lambda item: -item[1])
+  return times[:count]
+
+
+def run_startup(config):
+  """
+  Time a cold import of config.module and measure the memory it adds.
+  """
+  statement = 'import %s' % config.module
+  # One throwaway run so compiling the bytecode isn't measured.
+  _probe_startup(statement)
+  bare = [_probe_startup('pass') for i in range(config.runs)]
+  probes = [_probe_startup(statement) for i in range(config.runs)]
+  median = lambda values: percentile(sorted(values), 50)
+  import_ms = 1000.0 * median([p['import_s'] for p in probes])
+  rss_kb = median([p['rss_kb'] for p in probes if p['rss_kb'] is not None])
+  bare_rss_kb = median([p['rss_kb'] for p in bare if p['rss_kb'] is not None])
+  rss_added_kb = rss_kb - bare_rss_kb if rss_kb and bare_rss_kb else None
+  loaded = set(probes[0]['modules'])
+  server_modules = [m for m in _server_modules if m in loaded]
+  slowest = []
+  if sys.version_info >= (3, 7):
+    slowest = _slowest_imports(_probe_startup(statement, True)['importtime'])
+  over_budget = []
+  if config.budget_ms is not None and import_ms > config.budget_ms:
+    over_budget.append('import %.1f ms > %.1f ms' % (import_ms,
+                                                     config.budget_ms))
+  if config.budget_rss_kb is not None and rss_added_kb is not None \
+  and rss_added_kb > config.budget_rss_kb:
+    over_budget.append('rss +%d kB > %d kB' % (rss_added_kb,
+                                              config.budget_rss_kb))
+  return {
+    'config': config.to_dict(),
+    'meta': {
+      'timestamp': time.time(),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+    },
+    'results': {
+      'import_ms': import_ms,
+      'startup_ms': 1000.0 * median([p['wall_s'] for p in probes]),
+      'interpreter_startup_ms': 1000.0 * median([p['wall_s'] for p in bare]),
+      'rss_kb': rss_kb,
+      'rss_added_kb': rss_added_kb,
+      'modules_loaded': len(loaded),
+      'modules_added': len(loaded - set(bare[0]['modules'])),
+      'server_modules': server_modules,
+      'slowest_imports': slowest,
+      'over_budget': over_budget,
+    },
+  }
+
+
+def _hop_order(hop):
+  # Hops in the order of their stages, with the total last.
+  stages = hop.split(' > ')
+  if len(stages) != 2:
+    return (len(Event.stage_names), 0)
+  return tuple(Event.stage_names.index(stage)
+               if stage in Event.stage_names else len(Event.stage_names)
+               for stage in stages)
+
+
+def run_trace(paths):
+  """
+  Profile the traces saved in the given files and return the results dict.
+  """
+  latencies = stage_latencies(read_traces(paths))
+  to_ms = lambda x: None if x is None else x * 1000.0
+  hops = dict()
+  for hop, values in latencies.items():
+    values.sort()
+    hops[hop] = {
+      'count': len(values),
+      'p50_ms': to_ms(percentile(values, 50)),
+      'p90_ms': to_ms(percentile(values, 90)),
+      'p99_ms': to_ms(percentile(values, 99)),
+      'max_ms': to_ms(values[-1]),
+      'histogram': histogram(values),
+    }
+  return {
+    'config': {'paths': list(paths), 'bounds_ms': list(default_bounds_ms)},
+    'results': {'hops': hops},
+  }
+
+
+def _summarize(config, publishers, subscribers, subscriptions, elapsed,
+               core_usage, client_usage):
+  sent = sum(p.sent for p in publishers)
+  sent_per_type = [sum(p.sent_per_type[i] for p in publishers)
+                   for i in range(config.types)]
+  expected = 0
+  for event_types in subscriptions:
+    for event_type in event_types:
+      expected += sent_per_type[int(event_type.split('-')[1])]
+  latencies = []
+  by_priority = dict()
+  received = 0
+  for subscriber in subscribers:
+    with subscriber._lock:
+      latencies.extend(subscriber.latencies)
+      for priority, values in subscriber.latencies_by_priority.items():
+        name = 'default' if priority is None else str(priority)
+        by_priority.setdefault(name, []).extend(values)
+      received += subscriber.received
+  latencies.sort()
+  for values in by_priority.values():
+    values.sort()
+  to_ms = lambda x: None if x is None else x * 1000.0
+  return {
+    'config': config.to_dict(),
+    'meta': {
+      'timestamp': time.time(),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+    },
+    'results': {
+      'sent': sent,
+      'backpressured': sum(p.backpressured for p in publishers),
+      'expected': expected,
+      'received': received,
+      'loss_ratio': 1.0 - float(received) / expected if expected else 0.0,
+      'publish_throughput_eps': sent / elapsed if elapsed > 0 else None,
+      'delivery_throughput_eps': received / elapsed if elapsed > 0 else None,
+      'latency_ms': {
+        'mean': to_ms(sum(latencies) / len(latencies)) if latencies else None,
+        'p50': to_ms(percentile(latencies, 50)),
+        'p99': to_ms(percentile(latencies, 99)),
+        'p999': to_ms(percentile(latencies, 99.9)),
+        'max': to_ms(latencies[-1]) if latencies else None,
+      },
+      'max_gap_ms': to_ms(max([s.max_gap for s in subscribers] or [None])),
+      'latency_ms_by_priority': dict(
+        (name, {'p50': to_ms(percentile(values, 50)),
+                'p99': to_ms(percentile(values, 99))})
+        for name, values in by_priority.items()),
+      'core': core_usage,
+      'clients': client_usage,
+    },
+  }
+
+
+def _flatten(results, prefix=''):
+  flat = {}
+  for key, val in results.items():
+    name = prefix + key
+    if isinstance(val, dict):
+      flat.update(_flatten(val, name + '.'))
+    elif isinstance(val, (int, float)) and not isinstance(val, bool):
+      flat[name] = val
+  return flat
+
+
+# Metrics where a larger value is an improvement, and groups of metrics where
+# a smaller value is.  Only these are checked for regressions.
+_higher_is_better = ('publish_throughput_eps', 'delivery_throughput_eps')
+_lower_is_better = ('latency_ms.', 'connect_ms.', 'recovery_s.', 'import_ms',
+                    'startup_ms', 'rss_added_kb', 'max_gap_ms', 'handoff.')
+
+
+def compare_results(baseline, current, threshold=10.0):
+  """
+  Compare the results of two runs.
+
+  Returns a list of (metric, baseline, current, percent change, regressed)
+  tuples.  A metric regresses when it gets worse by more than threshold
+  percent.
+  """
+  base = _flatten(baseline['results'])
+  curr = _flatten(current['results'])
+  rows = []
+  for name in sorted(set(base) & set(curr)):
+    old, new = base[name], curr[name]
+    change = 100.0 * (new - old) / old if old else None
+    higher_better = name.split('.')[-1] in _higher_is_better
+    regressed = False
+    if change is not None and (higher_better
+                               or name.startswith(_lower_is_better)):
+      worse = -change if higher_better else change
+      regressed = worse > threshold
+    rows.append((name, old, new, change, regressed))
+  return rows
+
+
+def _format_report(results):
+  res = results['results']
+  lat = res['latency_ms']
+  fmt = lambda x: 'n/a' if x is None else '%.3f' % x
+  lines = [
+    'sent %d (%d refused by backpressure), delivered %d of %d '
+    '(loss %.2f%%)' % (
+      res['sent'], res['backpressured'], res['received'], res['expected'],
+      100 * res['loss_ratio']),
+    'throughput: publish %s ev/s, deliver %s ev/s' % (
+      fmt(res['publish_throughput_eps']), fmt(res['delivery_throughput_eps'])),
+    'latency ms: mean %s, p50 %s, p99 %s, p999 %s, max %s' % (
+      fmt(lat['mean']), fmt(lat['p50']), fmt(lat['p99']), fmt(lat['p999']),
+      fmt(lat['max'])),
+  ]
+  lines.append('longest wait between deliveries: %s ms' % fmt(
+    res['max_gap_ms']))
+  if 'handoff' in res:
+    lines.append('hand-off: paused %s ms, %d reconnects' % (
+      fmt(res['handoff']['pause_ms']), res['handoff']['reconnects']))
+  for name in ('core', 'clients'):
+    usage = res[name]
+    lines.append('%s: cpu %s%% (user %s s, system %s s), rss %s kB, '
+                 'max rss %s kB' % (
+      name, fmt(usage['cpu_percent']), fmt(usage['cpu_user_s']),
+      fmt(usage['cpu_system_s']), usage['rss_kb'], usage['max_rss_kb']))
+  for name in sorted(res['latency_ms_by_priority']):
+    lat = res['latency_ms_by_priority'][name]
+    lines.append('priority %s latency ms: p50 %s, p99 %s' % (
+      name, fmt(lat['p50']), fmt(lat['p99'])))
+  queue = res['core']['queue']
+  lines.append('core queue: max depth %d, dropped %d, rejected %d, '
+               'conflated %d (outboxes %d)' % (
+    queue['max_depth'], queue['dropped'], queue['rejected'],
+    queue['conflated'], queue['outbox_conflated']))
+  for priority, wait in enumerate(queue['wait_by_priority']):
+    if wait['count']:
+      lines.append('core queue priority %d wait ms: mean %s, max %s' % (
+        priority, fmt(wait['mean_wait_ms']), fmt(wait['max_wait_ms'])))
+  return '\n'.join(lines)
+
+
+def _format_storm_report(results):
+  res = results['results']
+  fmt = lambda x: 'n/a' if x is None else '%.3f' % x
+  return '\n'.join([
+    '%d of %d satellites connected, %d receiving, %d connect retries' % (
+      res['connected'], res['satellites'], res['receiving'], res['retries']),
+    'connect ms: p50 %s, p99 %s, max %s' % (
+      fmt(res['connect_ms']['p50']), fmt(res['connect_ms']['p99']),
+      fmt(res['connect_ms']['max'])),
+    'all connected after %s s, all receiving after %s s' % (
+      fmt(res['recovery_s']['all_connected']),
+      fmt(res['recovery_s']['all_receiving'])),
+  ])
+
+
+def _format_startup_report(results):
+  res = results['results']
+  fmt = lambda x: 'n/a' if x is None else '%.1f' % x
+  lines = [
+    'import %s: %s ms, process start-up %s ms (bare interpreter %s ms)' % (
+      results['config']['module'], fmt(res['import_ms']),
+      fmt(res['startup_ms']), fmt(res['interpreter_startup_ms'])),
+    'rss %s kB (+%s kB), %d modules loaded (+%d)' % (
+      res['rss_kb'], res['rss_added_kb'], res['modules_loaded'],
+      res['modules_added']),
+  ]
+  if res['slowest_imports']:
+    lines.append('slowest imports (cumulative ms): ' + ', '.join(
+      '%s %.1f' % item for item in res['slowest_imports'][:5]))
+  if res['server_modules']:
+    lines.append('server modules loaded: ' + ', '.join(res['server_modules']))
+  for failure in res['over_budget']:
+    lines.append('OVER BUDGET: ' + failure)
+  return '\n'.join(lines)
+
+
+def _format_trace_report(results):
+  hops = results['results']['hops']
+  bounds = results['config']['bounds_ms']
+  labels = ['<= %g ms' % bound for bound in bounds] + ['> %g ms' % bounds[-1]]
+  if not hops:
+    return 'no traces'
+  lines = []
+  for hop in sorted(hops, key=_hop_order):
+    res = hops[hop]
+    lines.append('%s: %d traces, p50 %.3f ms, p90 %.3f ms, p99 %.3f ms, '
+                 'max %.3f ms' % (hop, res['count'], res['p50_ms'],
+                                  res['p90_ms'], res['p99_ms'],
+                                  res['max_ms']))
+    most = max(res['histogram'])
+    for label, count in zip(labels, res['histogram']):
+      if count:
+        lines.append('  %12s %8d %s' % (label, count,
+                                        '#' * int(ceil(40.0 * count / most))))
+  return '\n'.join(lines)
+
+
+def _format_comparison(rows):
+  lines = ['%-40s %14s %14s %9s' % ('metric', 'baseline', 'current', 'change')]
+  for name, old, new, change, regressed in rows:
+    change_str = 'n/a' if change is None else '%+.1f%%' % change
+    lines.append('%-40s %14.3f %14.3f %9s%s' % (
+      name, old, new, change_str, '  REGRESSED' if regressed else ''))
+  return '\n'.join(lines)
+
+
+def _build_parser():
+  parser = ArgumentParser(description='Homeworld Core benchmark.')
+  commands = parser.add_subparsers(dest='command')
+  run = commands.add_parser('run', help='run a load benchmark')
+  defaults = BenchConfig()
+  for name, help_str in (
+      ('publishers', 'number of publishing satellites'),
+      ('subscribers', 'number of subscribing satellites'),
+      ('rate', 'aggregate publish rate in events per second'),
+      ('size', 'event padding size in bytes'),
+      ('types', 'number of distinct event types'),
+      ('fanout', 'event types each subscriber registers for'),
+      ('relays', 'number of Core relays'),
+      ('port', 'Core port'),
+      ('queue_size', 'bound on the Core event queue'),
+      ('devices', 'distinct devices reported by each publisher')):
+    run.add_argument('--' + name.replace('_', '-'), type=int,
+                     default=getattr(defaults, name), help=help_str)
+  run.add_argument('--queue-policy', choices=EventQueue.policies,
+                   default=defaults.queue_policy,
+                   help='what the Core does when its event queue is full')
+  for name, help_str in (
+      ('duration', 'publishing window in seconds'),
+      ('settle', 'seconds to wait before publishing'),
+      ('drain', 'seconds to wait for deliveries after publishing'),
+      ('send_timeout', 'seconds a publisher waits on backpressure'),
+      ('high_fraction', 'fraction of events sent with high priority'),
+      ('handoff_at', 'seconds into publishing to hand over to a new Core')):
+    run.add_argument('--' + name.replace('_', '-'), type=float,
+                     default=getattr(defaults, name), help=help_str)
+  run.add_argument('--trace-sample', type=float,
+                   default=defaults.trace_sample,
+                   help='fraction of published events to trace')
+  run.add_argument('--trace-file', default=defaults.trace_file,
+                   help='append the traces subscribers receive to this file')
+  run.add_argument('--conflate', action='store_true',
+                   help='conflate waiting events per type and device')
+  run.add_argument('--transport', choices=('tcp', 'unix', 'shm'),
+                   default=defaults.transport,
+                   help='how satellites connect to the Core')
+  run.add_argument('--output', help='save results as JSON to this file')
+  storm = commands.add_parser('storm', help='run a reconnect-storm benchmark')
+  defaults = StormConfig()
+  for name, arg_type, help_str in (
+      ('satellites', int, 'number of satellites connecting at once'),
+      ('backlog', int, 'listen backlog of the Core'),
+      ('relays', int, 'number of Core relays'),
+      ('port', int, 'Core port'),
+      ('connect_timeout', float, 'satellite connect timeout in seconds'),
+      ('deadline', float, 'seconds to keep trying'),
+      ('backoff_initial', float, 'first reconnect backoff ceiling, seconds'),
+      ('backoff_max', float, 'largest reconnect backoff, seconds')):
+    storm.add_argument('--' + name.replace('_', '-'), type=arg_type,
+                       default=getattr(defaults, name), help=help_str)
+  storm.add_argument('--restart', action='store_true',
+                     help='measure recovery from a Core restart')
+  storm.add_argument('--output', help='save results as JSON to this file')
+  startup = commands.add_parser('startup',
+                                help='measure client import time and memory')
+  defaults = StartupConfig()
+  startup.add_argument('--module', default=defaults.module,
+                       help='module to import')
+  startup.add_argument('--runs', type=int, default=defaults.runs,
+                       help='number of fresh interpreters to time')
+  startup.add_argument('--budget-ms', type=float, default=defaults.budget_ms,
+                       help='fail if the import takes longer')
+  startup.add_argument('--budget-rss-kb', type=int,
+                       default=defaults.budget_rss_kb,
+                       help='fail if the import adds more resident memory')
+  startup.add_argument('--output', help='save results as JSON to this file')
+  trace = commands.add_parser('trace',
+                              help='profile saved traces stage by stage')
+  trace.add_argument('paths', nargs='+', metavar='path',
+                     help='file of traces saved by tracing.FileHook')
+  trace.add_argument('--output', help='save results as JSON to this file')
+  compare = commands.add_parser('compare', help='compare two saved runs')
+  compare.add_argument('baseline')
+  compare.add_argument('current')
+  compare.add_argument('--threshold', type=float, default=10.0,
+                       help='percent change that counts as a regression')
+  return parser
+
+
+def main(argv=None):
+  args = _build_parser().parse_args(argv)
+  if args.command in ('run', 'storm', 'startup'):
+    kwargs = dict((k, v) for k, v in vars(args).items()
+                  if k not in ('command', 'output'))
+    status = 0
+    if args.command == 'run':
+      results = run_benchmark(BenchConfig(**kwargs))
+      print(_format_report(results))
+    elif args.command == 'storm':
+      results = run_storm(StormConfig(**kwargs))
+      print(_format_storm_report(results))
+    else:
+      results = run_startup(StartupConfig(**kwargs))
+      print(_format_startup_report(results))
+      res = results['results']
+      # The client entry point must not drag in the Core.
+      client = args.module in ('client', 'satellite')
+      if res['over_budget'] or (client and res['server_modules']):
+        status = 1
+    if args.output:
+      with open(args.output, 'w') as out:
+        json.dump(results, out, indent=2, sort_keys=True)
+    return status
+  elif args.command == 'trace':
+    results = run_trace(args.paths)
+    print(_format_trace_report(results))
+    if args.output:
+      with open(args.output, 'w') as out:
+        json.dump(results, out, indent=2, sort_keys=True)
+    return 0
+  elif args.command == 'compare':
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    with open(args.current) as f:
+      current = json.load(f)
+    rows = compare_results(baseline, current, args.threshold)
+    print(_format_comparison(rows))
+    return 1 if any(row[-1] for row in rows) else 0
+  _build_parser().print_help()
+  return 2
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,17 @@
+"""
+Client-only entry point for satellites.
+
+Importing this module pulls in the event codec and the socket client and
+nothing of the Core, which keeps start-up time and memory down on small
+devices:
+
+  from client import Event, Satellite
+
+  sat = Satellite()
+  sat.launch(core_host='hub.local')
+"""
+from events import Event
+from rpc import Reply, RequestTimeout, UndeliverableError
+from satellite import Backoff, BackpressureError, ConnectionError, \
+                      NotConnectedError, Satellite
+from sockutils import default_core_port
@@ -1,20 +1,28 @@
-from collections import deque
-from socket import socket, gethostname, SHUT_RDWR
-from threading import Condition
-from time import sleep
-
-from six import b
+import logging
+import os
+from socket import socket, gethostname, SHUT_RDWR, SOL_SOCKET, SO_REUSEADDR
+try:
+  from socket import AF_UNIX
+except ImportError:
+  AF_UNIX = None
+from threading import Condition, Event as _Signal, Lock
+from weakref import WeakKeyDictionary
+from time import sleep, time
 
+from eventqueue import EventQueue
 from lockeddata import LockedData
 from flag import Flag
 from groundcontrol import GroundControl
+from handoff import HandoffError, HandoffPort, close_fds, confirm_handoff, \
+                    receive_handoff, send_handoff, supported as can_hand_off
+from ring import RingBuffer
+from sockutils import default_core_port, set_send_timeout, Wakeup
 from spaceport import Spaceport
 from relay import Relay
+from rpc import PendingRequests
+from subscriptions import Subscriptions
 
-# Unit test modules
-import unittest as _ut
-
-default_core_port = 51100
+log = logging.getLogger(__name__)
 
 
 class InvalidCoreState(RuntimeError):
@@ -28,20 +36,98 @@ class CoreShutdownError(RuntimeError):
 class Core(object):
   """
   Manages a home-automation satellite swarm.
+
+  The global event queue is unbounded unless queue_size is given.  See
+  EventQueue for the queue_policy options once it is full.
+
+  conflate opts event types into conflation: it maps each type to the
+  property identifying the device, e.g. {b'temperature': b'device'}.  A newer
+  event for the same device then replaces one still waiting in the global
+  queue or a satellite's outbox.
+
+  backlog is the listen backlog for the public socket.  It should be large
+  enough to hold a whole swarm reconnecting at once.  sock_opts are applied to
+  every satellite connection; see sockutils.tune_socket.
+
+  With unix_path, the Core also listens on a UNIX domain socket at that path
+  for satellites on the same host.  Those may go on to attach a shared-memory
+  ring buffer for their events; see GroundControl.
+
+  With heartbeat_timeout, satellites must send something, at least a
+  heartbeat event, every that many seconds.  Those that don't are taken for
+  dead and dropped along with their registrations, and a write to a satellite
+  not done within that long fails and drops it, so a half-open connection can
+  hold up a relay for a bounded time only.  Each heartbeat is answered with
+  one, so satellites can tell whether the Core is alive.  Heartbeats skip
+  the queue bound and policy, so a busy Core is not taken for dead.
+
+  Requests are routed to the satellite registered under their recipient
+  name, and replies straight back to the requester.  A request not answered
+  within request_timeout seconds is forgotten, and a late reply dropped.
+  With request_timeout=None, requests are never forgotten.
+
+  Traced events are stamped as they pass through the Core; see Event.trace.
+  A trace_sample fraction of the events that arrive untraced get a trace
+  started on receipt.  trace_hook, if given, is called on a relay thread with
+  each traced event as it is written to a satellite, so it must be quick;
+  see tracing.FileHook.
+
+  With handoff_path, a restarted Core takes over from the running one without
+  dropping any satellite.  start() first connects to the UNIX socket at
+  handoff_path, and if a Core is listening there, it hands over its listening
+  sockets, satellite connections and registrations instead of the new Core
+  binding its own; see handoff.  Only a successor run by the same user may
+  take over.  The new Core then listens at handoff_path for its own
+  successor.  The old Core routes whatever it has already read
+  before handing over, and carries on if the hand-off fails.  If one of its
+  threads does not stop in time, the hand-off is called off, and the Core
+  only starts new threads once the old ones have all exited.  Requests
+  waiting for replies are not handed over, so those replies are dropped.
   """
-  def __init__(self, port=default_core_port, num_relays=4):
-    self._init_data_structures(port, num_relays)
+  def __init__(self, port=default_core_port, num_relays=4, queue_size=None,
+               queue_policy=EventQueue.block, conflate=None, backlog=1024,
+               sock_opts=None, unix_path=None, heartbeat_timeout=None,
+               request_timeout=30.0, trace_sample=0.0, trace_hook=None,
+               handoff_path=None):
+    self._init_data_structures(port, num_relays, queue_size, queue_policy,
+                               conflate)
+    self._backlog = backlog
+    self._sock_opts = sock_opts
+    if unix_path is not None and AF_UNIX is None:
+      raise ValueError('UNIX domain sockets are not supported here')
+    self._unix_path = unix_path
+    self._heartbeat_timeout = heartbeat_timeout
+    # Requests forwarded by the relays and waiting for replies.
+    self._pending = PendingRequests(request_timeout)
+    self._trace_sample = trace_sample
+    self._trace_hook = trace_hook
+    if handoff_path is not None and not can_hand_off():
+      raise ValueError('handing off a Core is not supported here')
+    self._handoff_path = handoff_path
+    self._handoff_port = None
+    self._handed_off = _Signal()
+    # Set once shutdown() is called, so a hand-off waiting for stuck threads
+    # knows not to start new ones.
+    self._stopping = False
+    # Seconds from stopping to the successor taking over, in the last
+    # hand-off.
+    self.handoff_pause = None
 
-  def _init_data_structures(self, port, num_relays):
+  def _init_data_structures(self, port, num_relays, queue_size=None,
+                            queue_policy=EventQueue.block, conflate=None):
     self._clean = True
+    self._conflate = conflate
     self._num_relays = num_relays
     self._port = port
     # Map from socket to addr structure of each satellite.
     self._sat_map = LockedData(dict())
     # Map from event type to list of satellite sockets.
-    self._event_sat_map = LockedData({b('all'): []})
+    self._event_sat_map = Subscriptions()
     # Global queue of events to route.
-    self._gbl_queue = LockedData(deque())
+    self._gbl_queue = EventQueue(maxlen=queue_size, policy=queue_policy,
+                                 conflate=conflate)
+    # Map from satellite socket to its outbox of events waiting to be sent.
+    self._outbox_map = LockedData(WeakKeyDictionary(), Lock())
     # Condition variable for ground control to use to notify switches of new
     # events to route.
     self._cond = Condition()
@@ -49,50 +135,315 @@ class Core(object):
     self._shutdown_flag = Flag()
 
   def start(self):
-    if not self._clean:
+    if not self._clean or self._handed_off.is_set():
       raise InvalidCoreState('Core not cleanly shut down; cannot start')
-    self._spawn_threads()
+    self._stopping = False
+    inherited = None
+    if self._handoff_path is not None:
+      inherited = self._take_over()
+    self._spawn_threads(inherited)
+    if self._handoff_path is not None:
+      self._open_handoff_port()
 
-  def _spawn_threads(self):
+  def _spawn_threads(self, inherited=None):
+    # inherited holds the listening sockets, and any attached rings, to carry
+    # on with instead of binding new ones.
     self._clean = False
     # Reset the shutdown flag in case Core is being restarted.
     self._shutdown_flag.unset()
+    if inherited is None:
+      inherited = {'public': self._bind_public_socket(), 'local': None,
+                   'rings': None}
+      if self._unix_path is not None:
+        inherited['local'] = self._bind_unix_socket()
     # Set up socket to listen for new satellites.
-    self._public_sock = socket()
-    self._public_sock.bind((gethostname(), self._port))
-    self._public_sock.listen(1)
+    self._public_sock = inherited['public']
+    # The Spaceport accepts until the socket would block.
+    self._public_sock.setblocking(False)
+    # Lets the Spaceports wake GroundControl when satellites connect, and
+    # shutdown stop the Spaceports without waiting.
+    self._wakeup = Wakeup()
+    self._interrupt = Wakeup()
+    # Construct and start GroundControl.
+    # This listens for events and passes them to the relays.  It starts the
+    # idle timers of the satellites already connected, such as those taken
+    # over, and the Spaceports tell it of the rest.
+    self._gnd_control = GroundControl(
+      sat_map=self._sat_map, event_sat_map=self._event_sat_map,
+      event_queue=self._gbl_queue, signal=self._cond,
+      shutdown_flag=self._shutdown_flag, wakeup=self._wakeup,
+      heartbeat_timeout=self._heartbeat_timeout,
+      trace_sample=self._trace_sample, rings=inherited['rings'])
+    self._gnd_control.start()
     # Construct and start the Spaceport.
     # This allows new satellites to connect to the Core.
     self._spaceport = Spaceport(socket=self._public_sock,
                                 sat_map=self._sat_map,
-                                shutdown_flag=self._shutdown_flag)
+                                shutdown_flag=self._shutdown_flag,
+                                wakeup=self._wakeup,
+                                sock_opts=self._sock_opts,
+                                send_timeout=self._heartbeat_timeout,
+                                interrupt=self._interrupt,
+                                on_accept=self._gnd_control.joined)
     self._spaceport.start()
-    # Construct and start GroundControl.
-    # This listens for events and passes them to the relays.
-    self._gnd_control = GroundControl(sat_map=self._sat_map,
-                                      event_sat_map=self._event_sat_map,
-                                      event_queue=self._gbl_queue,
-                                      signal=self._cond,
-                                      shutdown_flag=self._shutdown_flag)
-    self._gnd_control.start()
+    # Same-host satellites get a Spaceport of their own on the UNIX socket.
+    self._local_sock = inherited['local']
+    self._local_spaceport = None
+    if self._local_sock is not None:
+      self._local_path = self._local_sock.getsockname()
+      self._local_sock.setblocking(False)
+      self._local_spaceport = Spaceport(socket=self._local_sock,
+                                        sat_map=self._sat_map,
+                                        shutdown_flag=self._shutdown_flag,
+                                        wakeup=self._wakeup,
+                                        send_timeout=self._heartbeat_timeout,
+                                        interrupt=self._interrupt,
+                                        on_accept=self._gnd_control.joined)
+      self._local_spaceport.start()
     # Construct and start the relays.
     # These register satellites to get or stop getting certain event types and
     # routes events caught by GroundControl to registered satellites.
     self._relays = [Relay(event_queue=self._gbl_queue,
                           signal=self._cond,
                           event_sat_map=self._event_sat_map,
-                          shutdown_flag=self._shutdown_flag) \
+                          shutdown_flag=self._shutdown_flag,
+                          outbox_map=self._outbox_map,
+                          conflate=self._conflate,
+                          pending=self._pending,
+                          trace_hook=self._trace_hook) \
                      for i in range(self._num_relays)]
     for relay in self._relays:
       relay.start()
 
+  def _take_over(self):
+    """
+    Take over from the Core listening at the hand-off path, if there is one.
+
+    Returns the inherited listening sockets and rings, or None.
+    """
+    conn = socket(AF_UNIX)
+    try:
+      try:
+        conn.connect(self._handoff_path)
+      except (IOError, OSError):
+        # Nobody to take over from.
+        return None
+      state, fds = receive_handoff(conn)
+      try:
+        inherited = self._adopt(state, fds)
+      except Exception:
+        close_fds(fds)
+        raise
+      try:
+        confirm_handoff(conn)
+      except (IOError, OSError):
+        # The old Core carries on, so let go of its sockets.
+        self._release(inherited)
+        raise HandoffError('could not confirm the hand-off')
+      return inherited
+    finally:
+      conn.close()
+
+  def _adopt(self, state, fds):
+    # Wrap the descriptors handed over and restore the registrations.
+    def _bytes(text):
+      return text.encode('latin-1')
+    sockets = dict()
+    for index in [state['public'], state['local']] + \
+                 [sat['socket'] for sat in state['sats']]:
+      if index is not None:
+        sockets[index] = socket(fileno=fds[index])
+    rings = dict()
+    with self._sat_map.lock:
+      for sat_state in state['sats']:
+        sat = sockets[sat_state['socket']]
+        set_send_timeout(sat, self._heartbeat_timeout)
+        address = sat_state['address']
+        if isinstance(address, list):
+          address = tuple(address)
+        self._sat_map.data[sat] = address
+        self._event_sat_map.add(sat, [_bytes(t) for t in sat_state['types']])
+        for name in sat_state['names']:
+          self._event_sat_map.add_name(sat, _bytes(name))
+        if sat_state['ring'] is not None:
+          rings[sat] = RingBuffer(sat_state['ring_path'],
+                                  fds[sat_state['ring']])
+    local = None
+    if state['local'] is not None:
+      local = sockets[state['local']]
+    return {'public': sockets[state['public']], 'local': local,
+            'rings': rings}
+
+  def _release(self, inherited):
+    # Close, but never shut down, sockets another Core goes on using.
+    inherited['public'].close()
+    if inherited['local'] is not None:
+      inherited['local'].close()
+    for ring in inherited['rings'].values():
+      ring.close()
+    with self._sat_map.lock:
+      sats = list(self._sat_map.data)
+      self._sat_map.data.clear()
+    for sat in sats:
+      self._event_sat_map.remove_sat(sat)
+      sat.close()
+
+  def _handoff_state(self, rings):
+    # Number every descriptor to hand over, and describe them.
+    def _text(data):
+      return data.decode('latin-1')
+    fds = [self._public_sock.fileno()]
+    state = {'public': 0, 'local': None, 'sats': []}
+    if self._local_sock is not None:
+      state['local'] = len(fds)
+      fds.append(self._local_sock.fileno())
+    with self._sat_map.lock:
+      sat_map = dict(self._sat_map.data)
+    for sat, address in sat_map.items():
+      sat_state = {
+        'socket': len(fds),
+        'address': address,
+        'types': [_text(t) for t in self._event_sat_map.types_of(sat)],
+        'names': [_text(n) for n in self._event_sat_map.names_of(sat)],
+        'ring': None,
+        'ring_path': None,
+      }
+      fds.append(sat.fileno())
+      ring = rings.get(sat)
+      if ring is not None:
+        sat_state['ring'] = len(fds)
+        sat_state['ring_path'] = ring.path
+        fds.append(ring.fileno())
+      state['sats'].append(sat_state)
+    return state, fds
+
+  def _open_handoff_port(self):
+    # A Core that didn't shut down cleanly leaves its socket file behind, and
+    # the Core taken over from leaves its own.
+    try:
+      os.unlink(self._handoff_path)
+    except OSError:
+      pass
+    self._handoff_sock = socket(AF_UNIX)
+    self._handoff_sock.bind(self._handoff_path)
+    self._handoff_sock.listen(1)
+    self._handoff_sock.setblocking(False)
+    self._handoff_port = HandoffPort(socket=self._handoff_sock,
+                                     shutdown_flag=self._shutdown_flag,
+                                     on_successor=self._hand_off)
+    self._handoff_port.start()
+
+  def _hand_off(self, conn):
+    """
+    Hand everything over to the successor Core connected on conn.
+
+    Runs on the HandoffPort thread.  Returns whether the successor took over;
+    if it didn't, this Core carries on.
+    """
+    stopped_at = time()
+    spaceport_down, gnd_ctrl_down, relay_down = self._stop_threads()
+    rings = self._gnd_control.rings
+    inherited = {'public': self._public_sock, 'local': self._local_sock,
+                 'rings': rings}
+    if not (spaceport_down and gnd_ctrl_down and all(relay_down)):
+      # New threads beside one still running would share its sockets and
+      # queues, so hang up on the successor and wait the old ones out first.
+      conn.close()
+      if not self._await_threads():
+        return False
+      self._close_wakeups()
+      self._spawn_threads(inherited)
+      return False
+    try:
+      # Route what has already been read, so the successor starts afresh.
+      self._drain()
+      state, fds = self._handoff_state(rings)
+      send_handoff(conn, state, fds)
+    except Exception as error:
+      # Whatever went wrong, the successor has not taken over, so carry on.
+      # Only a failure to reach it is to be expected.
+      if not isinstance(error, (IOError, OSError, HandoffError)):
+        log.exception('hand-off failed')
+      self._close_wakeups()
+      self._spawn_threads(inherited)
+      return False
+    self.handoff_pause = time() - stopped_at
+    # The successor has descriptors of its own for all of these now.
+    self._close_wakeups()
+    self._handoff_sock.close()
+    self._release(inherited)
+    self._clean = True
+    self._handed_off.set()
+    return True
+
+  def _drain(self):
+    # Route the events left in the global queue once the relays have stopped.
+    if not len(self._relays):
+      return
+    while len(self._gbl_queue):
+      for rec_event in self._gbl_queue.take():
+        self._relays[0]._process_event(rec_event)
+
+  def wait_handed_off(self, timeout=None):
+    """
+    Wait until this Core has handed over to a successor.
+
+    Returns whether it has.  A Core that has handed over has nothing left to
+    shut down.
+    """
+    return self._handed_off.wait(timeout)
+
+  def _bind_public_socket(self):
+    sock = socket()
+    # Allow a restarted Core to bind while old connections are in TIME_WAIT.
+    sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    sock.bind((gethostname(), self._port))
+    sock.listen(self._backlog)
+    return sock
+
+  def _bind_unix_socket(self):
+    # A Core that didn't shut down cleanly leaves its socket file behind.
+    try:
+      os.unlink(self._unix_path)
+    except OSError:
+      pass
+    sock = socket(AF_UNIX)
+    sock.bind(self._unix_path)
+    sock.listen(self._backlog)
+    sock.setblocking(False)
+    return sock
+
+  @property
+  def queue_stats(self):
+    queue = self._gbl_queue
+    with self._outbox_map.lock:
+      outboxes = list(self._outbox_map.data.values())
+    return {'depth': len(queue), 'max_depth': queue.max_depth,
+            'dropped': queue.dropped, 'rejected': queue.rejected,
+            'conflated': queue.conflated,
+            'outbox_depth': sum(len(outbox) for outbox in outboxes),
+            'outbox_conflated': sum(outbox.conflated for outbox in outboxes),
+            'pending_requests': len(self._pending),
+            'expired_requests': self._pending.expired,
+            'wait_by_priority': [lane.to_dict() for lane in queue.lane_stats]}
+
   def _close_sockets(self, core, satellites):
     if core:
       self._public_sock.shutdown(SHUT_RDWR)
       self._public_sock.close()
+      if self._local_spaceport is not None:
+        self._local_sock.close()
+        try:
+          os.unlink(self._local_path)
+        except OSError:
+          pass
     if satellites:
       for sat in self._sat_map.data:
-        sat.shutdown(SHUT_RDWR)
+        # The satellite may already have hung up.
+        try:
+          sat.shutdown(SHUT_RDWR)
+        except (IOError, OSError):
+          pass
         sat.close()
 
   def _join_thread(self, thread, timeout=0.5):
@@ -115,68 +466,76 @@ class Core(object):
         needComma = True
     return err
 
-  def shutdown(self):
-    # Set the shutdown flag, wait a bit for threads to shutdown, then join them
-    # with a timeout.  If any are still alive after the signal, raise an
-    # exception.  If the shutdown wasn't "clean", don't allow a Core to be
-    # restarted.
+  def _stop_threads(self):
+    # Set the shutdown flag, wake every thread that may be waiting, and join
+    # them with a timeout.  Returns which of them are down.
     self._shutdown_flag.set()
+    self._interrupt.ring()
+    self._wakeup.ring()
     # Notify the relays they need to wake up and shutdown.
     with self._cond:
       self._cond.notify_all()
     # Join the threads.
     spaceport_down = self._join_thread(self._spaceport, 1)
+    if self._local_spaceport is not None:
+      spaceport_down = self._join_thread(self._local_spaceport, 1) \
+                       and spaceport_down
     gnd_ctrl_down = self._join_thread(self._gnd_control)
     relay_down = [self._join_thread(relay) for relay in self._relays]
+    return spaceport_down, gnd_ctrl_down, relay_down
+
+  def _await_threads(self, poll=0.5):
+    # Wait for every thread to exit, giving up if the Core is shut down in
+    # the meantime.  Returns whether they all have.
+    threads = [self._spaceport, self._local_spaceport, self._gnd_control] + \
+              self._relays
+    for thread in threads:
+      if thread is None:
+        continue
+      while not self._join_thread(thread, poll):
+        if self._stopping:
+          return False
+    return not self._stopping
+
+  def _close_wakeups(self):
+    self._wakeup.close()
+    self._interrupt.close()
+
+  def _close_handoff_port(self):
+    if self._handoff_port is None:
+      return
+    self._join_thread(self._handoff_port, 1)
+    self._handoff_port = None
+    # After a hand-off, the socket file is the successor's.
+    if not self._handed_off.is_set():
+      self._handoff_sock.close()
+      try:
+        os.unlink(self._handoff_path)
+      except OSError:
+        pass
+
+  def shutdown(self):
+    # Set the shutdown flag, wait a bit for threads to shutdown, then join them
+    # with a timeout.  If any are still alive after the signal, raise an
+    # exception.  If the shutdown wasn't "clean", don't allow a Core to be
+    # restarted.
+    self._stopping = True
+    if self._handed_off.is_set():
+      # Everything went to the successor.
+      self._close_handoff_port()
+      return
+    spaceport_down, gnd_ctrl_down, relay_down = self._stop_threads()
+    self._close_handoff_port()
     # Close the sockets.
     # Close the public connection socket if the spaceport shutdown.
     # Close the satellite connections if ground control and all relays down.
     self._close_sockets(core=spaceport_down,
                         satellites=gnd_ctrl_down and all(relay_down))
+    if spaceport_down and gnd_ctrl_down:
+      self._close_wakeups()
     if spaceport_down and gnd_ctrl_down and all(relay_down):
       self._clean = True
     else:
       err = self._gen_shutdown_error_msg(spaceport_down, gnd_ctrl_down,
                                          relay_down)
       raise CoreShutdownError(err)
-
-
-class _CoreTestCase(_ut.TestCase):
-  def setUp(self):
-    global socket
-    global Spaceport, GroundControl, Relay
-    self.sock_shutdown_count = 0
-    class socket(object):
-      def __init__(self, *args, **kwargs):
-        pass
-      def bind(self, *args, **kwargs):
-        pass
-      def listen(self, *args, **kwargs):
-        pass
-      def shutdown(sock_self, *args, **kwargs):
-        self.sock_shutdown_count += 1
-    class DummyThread(object):
-      def __init__(self, *args, **kwargs):
-        pass
-      def start(self, *args, **kwargs):
-        pass
-      def join(self, *args, **kwargs):
-        pass
-      def is_alive(self, *args, **kwargs):
-        return False
-    Spaceport = DummyThread
-    GroundControl = DummyThread
-    Relay = DummyThread
-
-  def test_core_restart(self):
-    core = Core()
-    core.start()
-    core.shutdown()
-    self.assertEqual(self.sock_shutdown_count, 1)
-    core.start()
-
-  def test_bad_restart(self):
-    core = Core()
-    core.start()
-    with self.assertRaises(InvalidCoreState):
-      core.start()
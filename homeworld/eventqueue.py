@@ -0,0 +1,303 @@
+from collections import deque
+from threading import Lock
+from time import time
+
+from six import b
+
+from events import Event
+from lockeddata import LockedData
+
+
+class QueuePolicyError(ValueError):
+  pass
+
+
+def conflation_key(event, conflate):
+  """
+  Return the key under which a newer event supersedes this one, or None.
+
+  conflate maps event types to the property that identifies the device, e.g.
+  {b'temperature': b'device'}.  Events of other types, or without the
+  property, are never conflated, and neither are requests and replies.
+  """
+  if not conflate or event.type not in conflate \
+  or event.correlation is not None:
+    return None
+  prop = conflate[event.type]
+  if not event.properties or prop not in event.properties:
+    return None
+  return (event.type, event.properties[prop], event.priority_class)
+
+
+def is_heartbeat(event):
+  """
+  Return whether the event is a satellite's heartbeat, which only the Core
+  answers.
+  """
+  return event.type is not None and event.type.lower() == b('heartbeat')
+
+
+class LaneStats(object):
+  """
+  Queueing latency of the events in one priority class.
+  """
+
+  def __init__(self):
+    self.count = 0
+    self.total_wait = 0.0
+    self.max_wait = 0.0
+
+  def record(self, wait):
+    self.count += 1
+    self.total_wait += wait
+    self.max_wait = max(self.max_wait, wait)
+
+  def to_dict(self):
+    return {'count': self.count,
+            'mean_wait_ms': 1000.0 * self.total_wait / self.count
+                            if self.count else None,
+            'max_wait_ms': 1000.0 * self.max_wait}
+
+
+class EventQueue(LockedData):
+  """
+  Queue of received events waiting to be routed by the relays.
+
+  Events are kept in one FIFO lane per priority class, and take() always
+  drains higher classes first.  To keep lower classes moving, a waiting lane
+  that has been passed over starvation_limit times in a row gets the next
+  slot.
+
+  The queue may be bounded with maxlen.  What happens once it is full depends
+  on the policy:
+
+  block        GroundControl stops reading from the satellites with the most
+               events queued until the relays catch up, so TCP pushes back on
+               the busiest publishers.  The bound is soft: quieter satellites
+               are still read, at most one event each per select wakeup.
+  drop_oldest  The oldest events of the lowest queued class are discarded to
+               make room, unless the new event's class is lower still, in
+               which case the new event is discarded instead.
+  reject       New events are discarded, unless they are of a higher class
+               than the lowest queued class, which then loses its oldest
+               event instead.
+
+  Heartbeats are exempt from the bound and the policies, and are taken
+  before any lane: a satellite whose heartbeats went unanswered would take a
+  busy Core for dead and add its reconnect to the load.
+
+  Conflation is opt-in with conflate, a map from event type to the property
+  identifying the device (see conflation_key).  A newer event with the same
+  type and device replaces the queued one in place, keeping its place in
+  line.
+
+  Like the LockedData it extends, the lanes are in data and the lock in lock.
+  data[p] holds the events of priority class p, newest at the left end and
+  oldest at the right.
+  """
+
+  block = 'block'
+  drop_oldest = 'drop_oldest'
+  reject = 'reject'
+  policies = (block, drop_oldest, reject)
+
+  def __init__(self, maxlen=None, policy=block, starvation_limit=16,
+               conflate=None):
+    if policy not in self.policies:
+      raise QueuePolicyError('unknown queue policy: %r' % (policy,))
+    LockedData.__init__(self, [deque() for i in range(Event.num_priorities)],
+                        Lock())
+    self.maxlen = maxlen
+    self.policy = policy
+    self.starvation_limit = starvation_limit
+    self.conflate = conflate
+    # Number of events discarded to make room, and refused by the reject
+    # policy.
+    self.dropped = 0
+    self.rejected = 0
+    # Number of events superseded by a newer event while queued.
+    self.conflated = 0
+    # Largest number of events the queue has held.
+    self.max_depth = 0
+    # Per-class queueing latency recorded by the relays.
+    self.lane_stats = [LaneStats() for i in range(Event.num_priorities)]
+    # Total number of queued events.
+    self._len = 0
+    # Number of times in a row each lane has been passed over.
+    self._skipped = [0] * Event.num_priorities
+    # Map from source satellite to its number of queued events.
+    self._pending = dict()
+    # Map from conflation key to the queued event holding it.
+    self._latest = dict()
+    # Queued heartbeats, newest at the left end.  They count towards len()
+    # but not towards maxlen.
+    self._heartbeats = deque()
+
+  def __len__(self):
+    return self._len
+
+  def full(self):
+    return self.maxlen is not None and \
+           self._len - len(self._heartbeats) >= self.maxlen
+
+  @property
+  def heartbeats(self):
+    """
+    Number of heartbeats waiting to be answered.
+    """
+    return len(self._heartbeats)
+
+  def top_lane(self):
+    """
+    Return the highest priority class with queued events, or -1 if empty.
+    """
+    for lane in range(len(self.data) - 1, -1, -1):
+      if len(self.data[lane]):
+        return lane
+    return -1
+
+  def put(self, rec_events):
+    """
+    Add received events to the queue.
+
+    Returns the number of events accepted.
+    """
+    accepted = 0
+    now = time()
+    with self.lock:
+      for rec_event in rec_events:
+        if is_heartbeat(rec_event.event):
+          self._heartbeats.appendleft(rec_event)
+          self._len += 1
+          accepted += 1
+          continue
+        lane = rec_event.priority
+        key = conflation_key(rec_event.event, self.conflate)
+        if key is not None and key in self._latest:
+          self._supersede(self._latest[key], rec_event)
+          accepted += 1
+          continue
+        if self.full() and self.policy != self.block:
+          lowest = self._bottom_lane()
+          # lowest is -1, with nothing to make room from, when maxlen is 0.
+          evict = lowest < lane or (lowest == lane and
+                                    self.policy == self.drop_oldest)
+          if lowest >= 0 and evict:
+            self._forget(self.data[lowest].pop())
+            self.dropped += 1
+          elif self.policy == self.drop_oldest:
+            # Never push out events of a higher class than the new one.
+            self.dropped += 1
+            continue
+          else:
+            self.rejected += 1
+            continue
+        if rec_event.enqueued_at is None:
+          rec_event.enqueued_at = now
+          if rec_event.event.trace is not None:
+            rec_event.event.stamp(Event.stage_enqueue, now)
+        self.data[lane].appendleft(rec_event)
+        self._len += 1
+        self._pending[rec_event.source] = \
+          self._pending.get(rec_event.source, 0) + 1
+        if key is not None:
+          self._latest[key] = rec_event
+        accepted += 1
+      self.max_depth = max(self.max_depth, self._len)
+    return accepted
+
+  def take(self, max_events=None, above=-1):
+    """
+    Remove and return up to max_events events in the order to route them.
+
+    Heartbeats come first.  Only lanes of a higher priority class than above
+    are taken from.
+    """
+    out = []
+    with self.lock:
+      while len(self._heartbeats) and (max_events is None
+                                       or len(out) < max_events):
+        out.append(self._heartbeats.pop())
+        self._len -= 1
+      while max_events is None or len(out) < max_events:
+        lane = self._next_lane(above)
+        if lane < 0:
+          break
+        rec_event = self.data[lane].pop()
+        self._forget(rec_event)
+        out.append(rec_event)
+    return out
+
+  def record_wait(self, rec_event, now=None):
+    """
+    Record how long an event waited between entering the queue and routing.
+    """
+    if rec_event.enqueued_at is None:
+      return
+    now = time() if now is None else now
+    with self.lock:
+      self.lane_stats[rec_event.priority].record(now - rec_event.enqueued_at)
+
+  def throttled(self):
+    """
+    Return the set of sources GroundControl should stop reading from.
+
+    Only the block policy throttles, and only while the queue is full.  The
+    busiest sources are those with at least their fair share of the queue.
+    """
+    if self.policy != self.block:
+      return set()
+    with self.lock:
+      if not self.full() or not len(self._pending):
+        return set()
+      fair_share = float(self._len) / len(self._pending)
+      return set(source for source, count in self._pending.items()
+                 if count >= fair_share)
+
+  def _next_lane(self, above):
+    top = self.top_lane()
+    if top <= above:
+      return -1
+    # Give a starved lower lane the slot, then charge every other waiting
+    # lower lane for being passed over.
+    chosen = top
+    for lane in range(above + 1, top):
+      if len(self.data[lane]) and self._skipped[lane] >= self.starvation_limit:
+        chosen = lane
+        break
+    for lane in range(above + 1, top + 1):
+      if lane == chosen or not len(self.data[lane]):
+        self._skipped[lane] = 0
+      else:
+        self._skipped[lane] += 1
+    return chosen
+
+  def _bottom_lane(self):
+    for lane in range(len(self.data)):
+      if len(self.data[lane]):
+        return lane
+    return -1
+
+  def _supersede(self, queued, rec_event):
+    # Swap the newer event into the queued one's place.
+    self._release(queued.source)
+    self._pending[rec_event.source] = \
+      self._pending.get(rec_event.source, 0) + 1
+    queued.event = rec_event.event
+    queued.source = rec_event.source
+    self.conflated += 1
+
+  def _forget(self, rec_event):
+    self._len -= 1
+    if len(self._latest):
+      key = conflation_key(rec_event.event, self.conflate)
+      if key is not None and self._latest.get(key) is rec_event:
+        del self._latest[key]
+    self._release(rec_event.source)
+
+  def _release(self, source):
+    count = self._pending.get(source, 0) - 1
+    if count > 0:
+      self._pending[source] = count
+    else:
+      self._pending.pop(source, None)
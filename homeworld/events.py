@@ -1,8 +1,14 @@
+from struct import Struct
+from time import time
+
 import six
 from six import next as it_next, iteritems as d_iteritems
 from six import binary_type, byte2int, int2byte, iterbytes
 from sockutils import long2bytes, bytes2long, iterbytes2long
 
+# A trace stamp's time, as a little-endian double.
+_stamp_time = Struct('<d')
+
 
 class FormatError(Exception):
   pass
@@ -14,14 +20,58 @@ class Event(object):
   flag_recipient = 1 << 0
   flag_type = 1 << 1
   flag_properties = 1 << 2
+  flag_priority = 1 << 3
+  flag_correlation = 1 << 4
+  flag_reply = 1 << 5
+  flag_trace = 1 << 6
+
+  # Priority classes.  Events without a priority are normal priority.
+  low_priority = 0
+  normal_priority = 1
+  high_priority = 2
+  num_priorities = 3
+
+  # Stages of an event's journey, in order, that a trace is stamped at.
+  stage_send = 0
+  stage_core_receive = 1
+  stage_enqueue = 2
+  stage_relay_dequeue = 3
+  stage_socket_write = 4
+  stage_client_receive = 5
+  stage_names = ('send', 'core-receive', 'enqueue', 'relay-dequeue',
+                 'socket-write', 'client-receive')
 
   # Message version [major, minor]
-  version = [0,1]
+  version = [0,4]
 
-  def __init__(self, type=None, recipient=None, properties=None):
+  def __init__(self, type=None, recipient=None, properties=None,
+               priority=None, correlation=None, reply=False, trace=None):
     self.type = type
     self.recipient = recipient
     self.properties = properties
+    self.priority = priority
+    # A request carries a correlation ID, and its reply carries the same ID
+    # with reply set.
+    self.correlation = correlation
+    self.reply = reply
+    # A traced event carries a list of (stage, time) stamps.  Untraced events
+    # carry None, and nothing is stamped.
+    self.trace = trace
+
+  @property
+  def priority_class(self):
+    """
+    The priority clamped to one of the known classes.
+    """
+    if self.priority is None:
+      return self.normal_priority
+    return max(0, min(self.num_priorities - 1, self.priority))
+
+  def stamp(self, stage, when=None):
+    """
+    Add a stamp for stage to the event's trace.
+    """
+    self.trace.append((stage, time() if when is None else when))
 
   def to_bytes(self):
     # Version
@@ -31,6 +81,10 @@ class Event(object):
     toc |= self.flag_recipient if self.recipient is not None else 0
     toc |= self.flag_type if self.type is not None else 0
     toc |= self.flag_properties if self.properties is not None else 0
+    toc |= self.flag_priority if self.priority is not None else 0
+    toc |= self.flag_correlation if self.correlation is not None else 0
+    toc |= self.flag_reply if self.reply else 0
+    toc |= self.flag_trace if self.trace is not None else 0
     out += int2byte(toc)
     # Recipient, if there is one.
     # First size as a 32-bit int.
@@ -65,11 +119,33 @@ class Event(object):
         val_len = min(2**32-1, len(val))
         out += long2bytes(val_len)
         out += val[:val_len]
+    # Fields added after version 0.1 follow the properties, so older readers
+    # simply ignore them.
+    if toc & self.flag_priority:
+      out += int2byte(self.priority_class)
+    if toc & self.flag_correlation:
+      if not isinstance(self.correlation, binary_type):
+        raise TypeError('Event correlation must be binary data')
+      field_len = min(2**32-1, len(self.correlation))
+      out += long2bytes(field_len)
+      out += self.correlation[:field_len]
+    if toc & self.flag_trace:
+      num_stamps = min(2**32-1, len(self.trace))
+      out += long2bytes(num_stamps)
+      for stage, when in self.trace[:num_stamps]:
+        out += int2byte(stage)
+        out += _stamp_time.pack(when)
     return out
 
   def from_bytes(self, mybytes):
     if len(mybytes) < 3:
       raise FormatError('input byte stream too short')
+    try:
+      return self._from_bytes(mybytes)
+    except StopIteration:
+      raise FormatError('input byte stream cut short')
+
+  def _from_bytes(self, mybytes):
     it = iterbytes(mybytes)
     # Version
     self.version = [it_next(it), it_next(it)]
@@ -101,6 +177,26 @@ class Event(object):
         for j in range(val_len):
           val += int2byte(it_next(it))
         self.properties[key] = val
+    # Priority
+    if toc & self.flag_priority:
+      self.priority = it_next(it)
+    # Correlation ID
+    if toc & self.flag_correlation:
+      field_len = iterbytes2long(it)
+      self.correlation = binary_type()
+      for i in range(field_len):
+        self.correlation += int2byte(it_next(it))
+    self.reply = bool(toc & self.flag_reply)
+    # Trace stamps
+    if toc & self.flag_trace:
+      num_stamps = iterbytes2long(it)
+      self.trace = []
+      for i in range(num_stamps):
+        stage = it_next(it)
+        when = binary_type()
+        for j in range(_stamp_time.size):
+          when += int2byte(it_next(it))
+        self.trace.append((stage, _stamp_time.unpack(when)[0]))
     return self
 
 
@@ -112,3 +208,9 @@ class ReceivedEvent(object):
   def __init__(self, event, source):
     self.event = event
     self.source = source
+    # Time the event entered the Core's global queue.
+    self.enqueued_at = None
+
+  @property
+  def priority(self):
+    return self.event.priority_class
@@ -1,27 +1,58 @@
-from collections import deque
+import os
+from random import random
 from select import select
-from threading import Thread
+import socket
+import stat
+from struct import error as StructError
+from threading import Lock, Thread
+from time import time
 
 from six import b
 
-from sockutils import bytes2long
-from events import Event, ReceivedEvent
-
-# Unit test modules
-import unittest as _ut
-from threading import Condition as _Cond
-from lockeddata import LockedData as _LD
-from flag import Flag as _Flag
-from sockutils import long2bytes as _l2b
+from ring import RingBuffer
+from sockutils import bytes2long, peer_uid, recvall
+from events import Event, FormatError, ReceivedEvent
+from lockeddata import LockedData
+from timerwheel import TimerWheel
 
 
 class GroundControl(Thread):
   """
   Listen for satellite messages on their sockets.
+
+  If a sockutils.Wakeup is given, ringing it makes GroundControl pick up
+  changes to the satellite map without waiting for the select timeout.
+
+  A satellite connected over the Core's UNIX socket may send an attach-ring
+  event naming a ring.RingBuffer, and from then on write its events there.
+  Attached rings are drained on every pass, up to ring_batch events each, and
+  at least every ring_poll seconds.  An empty frame on the socket is the
+  satellite's doorbell: it carries no event, it only wakes the select.  The
+  satellite still sends events too large for its ring over the socket, and
+  each event read there is counted in the ring, so the satellite knows when
+  its events may go back to the ring without overtaking them.  A
+  satellite whose ring is found corrupt is hung up on.  Only a regular file
+  owned by the satellite's user, as told by SO_PEERCRED, is attached, or,
+  where the platform cannot tell, one owned by the Core's own user.
+
+  With heartbeat_timeout, a satellite that sends nothing at all, not even a
+  heartbeat, for that many seconds is taken for dead.  It is removed along
+  with all its registrations and its socket is shut down.  Idle deadlines are
+  kept in a TimerWheel, so each frame received costs O(1) and no pass scans
+  every satellite.  The timers start for the satellites in sat_map when
+  GroundControl is made, and for those passed to joined() later.
+
+  rings are ring buffers already attached, by satellite socket, such as those
+  a Core hands over to its successor.
+
+  Traced events are stamped as they are received.  Of the events that arrive
+  untraced, a trace_sample fraction has a trace started here.
   """
 
   def __init__(self, sat_map, event_sat_map, event_queue, signal,
-               shutdown_flag, timeout=0.5):
+               shutdown_flag, timeout=0.5, throttle_poll=0.01, wakeup=None,
+               ring_poll=0.05, ring_batch=256, heartbeat_timeout=None,
+               trace_sample=0.0, rings=None):
     # Always call the parent Thread object's init function first.
     Thread.__init__(self)
     self._sat_map = sat_map
@@ -30,116 +61,254 @@ class GroundControl(Thread):
     self._cond = signal
     self._shutdown_flag = shutdown_flag
     self._timeout = timeout
+    # How often to check whether throttled satellites may be read again.
+    self._throttle_poll = throttle_poll
+    self._wakeup = wakeup
+    self._ring_poll = ring_poll
+    self._ring_batch = ring_batch
+    # Map from satellite socket to its attached ring buffer.
+    self._rings = dict(rings or {})
+    self._heartbeat_timeout = heartbeat_timeout
+    # Deadlines by which each satellite must be heard from again.
+    self._idle = None
+    # Satellites connected since the last pass, whose idle timers are yet to
+    # start.
+    self._joined = LockedData([], Lock())
+    if heartbeat_timeout is not None:
+      self._idle = TimerWheel(tick=heartbeat_timeout / 8.0)
+      with self._sat_map.lock:
+        self._joined.data.extend(self._sat_map.data)
+    self._trace_sample = trace_sample
 
   def run(self):
     while not self._shutdown_flag:
       self._run_loop()
 
+  @property
+  def rings(self):
+    return dict(self._rings)
+
+  def joined(self, sats):
+    """
+    Start the idle timers of newly connected satellites, on the next pass.
+
+    Safe to call from any thread, such as a Spaceport's.
+    """
+    if self._idle is None:
+      return
+    with self._joined.lock:
+      self._joined.data.extend(sats)
+
   def _run_loop(self):
+    if self._idle is not None:
+      self._reap_idle()
     # Listen on the satellite sockets for events.
     sat_list = self._listen_for_events()
     # If the select was broken prematurely (e.g. OS event), start over.
-    if not len(sat_list):
+    if not len(sat_list) and not len(self._rings):
       return
     # Loop over the sockets and receive their messages.
     event_queue = []
     for sat in sat_list:
+      if sat is self._wakeup:
+        self._wakeup.clear()
+        continue
       event = self._get_event(sat)
       if event:
-        event_queue.append(ReceivedEvent(event, sat))
+        event_queue.append(self._received(event, sat))
+    # Socket events go first, so an event sent before a ring was attached
+    # is not overtaken by the ring's.
+    if len(self._rings):
+      event_queue.extend(self._read_rings())
     self._add_events_to_queue(event_queue)
 
   def _listen_for_events(self):
+    if self._idle is not None:
+      self._start_idle_timers()
     # Copy the currently registered satellite list.
     with self._sat_map.lock:
       rd_list = [x for x in self._sat_map.data]
+    timeout = self._timeout
+    if self._idle is not None:
+      timeout = min(timeout, self._idle.tick)
+    # While the event queue is full, leave the busiest satellites unread so
+    # their sends back up over TCP.  Poll more often so reading resumes soon
+    # after the relays have caught up.
+    throttled = self._gbl_queue.throttled()
+    if len(throttled):
+      rd_list = [x for x in rd_list if x not in throttled]
+      timeout = min(timeout, self._throttle_poll)
+    if len(self._rings):
+      timeout = min(timeout, self._ring_poll)
+    if self._wakeup is not None:
+      rd_list.append(self._wakeup)
     # Wait for a socket message.
-    return select(rd_list,[],[], self._timeout)[0]
+    return select(rd_list,[],[], timeout)[0]
+
+  def _start_idle_timers(self):
+    with self._joined.lock:
+      joined, self._joined.data = self._joined.data, []
+    if not len(joined):
+      return
+    now = time()
+    # Skip any satellite that has already left again.
+    with self._sat_map.lock:
+      for sat in joined:
+        if sat in self._sat_map.data:
+          self._idle.schedule(sat, self._heartbeat_timeout, now)
 
   def _get_event(self, sat):
-    # Receive the header.
-    hdr = sat.recv(4)
-    # If the header is empty, the socket is closed, so remove the satellite
-    # from the sat map.
-    if not len(hdr):
+    # Receive the header.  If it is empty or cut short, or the connection
+    # failed, the socket is closed, so remove the satellite from the sat map.
+    try:
+      hdr = recvall(sat, 4)
+      if len(hdr) < 4:
+        self._remove_sat(sat)
+        return None
+      self._heard_from(sat)
+      event_len = bytes2long(hdr)
+      # An empty frame is a ring doorbell or a heartbeat.
+      if not event_len:
+        return None
+      # Receive the event.
+      event_bytes = recvall(sat, event_len)
+    except (IOError, OSError):
       self._remove_sat(sat)
       return None
-    event_len = bytes2long(hdr)
-    # Receive the event.
-    event_bytes = sat.recv(event_len)
-    return Event().from_bytes(event_bytes)
+    if len(event_bytes) < event_len:
+      self._remove_sat(sat)
+      return None
+    try:
+      event = Event().from_bytes(event_bytes)
+    except FormatError:
+      # Nothing after it on the socket can be trusted to line up.
+      self._drop_sat(sat)
+      return None
+    if event.type == b('attach-ring'):
+      self._attach_ring(sat, event)
+      return None
+    ring = self._rings.get(sat)
+    if ring is not None:
+      ring.count_bypass()
+    return event
+
+  def _attach_ring(self, sat, event):
+    # Only a satellite on this host can share memory with the Core, and only a
+    # ring file made by RingBuffer.create() is opened.
+    if getattr(sat, 'family', None) != getattr(socket, 'AF_UNIX', None):
+      return
+    path = (event.properties or {}).get(b('path'))
+    if not path:
+      return
+    path = path.decode('utf-8', 'replace')
+    name = os.path.basename(path)
+    if not (name.startswith(RingBuffer.prefix)
+            and name.endswith(RingBuffer.suffix)):
+      return
+    ring = self._open_ring(sat, path)
+    if ring is None:
+      return
+    # Both ends have it mapped now, so it needn't outlive them.  The name is
+    # checked again first, in case the file was swapped since it was opened.
+    try:
+      opened = os.fstat(ring.fileno())
+      named = os.lstat(path)
+      if (named.st_dev, named.st_ino) == (opened.st_dev, opened.st_ino):
+        ring.unlink()
+    except (IOError, OSError):
+      pass
+    self._detach_ring(sat)
+    self._rings[sat] = ring
+
+  def _open_ring(self, sat, path):
+    # Open the ring only if the satellite could have made it: a regular file,
+    # not a link to one, owned by the satellite's user.
+    owner = peer_uid(sat)
+    if owner is None:
+      owner = os.getuid()
+    try:
+      fd = os.open(path, os.O_RDWR | getattr(os, 'O_NOFOLLOW', 0))
+    except (IOError, OSError):
+      return None
+    try:
+      info = os.fstat(fd)
+    except (IOError, OSError):
+      os.close(fd)
+      return None
+    if not stat.S_ISREG(info.st_mode) or info.st_uid != owner:
+      os.close(fd)
+      return None
+    try:
+      return RingBuffer(path, fd)
+    except (IOError, OSError, ValueError):
+      return None
+
+  def _detach_ring(self, sat):
+    ring = self._rings.pop(sat, None)
+    if ring is not None:
+      ring.close()
+
+  def _read_rings(self):
+    # Leave throttled satellites' rings to fill up, like their sockets.
+    throttled = self._gbl_queue.throttled()
+    events = []
+    for sat, ring in list(self._rings.items()):
+      if sat in throttled:
+        continue
+      try:
+        received = [Event().from_bytes(frame)
+                    for frame in ring.read(self._ring_batch)]
+      except (ValueError, StructError, FormatError):
+        # The satellite would only go on writing to a ring nobody reads,
+        # so hang up on it.
+        self._drop_sat(sat)
+        continue
+      if len(received):
+        self._heard_from(sat)
+      events.extend(self._received(event, sat) for event in received)
+    return events
+
+  def _received(self, event, sat):
+    if event.trace is None and self._trace_sample \
+    and random() < self._trace_sample:
+      event.trace = []
+    if event.trace is not None:
+      event.stamp(Event.stage_core_receive)
+    return ReceivedEvent(event, sat)
+
+  def _heard_from(self, sat):
+    if self._idle is not None:
+      self._idle.schedule(sat, self._heartbeat_timeout)
+
+  def _reap_idle(self):
+    # Only shut the socket down: a relay may still be writing to it, and
+    # closing it would free its descriptor for reuse.  It is closed once
+    # nothing refers to it any more.
+    for sat in self._idle.expire():
+      self._drop_sat(sat)
+
+  def _drop_sat(self, sat):
+    # Hang up on a satellite that is still connected.  The satellite sees
+    # the connection drop, and any relay writing to it fails.
+    self._remove_sat(sat)
+    try:
+      sat.shutdown(socket.SHUT_RDWR)
+    except (IOError, OSError):
+      pass
 
   def _remove_sat(self, sat):
     # Remove satellites that have closed their connection from both the
-    # satellite map and any event registration lists.
+    # satellite map and, in one step, all their event registrations.
+    self._detach_ring(sat)
+    if self._idle is not None:
+      self._idle.cancel(sat)
     with self._sat_map.lock:
-      del self._sat_map.data[sat]
-    with self._event_sat_map.lock:
-      for ev_type in self._event_sat_map.data:
-        try:
-          self._event_sat_map.data[ev_type].remove(sat)
-        except ValueError:
-          continue
+      self._sat_map.data.pop(sat, None)
+    self._event_sat_map.remove_sat(sat)
 
   def _add_events_to_queue(self, events):
     if not len(events):
       return
-    with self._gbl_queue.lock:
-      self._gbl_queue.data.extendleft(events)
+    self._gbl_queue.put(events)
     with self._cond:
       self._cond.notify()
-
-
-class _GroundControlTestCase(_ut.TestCase):
-
-  def setUp(self):
-    self.ev = Event(type=b('test'))
-    self.recv_call_count = 0
-    class DummySat(object):
-      def recv(sat_self, dummy):
-        if self.recv_call_count % 2 == 0:
-          self.recv_call_count += 1
-          return _l2b(len(self.ev.to_bytes()))
-        else:
-          self.recv_call_count += 1
-          return self.ev.to_bytes()
-    self.sat = DummySat()
-    global select
-    def select(rd_list, wr_list, ex_list, timeout=None):
-      return [self.sat],[],[]
-    self.sat_map = _LD({self.sat: True})
-    self.event_sat_map = _LD({b('all'): [self.sat]})
-    self.event_queue = _LD(deque())
-    self.signal = _Cond()
-    self.flag = _Flag()
-    self.gc = GroundControl(self.sat_map, self.event_sat_map, self.event_queue,
-                            self.signal, self.flag)
-
-  def test_add_ev_to_queue(self):
-    self.assertEqual(len(self.event_queue.data), 0)
-    self.gc._add_events_to_queue([self.ev])
-    self.assertEqual(len(self.event_queue.data), 1)
-    self.assertEqual(self.event_queue.data[0], self.ev)
-
-  def test_get_event(self):
-    ev = self.gc._get_event(self.sat)
-    self.assertEqual(ev.to_bytes(), self.ev.to_bytes())
-
-  def test_listen(self):
-    rd_list = self.gc._listen_for_events()
-    self.assertEqual(len(rd_list), 1)
-    self.assertEqual(rd_list[0], self.sat)
-
-  def test_remove_sat(self):
-    self.assertTrue(self.sat in self.sat_map.data)
-    self.assertTrue(self.sat in self.event_sat_map.data[b('all')])
-    self.gc._remove_sat(self.sat)
-    self.assertFalse(self.sat in self.sat_map.data)
-    self.assertFalse(self.sat in self.event_sat_map.data[b('all')])
-
-  def test_run_loop(self):
-    self.assertEqual(len(self.event_queue.data), 0)
-    self.gc._run_loop()
-    self.assertEqual(len(self.event_queue.data), 1)
-    self.gc._run_loop()
-    self.assertEqual(len(self.event_queue.data), 2)
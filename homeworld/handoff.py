@@ -0,0 +1,167 @@
+"""
+Handing a running Core's sockets and registrations over to a successor.
+
+The successor connects to the Core's hand-off socket, a UNIX domain socket.
+The Core stops reading and routing and then sends its state as JSON and its
+open descriptors (the listening sockets, the satellite sockets and their
+rings) as SCM_RIGHTS messages.  It carries on as before unless the successor
+confirms it has everything.  Satellite connections are never closed, so
+events sent in the meantime wait in the sockets' buffers for the successor.
+
+The confirmation decides which Core carries on, so it must never count for
+one Core and not the other.  A Core that gives up waiting for it shuts the
+connection for reading first.  After that, a confirmation the successor
+sends fails with EPIPE, and the successor gives up too.  Only one that was
+already on its way counts.
+"""
+from array import array
+import json
+import os
+from select import select
+import socket
+from threading import Thread
+
+from six import b
+
+from sockutils import bytes2long, long2bytes, peer_uid, recvall
+
+# Most descriptors sent in one message.  Linux allows 253.
+_max_fds = 250
+
+
+class HandoffError(RuntimeError):
+  pass
+
+
+def supported():
+  """
+  Return whether descriptors can be passed between processes here, and the
+  user passing them to checked.
+  """
+  return hasattr(socket, 'AF_UNIX') and hasattr(socket.socket, 'sendmsg') \
+         and hasattr(socket, 'SO_PEERCRED')
+
+
+def send_handoff(conn, state, fds, timeout=10.0):
+  """
+  Send state, a dict that JSON can encode, and the descriptors fds to the
+  successor on conn, and wait for it to confirm it has taken over.
+  """
+  conn.settimeout(timeout)
+  try:
+    body = json.dumps(state).encode('utf-8')
+    conn.sendall(long2bytes(len(body)) + long2bytes(len(fds)) + body)
+    for start in range(0, len(fds), _max_fds):
+      chunk = array('i', fds[start:start + _max_fds])
+      conn.sendmsg([b('F')], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                               chunk.tobytes())])
+    confirmed = recvall(conn, 1) == b('\1')
+  except (IOError, OSError):
+    confirmed = False
+  if not confirmed and not _fence(conn):
+    raise HandoffError('successor did not take over')
+
+
+def _fence(conn):
+  # Stop the successor confirming from now on, and return whether it already
+  # has.
+  try:
+    conn.shutdown(socket.SHUT_RD)
+    conn.setblocking(False)
+    return conn.recv(1) == b('\1')
+  except (IOError, OSError):
+    return False
+
+
+def receive_handoff(conn, timeout=10.0):
+  """
+  Receive the state and descriptors sent by send_handoff().
+
+  The caller owns the descriptors, and confirms with confirm_handoff() once
+  it is ready to use them.
+  """
+  conn.settimeout(timeout)
+  header = recvall(conn, 8)
+  if len(header) < 8:
+    raise HandoffError('predecessor hung up')
+  body_len = bytes2long(header[:4])
+  num_fds = bytes2long(header[4:])
+  body = recvall(conn, body_len)
+  if len(body) < body_len:
+    raise HandoffError('predecessor hung up')
+  fds = []
+  try:
+    while len(fds) < num_fds:
+      want = min(_max_fds, num_fds - len(fds))
+      data, ancdata, flags, addr = conn.recvmsg(
+        1, socket.CMSG_SPACE(want * array('i').itemsize))
+      if not len(data):
+        raise HandoffError('predecessor hung up')
+      for level, kind, cdata in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+          received = array('i')
+          whole = len(cdata) - len(cdata) % received.itemsize
+          received.frombytes(cdata[:whole])
+          fds.extend(received)
+      if flags & socket.MSG_CTRUNC:
+        raise HandoffError('descriptors were cut short')
+  except Exception:
+    close_fds(fds)
+    raise
+  return json.loads(body.decode('utf-8')), fds
+
+
+def confirm_handoff(conn):
+  """
+  Tell the predecessor the successor has taken over.
+
+  Raises IOError or OSError if the predecessor has given up waiting, in
+  which case it carries on and the caller must let go of the descriptors.
+  """
+  conn.sendall(b('\1'))
+
+
+def close_fds(fds):
+  for fd in fds:
+    try:
+      os.close(fd)
+    except OSError:
+      pass
+
+
+class HandoffPort(Thread):
+  """
+  Waits on the Core's hand-off socket for a successor to connect.
+
+  Each successor's connection is passed to on_successor, and closed once it
+  returns.  Only a successor run by the same user is, as told by
+  SO_PEERCRED, since it is given every socket the Core has.  The socket must
+  be non-blocking.
+  """
+  def __init__(self, socket, shutdown_flag, on_successor, timeout=0.5):
+    # Always call the parent Thread object's init function first.
+    Thread.__init__(self)
+    self._sock = socket
+    self._shutdown_flag = shutdown_flag
+    self._on_successor = on_successor
+    self._timeout = timeout
+
+  def run(self):
+    while not self._shutdown_flag:
+      self._run_loop()
+
+  def _run_loop(self):
+    rd_list = select([self._sock], [], [], self._timeout)[0]
+    if not len(rd_list):
+      return
+    try:
+      conn, addr = self._sock.accept()
+    except (IOError, OSError):
+      return
+    try:
+      if peer_uid(conn) != os.getuid():
+        return
+      conn.setblocking(True)
+      self._on_successor(conn)
+    finally:
+      conn.close()
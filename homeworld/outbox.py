@@ -0,0 +1,131 @@
+from collections import deque
+from copy import copy
+from socket import SHUT_RDWR, timeout
+from threading import Lock
+from time import time
+
+from events import Event
+from eventqueue import conflation_key
+from sockutils import long2bytes
+
+
+class Outbox(object):
+  """
+  Events waiting to be written to one satellite.
+
+  Any relay may add events, but only one at a time writes them out.  Events
+  to a satellite are therefore never interleaved on its socket, and a slow
+  satellite only holds up the relay writing to it.  While that relay is busy,
+  newer conflatable events replace their waiting predecessors, so the
+  satellite catches up as soon as it drains.
+
+  Like the Core's EventQueue, events wait in one FIFO lane per priority
+  class, and higher classes are always written first, so an alarm to a
+  satellite that has fallen behind does not wait behind its backlog.
+
+  Putting None queues a heartbeat, an empty frame, in the highest lane.  Once a write fails, the
+  satellite's socket is shut down, so GroundControl removes it, and further
+  events are discarded.
+
+  Traced events are stamped as they are written, and then passed to
+  trace_hook, if given.
+  """
+
+  def __init__(self, conflate=None, trace_hook=None):
+    self._conflate = conflate
+    self._trace_hook = trace_hook
+    self._lock = Lock()
+    # One lane per priority class.  Entries are [event, conflation key]
+    # lists so an event can be replaced in place.  Newest are at the left
+    # end.
+    self._lanes = [deque() for i in range(Event.num_priorities)]
+    self._len = 0
+    self._latest = dict()
+    self._writing = False
+    self.failed = False
+    # Number of events superseded before they were written.
+    self.conflated = 0
+
+  def __len__(self):
+    return self._len
+
+  def put(self, event):
+    if self.failed:
+      return
+    key = None if event is None else conflation_key(event, self._conflate)
+    with self._lock:
+      if key is not None:
+        entry = self._latest.get(key)
+        if entry is not None:
+          entry[0] = event
+          self.conflated += 1
+          return
+      entry = [event, key]
+      if event is None:
+        # A late heartbeat could get the satellite taken for dead.
+        lane = Event.num_priorities - 1
+      else:
+        lane = event.priority_class
+      self._lanes[lane].appendleft(entry)
+      self._len += 1
+      if key is not None:
+        self._latest[key] = entry
+
+  def flush(self, sat):
+    """
+    Write waiting events to the satellite, unless another relay already is.
+    """
+    with self._lock:
+      if self._writing:
+        return
+      self._writing = True
+    try:
+      while True:
+        with self._lock:
+          if not self._len:
+            self._writing = False
+            return
+          lane = self._top_lane()
+          event, key = lane.pop()
+          self._len -= 1
+          if key is not None:
+            del self._latest[key]
+        send_event(event, sat, self._trace_hook)
+    except (timeout, IOError, OSError):
+      # The satellite is gone, or too slow to keep within the socket's send
+      # timeout.  A timed-out write may have sent part of a frame, so the
+      # stream can't be carried on either way.  Shutting the socket down
+      # wakes GroundControl to remove it; until then there is no point
+      # queueing for it.
+      with self._lock:
+        self.failed = True
+        for lane in self._lanes:
+          lane.clear()
+        self._len = 0
+        self._latest.clear()
+        self._writing = False
+      try:
+        sat.shutdown(SHUT_RDWR)
+      except (IOError, OSError):
+        pass
+
+  def _top_lane(self):
+    for lane in reversed(self._lanes):
+      if len(lane):
+        return lane
+
+
+def send_event(event, sat, trace_hook=None):
+  # Each frame goes out in one sendall(): send() may write only part of it,
+  # and a short write would leave the satellite's stream out of frame.
+  if event is None:
+    sat.sendall(long2bytes(0))
+    return
+  if event.trace is not None:
+    # The same event may be on its way to other satellites, so stamp a copy.
+    event = copy(event)
+    event.trace = event.trace + [(Event.stage_socket_write, time())]
+  event_bytes = event.to_bytes()
+  sat.sendall(long2bytes(len(event_bytes)) + event_bytes)
+  if event.trace is not None and trace_hook is not None:
+    trace_hook(event)
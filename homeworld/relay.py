@@ -1,29 +1,57 @@
-from collections import deque
-from threading import Thread
+from threading import Lock, Thread
+from weakref import WeakKeyDictionary
 
 from six import b
 
-from sockutils import bytes2long, long2bytes
+from events import Event
+from eventqueue import EventQueue, is_heartbeat
+from lockeddata import LockedData
+from outbox import Outbox
+from rpc import PendingRequests, undeliverable
 
-# Unit test modules
-import unittest as _ut
-import events as _ev
-from flag import Flag as _Flag
-from lockeddata import LockedData as _LD
-from threading import Condition as _Cond
 
 class Relay(Thread):
   """
   Route events placed into its queue to registered satellites.
+
+  Events are written through each satellite's Outbox, which outbox_map (a
+  LockedData around a WeakKeyDictionary) shares between the relays.  conflate
+  is passed on to new outboxes.  event_sat_map is the Core's Subscriptions.
+
+  A heartbeat event from a satellite is answered with a heartbeat, an empty
+  frame.
+
+  A request, an event with a correlation ID, goes only to the satellite
+  registered under its recipient name, and the reply only to the requester.
+  pending, the Core's PendingRequests, remembers who is waiting for which
+  reply, whichever relay routes it.
+
+  Traced events are stamped as they are taken from the queue, and
+  trace_hook, if given, is passed to new outboxes.
   """
-  def __init__(self, event_queue, signal, event_sat_map, shutdown_flag):
+  def __init__(self, event_queue, signal, event_sat_map, shutdown_flag,
+               batch_size=64, outbox_map=None, conflate=None, pending=None,
+               trace_hook=None):
     # Always call the parent Thread object's init function first.
     Thread.__init__(self)
     self._gbl_queue = event_queue
-    self._queue = deque()
+    # Local queue, with the same priority lanes as the global queue.
+    self._queue = EventQueue()
     self._cond = signal
     self._event_sat_map = event_sat_map
     self._shutdown_flag = shutdown_flag
+    # Maximum number of events to take from the global queue at once.  Taking
+    # a bounded batch keeps the global queue bound meaningful and leaves work
+    # for the other relays.
+    self._batch_size = batch_size
+    if outbox_map is None:
+      outbox_map = LockedData(WeakKeyDictionary(), Lock())
+    self._outbox_map = outbox_map
+    self._conflate = conflate
+    if pending is None:
+      pending = PendingRequests()
+    self._pending = pending
+    self._trace_hook = trace_hook
 
   def run(self):
     while not self._shutdown_flag:
@@ -32,157 +60,140 @@ class Relay(Thread):
   def _run_loop(self):
     self._get_events()
     while len(self._queue):
-      self._process_event(self._queue.pop())
+      self._process_event(self._queue.take(1)[0])
+      self._get_urgent_events()
 
   def _get_events(self):
     with self._cond:
-      while not len(self._gbl_queue.data) and not self._shutdown_flag:
+      while not len(self._gbl_queue) and not self._shutdown_flag:
         self._cond.wait()
-      while len(self._gbl_queue.data):
-          self._queue.appendleft(self._gbl_queue.data.pop())
+      self._queue.put(self._gbl_queue.take(self._batch_size))
+      # Wake another relay if there are events left over.
+      if len(self._gbl_queue):
+        self._cond.notify()
+
+  def _get_urgent_events(self):
+    # Pull in events of a higher class than any waiting locally, so they are
+    # not held up behind the rest of this relay's batch.
+    local_top = self._queue.top_lane()
+    if self._gbl_queue.top_lane() > local_top or self._gbl_queue.heartbeats:
+      self._queue.put(self._gbl_queue.take(self._batch_size, above=local_top))
 
   def _process_event(self, rec_event):
+    self._gbl_queue.record_wait(rec_event)
     event = rec_event.event
-    if event.type.lower() == b('register') \
-    or event.type.lower() == b('unregister'):
+    if event.trace is not None:
+      event.stamp(Event.stage_relay_dequeue)
+    ev_type = event.type.lower() if event.type is not None else None
+    # Registrations and heartbeats are for the Core only, so they are not
+    # routed on.
+    if ev_type == b('register') or ev_type == b('unregister'):
       self._process_register_event(rec_event)
+      return
+    if is_heartbeat(event):
+      self._answer_heartbeat(rec_event.source)
+      return
+    if event.correlation is not None:
+      if event.reply:
+        self._route_reply(rec_event)
+        return
+      if event.recipient is not None:
+        self._route_request(rec_event)
+        return
     self._route_event(rec_event)
 
+  def _route_request(self, rec_event):
+    event = rec_event.event
+    sat = self._event_sat_map.lookup(event.recipient)
+    if sat is None:
+      # Nobody to answer, so answer for them.
+      self._send(rec_event.source,
+                 Event(type=undeliverable, recipient=event.recipient,
+                       correlation=event.correlation, reply=True))
+      return
+    # Forward under a token of our own; the requester's ID is restored on
+    # the reply.
+    event.correlation = self._pending.add(rec_event.source, event.correlation,
+                                          sat)
+    self._send(sat, event)
+
+  def _route_reply(self, rec_event):
+    event = rec_event.event
+    waiting = self._pending.pop(event.correlation, rec_event.source)
+    # Replies that come too late, to no request, or from a satellite the
+    # request was not sent to, are dropped.
+    if waiting is None:
+      return
+    requester, event.correlation = waiting
+    self._send(requester, event)
+
+  def _send(self, sat, event):
+    outbox = self._get_outbox(sat)
+    outbox.put(event)
+    outbox.flush(sat)
+
+  def _answer_heartbeat(self, sat):
+    # Let the satellite know the Core is alive.
+    self._send(sat, None)
+
   def _route_event(self, rec_event):
     event = rec_event.event
     sats_sent = {}
     for sat in self._event_sat_map.data[b('all')]:
       if sat not in sats_sent:
-        _send_event(event, sat)
-        sats_sent[sat] = True
+        sats_sent[sat] = self._get_outbox(sat)
     if event.type in self._event_sat_map.data:
       for sat in self._event_sat_map.data[event.type]:
         if sat not in sats_sent:
-          _send_event(event, sat)
-          sats_sent[sat] = True
+          sats_sent[sat] = self._get_outbox(sat)
+    # Queue the event for every satellite before writing any, so one slow
+    # satellite doesn't delay the others.
+    for outbox in sats_sent.values():
+      outbox.put(event)
+    for sat, outbox in sats_sent.items():
+      outbox.flush(sat)
+
+  def _get_outbox(self, sat):
+    with self._outbox_map.lock:
+      outbox = self._outbox_map.data.get(sat)
+      if outbox is None:
+        outbox = Outbox(self._conflate, self._trace_hook)
+        self._outbox_map.data[sat] = outbox
+      return outbox
 
   def _process_register_event(self, rec_event):
     event = rec_event.event
     sat = rec_event.source
     # Drop registration events that don't have any properties.
-    if not hasattr(event, 'properties'):
+    if not event.properties:
       return
-    # Drop registration events without a "type" property.
-    if b('type') not in event.properties:
+    # A "name" property registers the name requests are addressed to.
+    if b('name') in event.properties:
+      if event.type.lower() == b('register'):
+        self._event_sat_map.add_name(sat, event.properties[b('name')])
+      else:
+        self._event_sat_map.remove_name(sat, event.properties[b('name')])
+    # Registration events name one type in a "type" property, or several in a
+    # NUL-separated "types" property.  Drop events with neither.
+    if b('type') in event.properties:
+      ev_types = [event.properties[b('type')]]
+    elif b('types') in event.properties:
+      ev_types = event.properties[b('types')].split(b('\0'))
+    else:
       return
     if event.type.lower() == b('register'):
-      # Add satellite to list for specified type.
-      self._add_sat_event(sat, event.properties[b('type')])
+      # Add satellite to list for specified types.
+      self._add_sat_events(sat, ev_types)
     elif event.type.lower() == b('unregister'):
-      # Remove satellite from list for specified type.
-      self._remove_sat_event(sat, event.properties[b('type')])
+      # Remove satellite from list for specified types.
+      for ev_type in ev_types:
+        self._remove_sat_event(sat, ev_type)
 
   def _add_sat_event(self, sat, ev_type):
-    # Lock the event sat map to modify it.
-    with self._event_sat_map.lock:
-      ev_sat_map = self._event_sat_map.data
-      # Create a new empty list if no satellites have registered for this type.
-      if ev_type not in ev_sat_map:
-        ev_sat_map[ev_type] = list()
-      # Add the satellite if it's not already in the list.
-      try:
-        ev_sat_map[ev_type].index(sat)
-      except ValueError:
-        ev_sat_map[ev_type].append(sat)
+    self._add_sat_events(sat, [ev_type])
+
+  def _add_sat_events(self, sat, ev_types):
+    self._event_sat_map.add(sat, ev_types)
 
   def _remove_sat_event(self, sat, ev_type):
-    # Lock the event sat map to modify it.
-    with self._event_sat_map.lock:
-      ev_sat_map = self._event_sat_map.data
-      # Bail if no list for the event type exists.
-      if ev_type not in ev_sat_map:
-        return
-      # Add the satellite if it's not already in the list.
-      try:
-        ev_sat_map[ev_type].remove(sat)
-      except ValueError:
-        pass
-
-
-def _send_event(event, sat):
-  event_bytes = event.to_bytes()
-  event_len = long2bytes(len(event_bytes))
-  sat.send(event_len)
-  sat.send(event_bytes)
-
-
-class _RelayTestCase(_ut.TestCase):
-
-  def setUp(self):
-    # Set up a dummy satellite object that counts calls to send.
-    self.sat_send_called = 0
-    class DummySat(object):
-      def send(sat_self, data):
-        self.sat_send_called += 1
-    self.sat = DummySat()
-    self.queue = _LD(deque())
-    self.signal = _Cond()
-    self.ev_sat_map = _LD({b('all'): [self.sat]})
-    self.flag = _Flag()
-    self.relay = Relay(self.queue, self.signal, self.ev_sat_map, self.flag)
-
-  def test_send_all(self):
-    # Create event to process.
-    ev = _ev.Event(type=b('test'))
-    rec_ev = _ev.ReceivedEvent(ev, self.sat)
-    self.relay._process_event(rec_ev)
-    self.assertEqual(self.sat_send_called, 2)
-
-  def test_add_sat(self):
-    self.assertFalse(b('test') in self.ev_sat_map.data)
-    self.relay._add_sat_event(self.sat, b('test'))
-    self.assertTrue(b('test') in self.ev_sat_map.data)
-
-  def test_remove_sat(self):
-    self.ev_sat_map.data[b('test')] = [self.sat]
-    self.assertTrue(self.sat in self.ev_sat_map.data[b('test')])
-    self.relay._remove_sat_event(self.sat, b('test'))
-    self.assertFalse(self.sat in self.ev_sat_map.data[b('test')])
-
-  def test_register_event(self):
-    # Create register event to process.
-    ev = _ev.Event(type=b('register'),
-                   properties={b('type'): b('test')})
-    rec_ev = _ev.ReceivedEvent(ev, self.sat)
-    self.assertFalse(not hasattr(ev, 'properties'))
-    self.assertFalse(b('type') not in ev.properties)
-    self.assertFalse(b('test') in self.ev_sat_map.data)
-    self.relay._process_register_event(rec_ev)
-    self.assertEqual(self.sat_send_called, 0)
-    self.assertTrue(b('test') in self.ev_sat_map.data)
-
-  def test_register(self):
-    # Create register event to process.
-    ev = _ev.Event(type=b('register'),
-                   properties={b('type'): b('test')})
-    rec_ev = _ev.ReceivedEvent(ev, self.sat)
-    self.assertFalse(b('test') in self.ev_sat_map.data)
-    self.relay._process_event(rec_ev)
-    self.assertEqual(self.sat_send_called, 0)
-    self.assertTrue(b('test') in self.ev_sat_map.data)
-
-  def test_relay(self):
-    # Add sat to b'test' types.
-    self.ev_sat_map.data[b('test')] = [self.sat]
-    # Create test event to relay.
-    ev = _ev.Event(type=b('test'),
-                   properties={b('type'): b('test')})
-    rec_ev = _ev.ReceivedEvent(ev, self.sat)
-    self.assertEqual(self.sat_send_called, 0)
-    self.relay._process_event(rec_ev)
-    self.assertEqual(self.sat_send_called, 2)
-
-  def test_run_loop(self):
-    # Create test event and add to queue.
-    ev = _ev.Event(type=b('test'),
-                   properties={b('type'): b('test')})
-    rec_ev = _ev.ReceivedEvent(ev, self.sat)
-    self.queue.data.append(rec_ev)
-    self.assertEqual(self.sat_send_called, 0)
-    self.relay._run_loop()
-    self.assertEqual(self.sat_send_called, 2)
+    self._event_sat_map.remove(sat, [ev_type])
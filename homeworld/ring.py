@@ -0,0 +1,213 @@
+import mmap
+import os
+import platform
+from struct import Struct
+import tempfile
+
+try:
+  from fcntl import flock, LOCK_EX, LOCK_UN
+except ImportError:
+  flock = None
+
+
+_position = Struct('<Q')
+_flag = Struct('<I')
+_length = Struct('<I')
+
+# x86 keeps stores in order with stores and loads with loads, which is all
+# the ring's positions need.  Elsewhere, ARM included, they need a fence.
+_ordered = platform.machine().lower() in ('x86_64', 'amd64', 'i386', 'i686',
+                                          'x86')
+
+
+class RingBuffer(object):
+  """
+  Single-producer, single-consumer ring of event frames in a shared file.
+
+  A same-host satellite writes length-prefixed frames into the ring and the
+  Core's GroundControl reads them, so events skip the socket entirely.  The
+  file starts with a header holding the write and read positions (total bytes
+  ever written and read) and a wakeup flag.  The consumer sets the flag when
+  it finds the ring empty; the producer clears it after its next write and
+  then rings the doorbell, an empty frame on the satellite's socket.  The
+  consumer also polls attached rings, which covers a doorbell lost to the
+  race between the two.
+
+  Frames too large for the ring go over the socket instead.  The header also
+  counts the frames the consumer has read from the socket, so the producer
+  can tell when it is safe to go back to the ring without its frames
+  overtaking those.
+
+  The file stays open for as long as the ring is, so a Core handing off to a
+  successor can pass it on by descriptor, as fd, after the file is unlinked.
+
+  Python has no memory fences, so on x86 the ring relies on the processor
+  keeping its stores, and its loads, in order: a frame is in place before
+  its write position is, and read before its read position is.  Other
+  processors, such as a Raspberry Pi's ARM cores, may reorder them, so there
+  each write() and read() holds an flock() on the file instead, and the
+  kernel orders memory around it.  That costs two system calls apiece.
+  """
+
+  header_size = 64
+  default_size = 1 << 20
+  prefix = 'homeworld-'
+  suffix = '.ring'
+  _write_at = 0
+  _read_at = 8
+  _wakeup_at = 16
+  _bypassed_at = 24
+
+  def __init__(self, path, fd=None):
+    self.path = path
+    if fd is None:
+      fd = os.open(path, os.O_RDWR)
+    try:
+      self._map = mmap.mmap(fd, 0)
+    except Exception:
+      os.close(fd)
+      raise
+    if len(self._map) <= self.header_size:
+      self._map.close()
+      os.close(fd)
+      raise ValueError('not a ring buffer: %s' % path)
+    self._fd = fd
+    self.capacity = len(self._map) - self.header_size
+    self._locked = not _ordered and flock is not None
+
+  @classmethod
+  def create(cls, size=default_size):
+    """
+    Create a ring in a new file, in shared memory if the platform has it.
+    """
+    shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    fd, path = tempfile.mkstemp(prefix=cls.prefix, suffix=cls.suffix,
+                                dir=shm_dir)
+    try:
+      os.ftruncate(fd, cls.header_size + size)
+    finally:
+      os.close(fd)
+    return cls(path)
+
+  def __len__(self):
+    return self._get(self._write_at) - self._get(self._read_at)
+
+  def write(self, frame):
+    """
+    Append a frame.  Returns False, writing nothing, if there is no room.
+    """
+    if self._locked:
+      flock(self._fd, LOCK_EX)
+    try:
+      write_pos = self._get(self._write_at)
+      if self.capacity - (write_pos - self._get(self._read_at)) < len(frame):
+        return False
+      self._copy_in(write_pos % self.capacity, frame)
+      # Publish the new write position only once the frame is in place.
+      _position.pack_into(self._map, self._write_at, write_pos + len(frame))
+      return True
+    finally:
+      if self._locked:
+        flock(self._fd, LOCK_UN)
+
+  def count_bypass(self):
+    """
+    Count a frame the consumer has read from the socket instead.
+    """
+    if self._locked:
+      flock(self._fd, LOCK_EX)
+    try:
+      _position.pack_into(self._map, self._bypassed_at,
+                          self._get(self._bypassed_at) + 1)
+    finally:
+      if self._locked:
+        flock(self._fd, LOCK_UN)
+
+  def bypassed(self):
+    """
+    Return how many frames the consumer has read from the socket.
+    """
+    if self._locked:
+      flock(self._fd, LOCK_EX)
+    try:
+      return self._get(self._bypassed_at)
+    finally:
+      if self._locked:
+        flock(self._fd, LOCK_UN)
+
+  def take_wakeup(self):
+    """
+    Return whether the consumer asked to be woken, clearing the request.
+    """
+    if not _flag.unpack_from(self._map, self._wakeup_at)[0]:
+      return False
+    _flag.pack_into(self._map, self._wakeup_at, 0)
+    return True
+
+  def read(self, max_frames=None):
+    """
+    Remove and return up to max_frames frame payloads.
+
+    If the ring is left empty, a wakeup is requested.  ValueError is raised
+    if the producer has left the ring inconsistent.
+    """
+    if self._locked:
+      flock(self._fd, LOCK_EX)
+    try:
+      return self._read(max_frames)
+    finally:
+      if self._locked:
+        flock(self._fd, LOCK_UN)
+
+  def _read(self, max_frames):
+    out = []
+    write_pos = self._get(self._write_at)
+    read_pos = self._get(self._read_at)
+    if write_pos - read_pos > self.capacity:
+      raise ValueError('corrupt ring buffer: %s' % self.path)
+    while read_pos < write_pos and (max_frames is None
+                                    or len(out) < max_frames):
+      offset = read_pos % self.capacity
+      frame_len = _length.unpack(self._copy_out(offset, 4))[0]
+      if read_pos + 4 + frame_len > write_pos:
+        raise ValueError('corrupt ring buffer: %s' % self.path)
+      out.append(self._copy_out((offset + 4) % self.capacity, frame_len))
+      read_pos += 4 + frame_len
+    _position.pack_into(self._map, self._read_at, read_pos)
+    if read_pos >= write_pos:
+      _flag.pack_into(self._map, self._wakeup_at, 1)
+    return out
+
+  def _get(self, at):
+    return _position.unpack_from(self._map, at)[0]
+
+  def _copy_in(self, offset, data):
+    start = self.header_size + offset
+    first = min(len(data), self.capacity - offset)
+    self._map[start:start + first] = data[:first]
+    if first < len(data):
+      rest = len(data) - first
+      self._map[self.header_size:self.header_size + rest] = data[first:]
+
+  def _copy_out(self, offset, size):
+    start = self.header_size + offset
+    first = min(size, self.capacity - offset)
+    data = self._map[start:start + first]
+    if first < size:
+      data += self._map[self.header_size:self.header_size + size - first]
+    return data
+
+  def fileno(self):
+    return self._fd
+
+  def close(self):
+    self._map.close()
+    if self._fd is not None:
+      os.close(self._fd)
+      self._fd = None
+
+  def unlink(self):
+    try:
+      os.unlink(self.path)
+    except OSError:
+      pass
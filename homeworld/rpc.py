@@ -0,0 +1,207 @@
+from itertools import count
+from threading import Event as _Signal, Lock
+from time import time
+
+from six import b
+
+from timerwheel import TimerWheel
+
+# Type of the reply the Core sends itself when a request has no recipient.
+undeliverable = b('undeliverable')
+
+
+class RequestTimeout(RuntimeError):
+  pass
+
+
+class UndeliverableError(RuntimeError):
+  pass
+
+
+class Reply(object):
+  """
+  The future reply to a request sent with Satellite.request().
+  """
+
+  def __init__(self, deadline=None):
+    self._deadline = deadline
+    self._signal = _Signal()
+    self._event = None
+    self._error = None
+    self._callbacks = []
+    self._lock = Lock()
+
+  def done(self):
+    return self._signal.is_set()
+
+  def result(self, timeout=None):
+    """
+    Wait for the reply event and return it.
+
+    Raises RequestTimeout if the request expired, or if no reply arrives
+    within timeout seconds, and UndeliverableError if the Core knows no
+    satellite by the request's recipient.
+    """
+    if self._deadline is not None:
+      remaining = max(0, self._deadline - time())
+      timeout = remaining if timeout is None else min(timeout, remaining)
+    if not self._signal.wait(timeout):
+      if self._deadline is not None and time() >= self._deadline:
+        raise RequestTimeout('request timed out')
+      raise RequestTimeout('no reply yet')
+    if self._error is not None:
+      raise self._error
+    return self._event
+
+  def add_done_callback(self, callback):
+    """
+    Call callback with this Reply once it is done, straight away if it is.
+    """
+    with self._lock:
+      if not self.done():
+        self._callbacks.append(callback)
+        return
+    callback(self)
+
+  def _finish(self, event=None, error=None):
+    with self._lock:
+      if self.done():
+        return False
+      self._event = event
+      self._error = error
+      self._signal.set()
+      callbacks, self._callbacks = self._callbacks, []
+    for callback in callbacks:
+      callback(self)
+    return True
+
+
+class Outstanding(object):
+  """
+  A satellite's requests waiting for replies, by correlation ID.
+
+  Expiry deadlines are kept in a TimerWheel, so any number of requests may
+  be outstanding and expire() only looks at those that are due.
+  """
+
+  def __init__(self, tick=0.1):
+    self._lock = Lock()
+    self._replies = dict()
+    self._expiry = TimerWheel(tick=tick)
+    self._expiry.expire()
+    self._ids = count()
+
+  def __len__(self):
+    return len(self._replies)
+
+  def add(self, timeout=None):
+    """
+    Return a new correlation ID and the Reply waiting on it.
+    """
+    reply = Reply(None if timeout is None else time() + timeout)
+    with self._lock:
+      correlation = b('%x' % next(self._ids))
+      self._replies[correlation] = reply
+      if timeout is not None:
+        self._expiry.schedule(correlation, timeout)
+    return correlation, reply
+
+  def cancel(self, correlation):
+    with self._lock:
+      self._replies.pop(correlation, None)
+      self._expiry.cancel(correlation)
+
+  def resolve(self, event):
+    """
+    Complete the request the reply event answers.
+
+    Returns False if no request is waiting for it.
+    """
+    with self._lock:
+      reply = self._replies.pop(event.correlation, None)
+      self._expiry.cancel(event.correlation)
+    if reply is None:
+      return False
+    if event.type == undeliverable:
+      reply._finish(error=UndeliverableError(
+        'no satellite is named %r' % (event.recipient,)))
+    else:
+      reply._finish(event)
+    return True
+
+  def expire(self, now=None):
+    with self._lock:
+      expired = [self._replies.pop(correlation)
+                 for correlation in self._expiry.expire(now)]
+    for reply in expired:
+      reply._finish(error=RequestTimeout('request timed out'))
+
+  def fail_all(self, error):
+    with self._lock:
+      replies = list(self._replies.values())
+      self._replies.clear()
+      self._expiry = TimerWheel(tick=self._expiry.tick)
+      self._expiry.expire()
+    for reply in replies:
+      reply._finish(error=error)
+
+
+class PendingRequests(object):
+  """
+  Requests the Core has forwarded and is waiting to route replies to.
+
+  Each request is forwarded under a token of the Core's own, so correlation
+  IDs only need to be unique per requesting satellite.  The reply, carrying
+  the token, is sent back to the requester under the original ID.  Only the
+  satellite the request went to may answer it: tokens are easy to guess, so
+  a reply from any other is dropped.  Requests not answered within timeout
+  seconds are forgotten; with timeout=None they never are.
+  """
+
+  def __init__(self, timeout=30.0):
+    self.timeout = timeout
+    self._lock = Lock()
+    # Map from token to (requester, correlation ID, responder).
+    self._pending = dict()
+    self._expiry = None
+    if timeout is not None:
+      self._expiry = TimerWheel(tick=timeout / 8.0)
+    self._tokens = count()
+    # Number of requests forgotten without a reply.
+    self.expired = 0
+
+  def __len__(self):
+    return len(self._pending)
+
+  def add(self, requester, correlation, responder, now=None):
+    now = time() if now is None else now
+    with self._lock:
+      self._expire(now)
+      token = b('%x' % next(self._tokens))
+      self._pending[token] = (requester, correlation, responder)
+      if self._expiry is not None:
+        self._expiry.schedule(token, self.timeout, now)
+    return token
+
+  def pop(self, token, responder):
+    """
+    Return the (requester, correlation ID) waiting on token, or None.
+
+    A responder other than the one the request went to gets None, and the
+    request stays pending.
+    """
+    with self._lock:
+      waiting = self._pending.get(token)
+      if waiting is None or waiting[2] is not responder:
+        return None
+      del self._pending[token]
+      if self._expiry is not None:
+        self._expiry.cancel(token)
+    return waiting[:2]
+
+  def _expire(self, now):
+    if self._expiry is None:
+      return
+    for token in self._expiry.expire(now):
+      del self._pending[token]
+      self.expired += 1
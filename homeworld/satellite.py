@@ -1,18 +1,20 @@
+from collections import deque
+from copy import copy
+from random import random, uniform
 from select import select
+import socket as _socket
 from socket import create_connection, gethostname, timeout, SHUT_RDWR
 import threading
-from time import sleep
+from time import sleep, time
 
 from six import b
 
-from core import default_core_port
 from events import Event
 from flag import Flag
 from lockeddata import LockedData
-from sockutils import long2bytes, bytes2long
-
-# Unit test modules
-import unittest as _ut
+from rpc import Outstanding
+from sockutils import default_core_port, long2bytes, bytes2long, \
+                      parse_address, recvall, tune_socket
 
 
 class NotConnectedError(RuntimeError):
@@ -23,6 +25,29 @@ class ConnectionError(RuntimeError):
   pass
 
 
+class BackpressureError(RuntimeError):
+  pass
+
+
+class Backoff(object):
+  """
+  Exponential backoff with full jitter between reconnect attempts.
+
+  The delay before attempt n (from 0) is drawn uniformly from
+  [0, min(maximum, initial * multiplier ** n)], so a swarm that lost the Core
+  at the same moment spreads its reconnects out instead of arriving at once.
+  """
+
+  def __init__(self, initial=0.1, maximum=30.0, multiplier=2.0):
+    self.initial = initial
+    self.maximum = maximum
+    self.multiplier = multiplier
+
+  def delay(self, attempt):
+    ceiling = self.initial * self.multiplier ** min(attempt, 64)
+    return uniform(0, min(self.maximum, ceiling))
+
+
 class _SatCallback(object):
   """
   Shared received-event callback object.
@@ -43,15 +68,29 @@ class _SatCallback(object):
 class _SatListener(threading.Thread):
   """
   Event-receiver thread.
+
+  When the connection drops, on_disconnect is called, if given.  It returns
+  a new socket to carry on listening on, or None to stop.  on_tick, if given,
+  is called on every pass with the time the last frame was received.  If it
+  returns True, the connection is treated as dropped.  Replies are passed to
+  on_reply, if given, instead of the callback.  Traced events are stamped on
+  receipt and passed to on_trace, if given, before anything else.
   """
 
-  def __init__(self, socket, callback, event_list, terminate_flag, timeout=0.5):
+  def __init__(self, socket, callback, event_list, terminate_flag, timeout=0.5,
+               on_disconnect=None, on_tick=None, on_reply=None,
+               on_trace=None):
     threading.Thread.__init__(self)
     self.__socket = socket
     self.__callback = callback
     self.__event_list = event_list
     self.__terminate_flag = terminate_flag
     self.__timeout = timeout
+    self.__on_disconnect = on_disconnect
+    self.__on_tick = on_tick
+    self.__on_reply = on_reply
+    self.__on_trace = on_trace
+    self.__last_received = time()
 
   def run(self):
     while not self.__terminate_flag:
@@ -61,23 +100,52 @@ class _SatListener(threading.Thread):
     rd_list = select([self.__socket], [], [], self.__timeout)[0]
     if len(rd_list):
       event = self.__get_event()
-      self.__process_event(event)
+      if event:
+        self.__process_event(event)
+    if self.__on_tick is not None and not self.__terminate_flag:
+      if self.__on_tick(self.__last_received):
+        # Nothing heard from the Core for too long.
+        self.__disconnected()
 
   def __get_event(self):
-    msg = self.__socket.recv(4)
-    if not len(msg):
-      # Message is zero-length, so the socket is closed.
-      self.__terminate_flag.set()
-      return
-    event_len = bytes2long(msg)
-    event_bytes = self.__socket.recv(event_len)
-    return Event().from_bytes(event_bytes)
+    try:
+      msg = recvall(self.__socket, 4)
+      if len(msg) == 4:
+        self.__last_received = time()
+        event_len = bytes2long(msg)
+        # An empty frame is a heartbeat from the Core.
+        if not event_len:
+          return None
+        event_bytes = recvall(self.__socket, event_len)
+        if len(event_bytes) == event_len:
+          return Event().from_bytes(event_bytes)
+    except (IOError, OSError):
+      pass
+    # Message is cut short, so the socket is closed.
+    self.__disconnected()
+
+  def __disconnected(self):
+    if self.__on_disconnect is not None and not self.__terminate_flag:
+      socket = self.__on_disconnect()
+      if socket is not None:
+        self.__socket = socket
+        self.__last_received = time()
+        return
+    self.__terminate_flag.set()
 
   def __process_event(self, event):
     """
     Passes a caught event to the callback function, if set.
     Otherwise appends event list stored in parent Satellite.
     """
+    if event.trace is not None:
+      event.stamp(Event.stage_client_receive)
+      if self.__on_trace is not None:
+        self.__on_trace(event)
+    if event.reply and self.__on_reply is not None:
+      # A reply to a request that has already expired is dropped.
+      self.__on_reply(event)
+      return
     if self.__callback.callback:
       callback = self.__callback.callback
       args = self.__callback.callback_args
@@ -91,27 +159,89 @@ class _SatListener(threading.Thread):
 class Satellite(object):
   """
   Basic satellite for communication with a Core.
+
+  Pass a Backoff as reconnect to reconnect automatically when the connection
+  to the Core drops.  The registered event types are then re-sent as a single
+  bulk registration.  While reconnecting, up to buffer_size sent events are
+  held and sent once the connection is back; beyond that, send_event raises
+  BackpressureError.  Without a buffer it raises NotConnectedError.
+
+  A satellite on the Core's host may connect over the Core's UNIX socket
+  instead of TCP, by launching with a unix:///path address.  With an
+  shm:///path address it also hands the Core a shared-memory ring of
+  ring_size bytes and writes its events there.  Events too large for the ring
+  still go over the socket, but they keep their place: such an event waits
+  for the Core to empty the ring, and the events after it follow it over the
+  socket until the Core has read it.
+
+  With heartbeat, the satellite sends a heartbeat event whenever it has sent
+  or received nothing for that many seconds, and the Core answers it.  If
+  nothing at all arrives from the Core for heartbeat_timeout seconds (three
+  heartbeats by default), the connection is taken to be dead and dropped,
+  and reconnected if reconnect is set.
+
+  With a name, other satellites may send requests to this one with
+  request(), addressed to that name, and it answers them with reply().
+
+  A trace_sample fraction of the events sent get a trace, which the Core and
+  the receiving satellites stamp at each stage; see Event.trace.  Traced
+  events received are passed to trace_hook, if given, on the listener
+  thread; see tracing.FileHook.
   """
 
-  def __init__(self, timeout=2):
+  def __init__(self, timeout=2, reconnect=None, buffer_size=0,
+               ring_size=None, ring_poll=0.0005, heartbeat=None,
+               heartbeat_timeout=None, name=None, trace_sample=0.0,
+               trace_hook=None):
     self.__timeout = timeout
     self.__connected = False
     self.__callback = _SatCallback()
     self.__terminate_flag = Flag()
     self.__events = LockedData([])
     self.__event_types = []
-
-  def launch(self, core_host=gethostname(), core_port=default_core_port):
+    self.__send_lock = threading.Lock()
+    self.__reconnect = reconnect
+    self.__reconnecting = False
+    self.__buffer = deque()
+    self.__buffer_size = buffer_size
+    self.__reconnects = 0
+    self.__ring = None
+    self.__ring_size = ring_size
+    self.__ring_poll = ring_poll
+    # Frames sent over the socket while the ring is attached.
+    self.__bypassed = 0
+    # Set by the listener as soon as it sees the connection drop, so a send
+    # waiting on a ring the Core no longer reads gives up.
+    self.__dropped = False
+    self.__heartbeat = heartbeat
+    if heartbeat_timeout is None and heartbeat is not None:
+      heartbeat_timeout = 3 * heartbeat
+    self.__heartbeat_timeout = heartbeat_timeout
+    self.__last_sent = 0
+    self.__last_ping = 0
+    self.__name = name
+    self.__outstanding = Outstanding()
+    self.__trace_sample = trace_sample
+    self.__trace_hook = trace_hook
+
+  def launch(self, core_host=gethostname(), core_port=default_core_port,
+             address=None):
     """
     Connect the the core.
+
+    address, if given, overrides core_host and core_port.  It is one of
+    tcp://host:port, unix:///path or shm:///path.
     """
-    core_addr = (core_host, core_port)
-    try:
-      self.__socket = create_connection(core_addr, self.__timeout)
-    except timeout:
-      raise ConnectionError('could not connect to Core')
+    if address is None:
+      self.__core_addr = ('tcp', (core_host, core_port))
+    else:
+      self.__core_addr = parse_address(address)
+    self.__dropped = False
+    self.__socket = self.__connect()
     self.__spawn_listener()
     self.__connected = True
+    if self.__name is not None:
+      self.send_event(self.__name_event())
 
   def terminate(self):
     """
@@ -123,9 +253,12 @@ class Satellite(object):
     self.__check_connection()
     self.__terminate_flag.set()
     self.__listener.join(0.75)
-    self.__socket.shutdown(SHUT_RDWR)
-    self.__socket.close()
+    _close(self.__socket)
+    self.__close_ring()
     self.__event_types = []
+    self.__buffer.clear()
+    self.__reconnecting = False
+    self.__outstanding.fail_all(NotConnectedError('satellite terminated'))
 
   def event_callback(self, callback, *args, **kwargs):
     """
@@ -136,12 +269,72 @@ class Satellite(object):
     """
     self.__callback(callback, *args, **kwargs)
 
-  def send_event(self, event):
+  def send_event(self, event, block=True, timeout=None):
+    """
+    Send an event to the Core.
+
+    When the Core is applying backpressure, the send waits until the Core
+    accepts the event.  With block=False, BackpressureError is raised instead
+    of waiting.  With a timeout, BackpressureError is raised if the Core does
+    not start accepting the event within that many seconds.  Once part of an
+    event has been sent, the rest is always sent.
+    """
     self.__check_connection()
-    event_bytes = event.to_bytes()
-    event_len = long2bytes(len(event_bytes))
-    self.__socket.send(event_len)
-    self.__socket.send(event_bytes)
+    trace = event.trace
+    if trace is None and self.__trace_sample \
+    and random() < self.__trace_sample:
+      trace = []
+    if trace is not None:
+      # Stamp a copy, so an event sent again is sampled afresh and does not
+      # pile up stamps.
+      event = copy(event)
+      event.trace = trace + [(Event.stage_send, time())]
+    frame = _frame(event)
+    wait = timeout if block else 0
+    with self.__send_lock:
+      if not self.__reconnecting:
+        try:
+          self.__write(frame, wait)
+          return
+        except (IOError, OSError):
+          # The listener will notice the dropped connection too.  Hold on to
+          # the event if it is going to reconnect.
+          if self.__reconnect is None:
+            raise
+          self.__reconnecting = True
+      self.__buffer_frame(frame)
+
+  def request(self, event, timeout=30.0):
+    """
+    Send a request to the satellite named by the event's recipient.
+
+    Returns a Reply, whose result() is the answering event.  If no answer
+    arrives within timeout seconds, the request expires with RequestTimeout.
+    With timeout=None it never expires, so result() waits for good if the
+    answer is lost, as it is once the Core forgets the request after its
+    request_timeout.  Any number of requests may be outstanding at once.
+    """
+    if event.recipient is None:
+      raise ValueError('a request needs a recipient')
+    correlation, reply = self.__outstanding.add(timeout)
+    trace = None if event.trace is None else list(event.trace)
+    request = Event(type=event.type, recipient=event.recipient,
+                    properties=event.properties, priority=event.priority,
+                    correlation=correlation, trace=trace)
+    try:
+      self.send_event(request)
+    except Exception:
+      self.__outstanding.cancel(correlation)
+      raise
+    return reply
+
+  def reply(self, request, event):
+    """
+    Send event to the satellite that sent request, as its answer.
+    """
+    self.send_event(Event(type=event.type, properties=event.properties,
+                          priority=event.priority,
+                          correlation=request.correlation, reply=True))
 
   def register(self, event_type):
     event = Event(type=b('register'), properties={b('type'): b(event_type)})
@@ -161,6 +354,10 @@ class Satellite(object):
         retevents.append(self.__events.data.pop())
     return retevents
 
+  @property
+  def name(self):
+    return self.__name
+
   @property
   def connected(self):
     return self.__connected
@@ -169,19 +366,254 @@ class Satellite(object):
   def event_types(self):
     return [x for x in self.__event_types]
 
+  @property
+  def reconnecting(self):
+    return self.__reconnecting
+
+  @property
+  def reconnects(self):
+    """
+    Number of times the satellite has reconnected to the Core.
+    """
+    return self.__reconnects
+
+  def __connect(self):
+    scheme, location = self.__core_addr
+    try:
+      if scheme == 'tcp':
+        socket = create_connection(location, self.__timeout)
+      else:
+        socket = _socket.socket(_socket.AF_UNIX)
+        socket.settimeout(self.__timeout)
+        try:
+          socket.connect(location)
+        except Exception:
+          socket.close()
+          raise
+    except timeout:
+      raise ConnectionError('could not connect to Core')
+    tune_socket(socket)
+    if scheme == 'shm':
+      try:
+        self.__attach_ring(socket)
+      except Exception:
+        _close(socket)
+        raise
+    return socket
+
+  def __attach_ring(self, socket):
+    # A fresh ring for every connection: whatever the old Core left unread
+    # in the last one is lost, as it would be in a socket's buffers.
+    from ring import RingBuffer
+    self.__close_ring()
+    if self.__ring_size is None:
+      ring = RingBuffer.create()
+    else:
+      ring = RingBuffer.create(self.__ring_size)
+    event = Event(type=b('attach-ring'), properties={b('path'): b(ring.path)})
+    try:
+      socket.sendall(_frame(event))
+    except Exception:
+      ring.unlink()
+      ring.close()
+      raise
+    self.__ring = ring
+    self.__bypassed = 0
+
+  def __close_ring(self):
+    if self.__ring is not None:
+      # The Core unlinks the file once it has it mapped, unless it never got
+      # that far.
+      self.__ring.unlink()
+      self.__ring.close()
+      self.__ring = None
+
+  def __write(self, frame, wait=None):
+    self.__last_sent = time()
+    if self.__ring is None:
+      self.__send_frame(frame, wait)
+      return
+    deadline = None if wait is None else time() + wait
+    if len(frame) > self.__ring.capacity \
+    or self.__ring.bypassed() < self.__bypassed:
+      self.__bypass_ring(frame, deadline)
+      return
+    while not self.__ring.write(frame):
+      self.__wait_for_ring(deadline)
+    # Ring the doorbell if the Core has gone to sleep on an empty ring.
+    if self.__ring.take_wakeup():
+      self.__send_frame(long2bytes(0))
+
+  def __bypass_ring(self, frame, deadline):
+    # Send a frame over the socket without letting it overtake the ring, or
+    # be overtaken by it: the ring must be empty before the first such frame,
+    # and stays unused until the Core has read the last.
+    if self.__ring.bypassed() == self.__bypassed:
+      while len(self.__ring):
+        self.__wait_for_ring(deadline)
+    wait = None if deadline is None else max(0, deadline - time())
+    self.__send_frame(frame, wait)
+    self.__bypassed += 1
+
+  def __wait_for_ring(self, deadline):
+    if self.__dropped or self.__terminate_flag:
+      raise IOError('lost connection to Core')
+    if deadline is not None and time() >= deadline:
+      raise BackpressureError('Core is not accepting events')
+    sleep(self.__ring_poll)
+
+  def __buffer_frame(self, frame):
+    if len(self.__buffer) >= self.__buffer_size:
+      if self.__buffer_size:
+        raise BackpressureError('reconnect buffer is full')
+      raise NotConnectedError('reconnecting to Core')
+    self.__buffer.append(frame)
+
+  def __on_disconnect(self):
+    """
+    Reconnect to the Core, backing off between attempts.
+
+    Runs on the listener thread.  Returns the new socket, or None if the
+    satellite is terminated first.
+    """
+    self.__dropped = True
+    # Closing the socket fails any send stuck on a dead connection.
+    _close(self.__socket)
+    if self.__reconnect is None:
+      return None
+    with self.__send_lock:
+      self.__reconnecting = True
+    attempt = 0
+    while not self.__terminate_flag:
+      # Sleep in short steps so terminate() isn't held up.
+      wake_at = time() + self.__reconnect.delay(attempt)
+      while not self.__terminate_flag and time() < wake_at:
+        sleep(min(0.1, max(0, wake_at - time())))
+      if self.__terminate_flag:
+        break
+      attempt += 1
+      try:
+        socket = self.__connect()
+      except (ConnectionError, IOError, OSError):
+        continue
+      with self.__send_lock:
+        self.__socket = socket
+        self.__dropped = False
+        try:
+          self.__replay()
+        except (IOError, OSError):
+          self.__dropped = True
+          _close(socket)
+          continue
+        self.__reconnecting = False
+        self.__reconnects += 1
+      return socket
+    return None
+
+  def __replay(self):
+    # Re-register the name and every event type in one message, then send the
+    # events held while disconnected.
+    if self.__name is not None:
+      self.__write(_frame(self.__name_event()))
+    if len(self.__event_types):
+      types = b('\0').join(b(event_type) for event_type in self.__event_types)
+      event = Event(type=b('register'), properties={b('types'): types})
+      self.__write(_frame(event))
+    while len(self.__buffer):
+      self.__write(self.__buffer[0])
+      self.__buffer.popleft()
+
+  def __name_event(self):
+    return Event(type=b('register'), properties={b('name'): b(self.__name)})
+
+  def __send_frame(self, frame, wait=None):
+    view = memoryview(frame)
+    while len(view):
+      # Only the wait for the first bytes may time out, or the Core would be
+      # left with a partial event.
+      writable = select([], [self.__socket], [], wait)[1]
+      if not len(writable):
+        if len(view) == len(frame):
+          raise BackpressureError('Core is not accepting events')
+        continue
+      try:
+        sent = self.__socket.send(view)
+      except timeout:
+        continue
+      view = view[sent:]
+      wait = None
+
+  def __on_tick(self, last_received):
+    """
+    Expire outstanding requests, send a heartbeat if the connection has been
+    idle, and return whether the Core has been silent for too long.
+
+    Runs on the listener thread.
+    """
+    now = time()
+    if len(self.__outstanding):
+      self.__outstanding.expire(now)
+    if self.__heartbeat_timeout is not None \
+    and now - last_received > self.__heartbeat_timeout:
+      return True
+    if self.__heartbeat is not None \
+    and now - self.__last_ping >= self.__heartbeat \
+    and (now - last_received >= self.__heartbeat
+         or now - self.__last_sent >= self.__heartbeat):
+      self.__last_ping = now
+      self.__send_heartbeat()
+    return False
+
+  def __send_heartbeat(self):
+    # Never wait on a send in progress: if the Core is gone, the listener
+    # must stay free to notice.
+    if not self.__send_lock.acquire(False):
+      return
+    try:
+      if not self.__reconnecting:
+        self.__write(_frame(Event(type=b('heartbeat'))), 0)
+    except (BackpressureError, IOError, OSError):
+      pass
+    finally:
+      self.__send_lock.release()
+
   def __check_connection(self):
     if not self.__connected:
       raise NotConnectedError('not connected to Core')
 
   def __spawn_listener(self):
     self.__terminate_flag.unset()
+    timeout = 0.5
+    if self.__heartbeat_timeout is not None:
+      # Check often enough to keep to the heartbeat.
+      timeout = min(timeout,
+                    (self.__heartbeat or self.__heartbeat_timeout) / 4.0)
     self.__listener = _SatListener(socket=self.__socket,
                                   event_list=self.__events,
                                   callback=self.__callback,
-                                  terminate_flag=self.__terminate_flag)
+                                  terminate_flag=self.__terminate_flag,
+                                  timeout=timeout,
+                                  on_disconnect=self.__on_disconnect,
+                                  on_tick=self.__on_tick,
+                                  on_reply=self.__outstanding.resolve,
+                                  on_trace=self.__trace_hook)
     self.__listener.start()
 
   def __terminate_listener(self):
     self.__terminate_flag.set()
     self.__listener.join(timeout=1)
     return not self.__listener.is_alive()
+
+
+def _frame(event):
+  event_bytes = event.to_bytes()
+  return long2bytes(len(event_bytes)) + event_bytes
+
+
+def _close(socket):
+  # The Core may already have hung up.
+  try:
+    socket.shutdown(SHUT_RDWR)
+  except (IOError, OSError):
+    pass
+  socket.close()
@@ -1,5 +1,13 @@
+import socket
+from struct import Struct
+
 from six import int2byte, iterbytes
 
+default_core_port = 51100
+
+# struct ucred, as read with SO_PEERCRED: pid, uid and gid.
+_peercred = Struct('=iII')
+
 def long2bytes(mylong):
   out = int2byte(mylong % 256)
   for i in range(3):
@@ -19,3 +27,121 @@ def iterbytes2long(it):
 
 def bytes2long(mybytes):
   return iterbytes2long(iterbytes(mybytes))
+
+def recvall(sock, size):
+  # Receive exactly size bytes from the socket.  Fewer bytes are returned only
+  # if the peer closed the connection part way through.
+  data = sock.recv(size)
+  if len(data) == size or not len(data):
+    return data
+  chunks = [data]
+  remaining = size - len(data)
+  while remaining:
+    chunk = sock.recv(remaining)
+    if not len(chunk):
+      break
+    chunks.append(chunk)
+    remaining -= len(chunk)
+  return b''.join(chunks)
+
+
+def tune_socket(sock, nodelay=True, keepalive=True, sndbuf=None, rcvbuf=None,
+                keepidle=None, keepintvl=None, keepcnt=None):
+  # Apply latency and liveness options to a connected socket.  Options the
+  # platform or socket family doesn't support are skipped.
+  options = [(socket.IPPROTO_TCP, 'TCP_NODELAY', int(nodelay)),
+             (socket.SOL_SOCKET, 'SO_KEEPALIVE', int(keepalive)),
+             (socket.SOL_SOCKET, 'SO_SNDBUF', sndbuf),
+             (socket.SOL_SOCKET, 'SO_RCVBUF', rcvbuf),
+             (socket.IPPROTO_TCP, 'TCP_KEEPIDLE', keepidle),
+             (socket.IPPROTO_TCP, 'TCP_KEEPINTVL', keepintvl),
+             (socket.IPPROTO_TCP, 'TCP_KEEPCNT', keepcnt)]
+  local = getattr(socket, 'AF_UNIX', None) is not None \
+          and getattr(sock, 'family', None) == socket.AF_UNIX
+  for level, name, value in options:
+    if value is None or not hasattr(socket, name):
+      continue
+    if local and level == socket.IPPROTO_TCP:
+      continue
+    try:
+      sock.setsockopt(level, getattr(socket, name), value)
+    except (IOError, OSError):
+      pass
+
+
+def set_send_timeout(sock, timeout):
+  # A satellite socket blocks on writes, for at most timeout seconds if one
+  # is given.  Frames to it must be written with sendall(): in timeout mode,
+  # send() may write only part of one.  A sendall() that times out raises
+  # socket.timeout, with part of the frame written, so the satellite must
+  # then be dropped.
+  if timeout is None:
+    sock.setblocking(True)
+  else:
+    sock.settimeout(timeout)
+
+
+def peer_uid(sock):
+  # The user id of the process at the other end of a UNIX socket, or None if
+  # the platform cannot tell.
+  if not hasattr(socket, 'SO_PEERCRED'):
+    return None
+  try:
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            _peercred.size)
+  except (IOError, OSError):
+    return None
+  return _peercred.unpack(creds)[1]
+
+
+def parse_address(address):
+  # Split a Core address into its scheme and location.  tcp://host:port gives
+  # ('tcp', (host, port)); unix:///path and shm:///path give the path of the
+  # Core's UNIX socket.
+  scheme, sep, location = address.partition('://')
+  if not sep:
+    raise ValueError('not a Core address: %r' % (address,))
+  if scheme == 'tcp':
+    host, sep, port = location.rpartition(':')
+    if not sep or not port.isdigit():
+      raise ValueError('no port in Core address: %r' % (address,))
+    return scheme, (host, int(port))
+  if scheme in ('unix', 'shm'):
+    if not location:
+      raise ValueError('no path in Core address: %r' % (address,))
+    return scheme, location
+  raise ValueError('unknown Core address scheme: %r' % (scheme,))
+
+
+class Wakeup(object):
+  """
+  Breaks a thread out of select() from another thread.
+
+  Pass the Wakeup itself in the select read list; it is readable once rung.
+  """
+
+  def __init__(self):
+    self._rd, self._wr = socket.socketpair()
+    self._rd.setblocking(False)
+    self._wr.setblocking(False)
+
+  def fileno(self):
+    return self._rd.fileno()
+
+  def ring(self):
+    try:
+      self._wr.send(b'\0')
+    except (IOError, OSError):
+      # The buffer is full, so it has already been rung.
+      pass
+
+  def clear(self):
+    try:
+      while len(self._rd.recv(4096)):
+        pass
+    except (IOError, OSError):
+      pass
+
+  def close(self):
+    self._rd.close()
+    self._wr.close()
@@ -1,58 +1,102 @@
+from errno import EAGAIN, ECONNABORTED, EWOULDBLOCK
+import logging
 from select import select
 from threading import Thread
+from time import time
 
-# Unit test modules
-import unittest as _ut
-from lockeddata import LockedData as _LD
-from flag import Flag as _Flag
+from sockutils import set_send_timeout, tune_socket
+
+log = logging.getLogger(__name__)
+
+# Errors from accept() that only mean there is nothing left to accept.
+_drained = (EAGAIN, ECONNABORTED, EWOULDBLOCK)
 
 
 class Spaceport(Thread):
   """
   Establishes new connections on the Core's public socket
+
+  The public socket must be non-blocking.  Each wakeup accepts every pending
+  connection, up to max_accepts, so a reconnect storm is not left waiting in
+  the listen backlog.  Accepted sockets are tuned with sock_opts (keyword
+  arguments to sockutils.tune_socket) and passed to on_accept, if given, once
+  they are in sat_map.  wakeup, if given, is then rung so GroundControl starts
+  listening to them straight away.  With send_timeout,
+  a write to a satellite fails if it is not done within that many seconds,
+  rather than blocking for good; see sockutils.set_send_timeout.  Ringing
+  interrupt, a Wakeup, breaks the wait for connections so a shutdown is seen
+  straight away.
+
+  Any other error from accept(), such as running out of descriptors, is
+  logged, and the Spaceport stops accepting for a while, backing off up to
+  timeout seconds while the error persists.  The connection stays in the
+  listen backlog meanwhile, so it would otherwise wake the Spaceport again
+  straight away.
   """
-  def __init__(self, socket, sat_map, shutdown_flag, timeout=0.5):
+  def __init__(self, socket, sat_map, shutdown_flag, timeout=0.5,
+               wakeup=None, max_accepts=1024, sock_opts=None,
+               send_timeout=None, interrupt=None, on_accept=None):
     # Always call the parent Thread object's init function first.
     Thread.__init__(self)
     self._sock = socket
     self._sat_map = sat_map
     self._shutdown_flag = shutdown_flag
     self._timeout = timeout
+    self._wakeup = wakeup
+    self._max_accepts = max_accepts
+    self._sock_opts = sock_opts or {}
+    self._send_timeout = send_timeout
+    self._interrupt = interrupt
+    self._on_accept = on_accept
+    self._backoff = 0
+    self._resume_at = 0
 
   def run(self):
     while not self._shutdown_flag:
       self._run_loop()
 
   def _run_loop(self):
-    rd_list = select([self._sock],[],[], self._timeout)[0]
+    rd_list = []
+    timeout = self._timeout
+    wait = self._resume_at - time()
+    if wait > 0:
+      timeout = min(timeout, wait)
+    else:
+      rd_list.append(self._sock)
+    if self._interrupt is not None:
+      # Rung only to stop the Spaceport, so it is never cleared.
+      rd_list.append(self._interrupt)
+    rd_list = select(rd_list,[],[], timeout)[0]
     if self._sock in rd_list:
-      self._accept_new_connection()
+      self._accept_new_connections()
 
-  def _accept_new_connection(self):
-    # Accept new connections on the socket.
-    (sat_sock, sat_addr) = self._sock.accept()
+  def _accept_new_connections(self):
+    # Accept pending connections on the socket until there are none left.
+    accepted = {}
+    for i in range(self._max_accepts):
+      try:
+        (sat_sock, sat_addr) = self._sock.accept()
+      except (IOError, OSError) as e:
+        if e.errno not in _drained:
+          self._back_off(e)
+        # Anything left is picked up on the next wakeup.
+        break
+      self._backoff = 0
+      set_send_timeout(sat_sock, self._send_timeout)
+      tune_socket(sat_sock, **self._sock_opts)
+      accepted[sat_sock] = sat_addr
+    if not len(accepted):
+      return
     # Save connections to the satellite map.
     with self._sat_map.lock:
-      self._sat_map.data[sat_sock] = sat_addr
-
-
-class _SpaceportTestCase(_ut.TestCase):
-
-  def setUp(self):
-    global select
-    class DummySocket(object):
-      def accept(self):
-        return (1, 1)
-    self.sock = DummySocket()
-    def select(rd_list, wr_list, ex_list, timeout=None):
-      return [self.sock], [], []
-    self.sat_map = _LD(dict())
-    self.flag = _Flag()
-    self.spaceport = Spaceport(self.sock, self.sat_map, self.flag)
-
-  def test_run_loop(self):
-    self.assertEqual(len(self.sat_map.data), 0)
-    self.spaceport._run_loop()
-    self.assertEqual(len(self.sat_map.data), 1)
-    self.assertTrue(1 in self.sat_map.data)
-    self.assertEqual(self.sat_map.data[1], 1)
+      self._sat_map.data.update(accepted)
+    if self._on_accept is not None:
+      self._on_accept(list(accepted))
+    if self._wakeup is not None:
+      self._wakeup.ring()
+
+  def _back_off(self, error):
+    self._backoff = min(max(2 * self._backoff, 0.01), self._timeout)
+    self._resume_at = time() + self._backoff
+    log.warning('cannot accept connections, retrying in %.2fs: %s',
+                self._backoff, error)
@@ -0,0 +1,100 @@
+from threading import Lock
+
+from six import b
+
+from lockeddata import LockedData
+
+
+class Subscriptions(LockedData):
+  """
+  The event types and names each satellite is registered under.
+
+  Like the LockedData it extends, data maps each event type to the list of
+  satellites registered for it, starting with b'all' for the satellites that
+  get every event.  The lists are replaced rather than changed in place, so a
+  relay may route over a list it read without holding the lock.
+
+  Satellites may also register names, which requests are addressed to.
+
+  A reverse index from each satellite to its types and names lets
+  remove_sat() drop all of a satellite's registrations in one step, without
+  looking at any other type.
+  """
+
+  def __init__(self):
+    LockedData.__init__(self, {b('all'): []}, Lock())
+    # Map from satellite to the set of types it is registered for.
+    self._types = dict()
+    # Map from name to satellite, and from satellite to its names.
+    self._sats_by_name = dict()
+    self._names = dict()
+
+  def add(self, sat, ev_types):
+    with self.lock:
+      types = self._types.setdefault(sat, set())
+      for ev_type in ev_types:
+        if ev_type in types:
+          continue
+        types.add(ev_type)
+        self.data[ev_type] = self.data.get(ev_type, []) + [sat]
+
+  def remove(self, sat, ev_types):
+    with self.lock:
+      types = self._types.get(sat)
+      if not types:
+        return
+      for ev_type in ev_types:
+        if ev_type in types:
+          types.discard(ev_type)
+          self._drop(sat, ev_type)
+      if not types:
+        del self._types[sat]
+
+  def add_name(self, sat, name):
+    """
+    Address requests for name to the satellite, instead of any other.
+    """
+    with self.lock:
+      previous = self._sats_by_name.get(name)
+      if previous is not None and previous is not sat:
+        self._names[previous].discard(name)
+      self._sats_by_name[name] = sat
+      self._names.setdefault(sat, set()).add(name)
+
+  def remove_name(self, sat, name):
+    with self.lock:
+      if self._sats_by_name.get(name) is sat:
+        del self._sats_by_name[name]
+        self._names[sat].discard(name)
+
+  def lookup(self, name):
+    """
+    Return the satellite registered under name, or None.
+    """
+    return self._sats_by_name.get(name)
+
+  def remove_sat(self, sat):
+    """
+    Remove every registration of the satellite.
+    """
+    with self.lock:
+      for ev_type in self._types.pop(sat, ()):
+        self._drop(sat, ev_type)
+      for name in self._names.pop(sat, ()):
+        del self._sats_by_name[name]
+
+  def types_of(self, sat):
+    with self.lock:
+      return set(self._types.get(sat, ()))
+
+  def names_of(self, sat):
+    with self.lock:
+      return set(self._names.get(sat, ()))
+
+  def _drop(self, sat, ev_type):
+    sats = [x for x in self.data[ev_type] if x is not sat]
+    # Keep b'all' even when it empties.
+    if len(sats) or ev_type == b('all'):
+      self.data[ev_type] = sats
+    else:
+      del self.data[ev_type]
@@ -0,0 +1,36 @@
+import unittest
+
+from bench import BenchConfig, _slowest_imports, _subscriber_types, \
+                  compare_results, percentile
+
+
+class BenchTestCase(unittest.TestCase):
+
+  def test_percentile(self):
+    values = list(range(1, 101))
+    self.assertEqual(percentile(values, 50), 50)
+    self.assertEqual(percentile(values, 99), 99)
+    self.assertEqual(percentile(values, 100), 100)
+    self.assertEqual(percentile([], 50), None)
+
+  def test_subscriber_types(self):
+    config = BenchConfig(types=3, fanout=2)
+    self.assertEqual(_subscriber_types(2, config), ['bench-2', 'bench-0'])
+
+  def test_compare(self):
+    base = {'results': {'latency_ms': {'p99': 10.0},
+                        'delivery_throughput_eps': 1000.0}}
+    curr = {'results': {'latency_ms': {'p99': 12.0},
+                        'delivery_throughput_eps': 950.0}}
+    rows = dict((row[0], row) for row in compare_results(base, curr, 10.0))
+    self.assertTrue(rows['latency_ms.p99'][-1])
+    self.assertFalse(rows['delivery_throughput_eps'][-1])
+
+  def test_slowest_imports(self):
+    importtime = '\n'.join([
+      'import time: self [us] | cumulative | imported package',
+      'import time:       200 |        200 |   six',
+      'import time:       100 |       1500 | events',
+      'import time:        50 |         50 | sockutils'])
+    self.assertEqual(_slowest_imports(importtime, 2),
+                     [('events', 1.5), ('six', 0.2)])
@@ -0,0 +1,109 @@
+import unittest
+
+import core
+from core import Core, InvalidCoreState
+
+
+class CoreTestCase(unittest.TestCase):
+  def setUp(self):
+    self.sock_shutdown_count = 0
+    class DummySocket(object):
+      def __init__(self, *args, **kwargs):
+        pass
+      def bind(self, *args, **kwargs):
+        pass
+      def listen(self, *args, **kwargs):
+        pass
+      def setsockopt(self, *args, **kwargs):
+        pass
+      def setblocking(self, *args, **kwargs):
+        pass
+      def shutdown(sock_self, *args, **kwargs):
+        self.sock_shutdown_count += 1
+      def close(self, *args, **kwargs):
+        pass
+    class DummyThread(object):
+      rings = {}
+      def __init__(self, *args, **kwargs):
+        pass
+      def start(self, *args, **kwargs):
+        pass
+      def join(self, *args, **kwargs):
+        pass
+      def is_alive(self, *args, **kwargs):
+        return False
+      def joined(self, sats):
+        pass
+    # Swap the dummies in for the names the core module imported.
+    for name, value in (('socket', DummySocket), ('Spaceport', DummyThread),
+                        ('GroundControl', DummyThread),
+                        ('Relay', DummyThread)):
+      self.addCleanup(setattr, core, name, getattr(core, name))
+      setattr(core, name, value)
+
+  def test_core_restart(self):
+    core = Core()
+    core.start()
+    core.shutdown()
+    self.assertEqual(self.sock_shutdown_count, 1)
+    core.start()
+
+  def test_bad_restart(self):
+    core = Core()
+    core.start()
+    with self.assertRaises(InvalidCoreState):
+      core.start()
+
+  def _stick_relay(self, core, joins_until_exit, on_join=None):
+    # Make the first relay outlast the shutdown flag for a few joins.
+    relay = core._relays[0]
+    joins = []
+    def join(timeout=None):
+      joins.append(timeout)
+      if on_join is not None:
+        on_join()
+    relay.join = join
+    relay.is_alive = lambda: len(joins) < joins_until_exit
+    return relay
+
+  def test_hand_off_waits_for_stuck_threads(self):
+    class DummyConn(object):
+      closed = False
+      def close(conn_self):
+        conn_self.closed = True
+    core = Core()
+    core.start()
+    relay = self._stick_relay(core, 4)
+    conn = DummyConn()
+    self.assertFalse(core._hand_off(conn))
+    self.assertTrue(conn.closed)
+    # Fresh threads, only once the stuck one has gone.
+    self.assertFalse(relay.is_alive())
+    self.assertFalse(relay in core._relays)
+    self.assertFalse(core._shutdown_flag)
+
+  def test_hand_off_gives_up_on_shutdown(self):
+    class DummyConn(object):
+      def close(conn_self):
+        pass
+    core = Core()
+    core.start()
+    def shut_down():
+      core._stopping = True
+    relay = self._stick_relay(core, 100, shut_down)
+    self.assertFalse(core._hand_off(DummyConn()))
+    self.assertTrue(relay in core._relays)
+    self.assertTrue(core._shutdown_flag)
+
+  def test_hand_off_survives_errors(self):
+    core = Core()
+    core.start()
+    relays = core._relays
+    def handoff_state(rings):
+      raise TypeError('not JSON serializable')
+    core._handoff_state = handoff_state
+    with self.assertLogs('core', 'ERROR'):
+      self.assertFalse(core._hand_off(None))
+    # Fresh threads carry on routing.
+    self.assertFalse(core._shutdown_flag)
+    self.assertFalse(core._relays is relays)
@@ -0,0 +1,141 @@
+import unittest
+
+from six import b
+
+from events import Event, ReceivedEvent
+from eventqueue import EventQueue, QueuePolicyError
+
+
+class EventQueueTestCase(unittest.TestCase):
+
+  def _events(self, source, count, priority=None):
+    return [ReceivedEvent(Event(type=b('test'), priority=priority,
+                            properties={b('n'): b(str(i))}), source)
+            for i in range(count)]
+
+  def test_unbounded(self):
+    queue = EventQueue()
+    self.assertEqual(queue.put(self._events('a', 5)), 5)
+    self.assertEqual(len(queue), 5)
+    self.assertFalse(queue.full())
+    self.assertEqual(queue.throttled(), set())
+
+  def test_take_fifo(self):
+    queue = EventQueue()
+    events = self._events('a', 3)
+    queue.put(events)
+    self.assertEqual(queue.take(2), events[:2])
+    self.assertEqual(queue.take(), events[2:])
+    self.assertEqual(queue.take(), [])
+    self.assertEqual(len(queue), 0)
+
+  def test_reject(self):
+    queue = EventQueue(maxlen=2, policy=EventQueue.reject)
+    events = self._events('a', 3)
+    self.assertEqual(queue.put(events), 2)
+    self.assertEqual(queue.rejected, 1)
+    self.assertEqual(queue.take(), events[:2])
+
+  def test_drop_oldest(self):
+    queue = EventQueue(maxlen=2, policy=EventQueue.drop_oldest)
+    events = self._events('a', 3)
+    self.assertEqual(queue.put(events), 3)
+    self.assertEqual(queue.dropped, 1)
+    self.assertEqual(queue.take(), events[1:])
+
+  def test_drop_oldest_keeps_higher_class(self):
+    queue = EventQueue(maxlen=2, policy=EventQueue.drop_oldest)
+    high = self._events('a', 2, Event.high_priority)
+    queue.put(high)
+    low = self._events('b', 1, Event.low_priority)
+    self.assertEqual(queue.put(low), 0)
+    self.assertEqual(queue.dropped, 1)
+    self.assertEqual(queue.take(), high)
+
+  def test_zero_maxlen(self):
+    for policy in (EventQueue.drop_oldest, EventQueue.reject):
+      queue = EventQueue(maxlen=0, policy=policy)
+      self.assertEqual(queue.put(self._events('a', 2)), 0)
+      self.assertEqual(len(queue), 0)
+      self.assertEqual(queue.dropped + queue.rejected, 2)
+
+  def test_block_throttles_busiest(self):
+    queue = EventQueue(maxlen=4, policy=EventQueue.block)
+    queue.put(self._events('busy', 3) + self._events('quiet', 1))
+    self.assertTrue(queue.full())
+    self.assertEqual(queue.throttled(), set(['busy']))
+    queue.take(1)
+    self.assertEqual(queue.throttled(), set())
+
+  def test_bad_policy(self):
+    with self.assertRaises(QueuePolicyError):
+      EventQueue(policy='bogus')
+
+  def test_priority_first(self):
+    queue = EventQueue()
+    low = self._events('a', 2, Event.low_priority)
+    high = self._events('a', 1, Event.high_priority)
+    queue.put(low + high)
+    self.assertEqual(queue.top_lane(), Event.high_priority)
+    self.assertEqual(queue.take(), high + low)
+
+  def test_take_above(self):
+    queue = EventQueue()
+    low = self._events('a', 1, Event.low_priority)
+    high = self._events('a', 1, Event.high_priority)
+    queue.put(low + high)
+    self.assertEqual(queue.take(above=Event.normal_priority), high)
+    self.assertEqual(queue.take(above=Event.normal_priority), [])
+
+  def test_starvation(self):
+    queue = EventQueue(starvation_limit=2)
+    low = self._events('a', 1, Event.low_priority)
+    high = self._events('a', 4, Event.high_priority)
+    queue.put(low + high)
+    self.assertEqual(queue.take(), high[:2] + low + high[2:])
+
+  def test_reject_admits_higher_class(self):
+    queue = EventQueue(maxlen=1, policy=EventQueue.reject)
+    low = self._events('a', 1, Event.low_priority)
+    high = self._events('a', 1, Event.high_priority)
+    queue.put(low + high)
+    self.assertEqual(queue.dropped, 1)
+    self.assertEqual(queue.take(), high)
+
+  def test_heartbeats_exempt(self):
+    for policy in EventQueue.policies:
+      queue = EventQueue(maxlen=2, policy=policy)
+      queue.put(self._events('a', 2, Event.high_priority))
+      heartbeat = ReceivedEvent(Event(type=b('heartbeat')), 'b')
+      self.assertEqual(queue.put([heartbeat]), 1)
+      self.assertEqual(queue.dropped + queue.rejected, 0)
+      self.assertEqual(queue.heartbeats, 1)
+      # Still full for anything else, and the heartbeat is answered first.
+      self.assertTrue(queue.full())
+      self.assertEqual(queue.take(1), [heartbeat])
+      self.assertEqual(len(queue), 2)
+
+  def test_conflate(self):
+    queue = EventQueue(conflate={b('test'): b('n')})
+    first = self._events('a', 2)
+    newer = self._events('b', 1)
+    queue.put(first + newer)
+    self.assertEqual(len(queue), 2)
+    self.assertEqual(queue.conflated, 1)
+    self.assertEqual(queue._pending, {'a': 1, 'b': 1})
+    taken = queue.take()
+    self.assertEqual(taken[0].event, newer[0].event)
+    self.assertEqual(taken[0].source, 'b')
+    self.assertEqual(taken[1], first[1])
+    # Once taken, the key no longer conflates.
+    queue.put(self._events('a', 1))
+    self.assertEqual(len(queue), 1)
+
+  def test_record_wait(self):
+    queue = EventQueue()
+    events = self._events('a', 1, Event.high_priority)
+    queue.put(events)
+    queue.record_wait(events[0], now=events[0].enqueued_at + 0.5)
+    stats = queue.lane_stats[Event.high_priority].to_dict()
+    self.assertEqual(stats['count'], 1)
+    self.assertAlmostEqual(stats['max_wait_ms'], 500.0)
@@ -0,0 +1,22 @@
+import unittest
+
+from flag import Flag
+
+
+class FlagTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.flag = Flag()
+
+  def test_default(self):
+    self.assertFalse(self.flag)
+
+  def test_set(self):
+    self.flag.set()
+    self.assertTrue(self.flag)
+
+  def test_unset(self):
+    self.flag.set()
+    self.assertTrue(self.flag)
+    self.flag.unset()
+    self.assertFalse(self.flag)
@@ -0,0 +1,221 @@
+import os
+import socket
+import struct
+from threading import Condition
+import time
+import unittest
+
+from six import b
+
+from events import Event, ReceivedEvent
+from eventqueue import EventQueue
+from flag import Flag
+import groundcontrol
+from groundcontrol import GroundControl
+from lockeddata import LockedData
+from ring import RingBuffer
+from sockutils import long2bytes
+from subscriptions import Subscriptions
+
+
+class GroundControlTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.ev = Event(type=b('test'))
+    self.recv_call_count = 0
+    self.peer_uid = os.getuid()
+    class DummySat(object):
+      def getsockopt(sat_self, level, name, size):
+        return struct.pack('=iII', os.getpid(), self.peer_uid, os.getgid())
+      def recv(sat_self, dummy):
+        if self.recv_call_count % 2 == 0:
+          self.recv_call_count += 1
+          return long2bytes(len(self.ev.to_bytes()))
+        else:
+          self.recv_call_count += 1
+          return self.ev.to_bytes()
+    self.sat = DummySat()
+    def select(rd_list, wr_list, ex_list, timeout=None):
+      return [self.sat], [], []
+    self.addCleanup(setattr, groundcontrol, 'select', groundcontrol.select)
+    groundcontrol.select = select
+    self.sat_map = LockedData({self.sat: True})
+    self.event_sat_map = Subscriptions()
+    self.event_sat_map.add(self.sat, [b('all')])
+    self.event_queue = EventQueue()
+    self.signal = Condition()
+    self.flag = Flag()
+    self.gc = GroundControl(self.sat_map, self.event_sat_map, self.event_queue,
+                            self.signal, self.flag)
+
+  def test_add_ev_to_queue(self):
+    self.assertEqual(len(self.event_queue), 0)
+    self.gc._add_events_to_queue([ReceivedEvent(self.ev, self.sat)])
+    self.assertEqual(len(self.event_queue), 1)
+    self.assertEqual(self.event_queue.data[Event.normal_priority][0].event, self.ev)
+
+  def test_get_event(self):
+    ev = self.gc._get_event(self.sat)
+    self.assertEqual(ev.to_bytes(), self.ev.to_bytes())
+
+  def test_listen(self):
+    rd_list = self.gc._listen_for_events()
+    self.assertEqual(len(rd_list), 1)
+    self.assertEqual(rd_list[0], self.sat)
+
+  def test_remove_sat(self):
+    self.assertTrue(self.sat in self.sat_map.data)
+    self.assertTrue(self.sat in self.event_sat_map.data[b('all')])
+    self.gc._remove_sat(self.sat)
+    self.assertFalse(self.sat in self.sat_map.data)
+    self.assertFalse(self.sat in self.event_sat_map.data[b('all')])
+
+  def test_run_loop(self):
+    self.assertEqual(len(self.event_queue), 0)
+    self.gc._run_loop()
+    self.assertEqual(len(self.event_queue), 1)
+    self.gc._run_loop()
+    self.assertEqual(len(self.event_queue), 2)
+
+  def test_doorbell(self):
+    self.sat.recv = lambda size: long2bytes(0)
+    self.assertEqual(self.gc._get_event(self.sat), None)
+
+  def test_ring(self):
+    ring = RingBuffer.create(size=1024)
+    self.sat.family = socket.AF_UNIX
+    self.ev = Event(type=b('attach-ring'),
+                    properties={b('path'): b(ring.path)})
+    self.gc._get_event(self.sat)
+    self.assertTrue(self.sat in self.gc._rings)
+    self.assertFalse(os.path.exists(ring.path))
+    data = Event(type=b('test')).to_bytes()
+    ring.write(long2bytes(len(data)) + data)
+    events = self.gc._read_rings()
+    self.assertEqual(len(events), 1)
+    self.assertEqual(events[0].event.type, b('test'))
+    # Events still sent over the socket are counted for the satellite.
+    self.ev = Event(type=b('test'))
+    self.gc._get_event(self.sat)
+    self.assertEqual(ring.bypassed(), 1)
+    self.gc._remove_sat(self.sat)
+    self.assertEqual(self.gc._rings, {})
+    ring.close()
+
+  def test_corrupt_ring(self):
+    shut = []
+    self.sat.shutdown = lambda how: shut.append(how)
+    ring = RingBuffer.create(size=1024)
+    self.addCleanup(ring.close)
+    self.sat.family = socket.AF_UNIX
+    self.ev = Event(type=b('attach-ring'),
+                    properties={b('path'): b(ring.path)})
+    self.gc._get_event(self.sat)
+    ring.write(long2bytes(100) + b('short'))
+    self.assertEqual(self.gc._read_rings(), [])
+    self.assertEqual(self.gc._rings, {})
+    self.assertEqual(shut, [socket.SHUT_RDWR])
+    self.assertFalse(self.sat in self.sat_map.data)
+
+  def test_undecodable_ring_frame(self):
+    self.sat.shutdown = lambda how: None
+    ring = RingBuffer.create(size=1024)
+    self.addCleanup(ring.close)
+    self.sat.family = socket.AF_UNIX
+    self.ev = Event(type=b('attach-ring'),
+                    properties={b('path'): b(ring.path)})
+    self.gc._get_event(self.sat)
+    # Promises a type longer than the frame.
+    data = b('\0\4\2') + long2bytes(100)
+    ring.write(long2bytes(len(data)) + data)
+    self.assertEqual(self.gc._read_rings(), [])
+    self.assertEqual(self.gc._rings, {})
+    self.assertFalse(self.sat in self.sat_map.data)
+
+  def test_tiny_ring(self):
+    ring = RingBuffer.create(size=1024)
+    self.addCleanup(ring.close)
+    self.addCleanup(ring.unlink)
+    os.truncate(ring.path, 10)
+    self.sat.family = socket.AF_UNIX
+    self.ev = Event(type=b('attach-ring'),
+                    properties={b('path'): b(ring.path)})
+    self.gc._get_event(self.sat)
+    self.assertEqual(self.gc._rings, {})
+
+  def test_undecodable_event(self):
+    self.sat.shutdown = lambda how: None
+    self.ev.to_bytes = lambda: b('\0\4\2') + long2bytes(100)
+    self.assertEqual(self.gc._get_event(self.sat), None)
+    self.assertFalse(self.sat in self.sat_map.data)
+
+  def test_ring_owned_by_peer(self):
+    ring = RingBuffer.create(size=1024)
+    self.addCleanup(ring.close)
+    self.addCleanup(ring.unlink)
+    self.sat.family = socket.AF_UNIX
+    self.peer_uid = os.getuid() + 1
+    self.ev = Event(type=b('attach-ring'),
+                    properties={b('path'): b(ring.path)})
+    self.gc._get_event(self.sat)
+    self.assertEqual(self.gc._rings, {})
+    self.assertTrue(os.path.exists(ring.path))
+
+  def test_ring_needs_unix_socket(self):
+    ring = RingBuffer.create(size=1024)
+    self.ev = Event(type=b('attach-ring'),
+                    properties={b('path'): b(ring.path)})
+    self.gc._get_event(self.sat)
+    self.assertEqual(self.gc._rings, {})
+    ring.unlink()
+    ring.close()
+
+  def test_throttle(self):
+    self.event_queue.maxlen = 1
+    self.gc._run_loop()
+    self.assertEqual(self.event_queue.throttled(), set([self.sat]))
+
+  def test_connection_reset(self):
+    def recv(size):
+      raise OSError('connection reset')
+    self.sat.recv = recv
+    self.assertEqual(self.gc._get_event(self.sat), None)
+    self.assertFalse(self.sat in self.sat_map.data)
+
+  def test_reap_idle(self):
+    shut = []
+    self.sat.shutdown = lambda how: shut.append(self.sat)
+    self.sat.close = lambda: self.fail('closed under the relays')
+    gc = GroundControl(self.sat_map, self.event_sat_map, self.event_queue,
+                       self.signal, self.flag, heartbeat_timeout=0.05)
+    gc._listen_for_events()
+    self.assertTrue(self.sat in gc._idle)
+    gc._reap_idle()
+    self.assertEqual(shut, [])
+    time.sleep(0.15)
+    gc._reap_idle()
+    self.assertEqual(shut, [self.sat])
+    self.assertFalse(self.sat in self.sat_map.data)
+    self.assertEqual(self.event_sat_map.data[b('all')], [])
+
+  def test_joined(self):
+    gc = GroundControl(self.sat_map, self.event_sat_map, self.event_queue,
+                       self.signal, self.flag, heartbeat_timeout=60)
+    gc._listen_for_events()
+    self.assertTrue(self.sat in gc._idle)
+    # One satellite leaves as another joins, so there are as many as before.
+    with self.sat_map.lock:
+      self.sat_map.data.pop(self.sat)
+      self.sat_map.data['joined'] = True
+    gc.joined(['joined', 'left'])
+    gc._listen_for_events()
+    self.assertTrue('joined' in gc._idle)
+    self.assertFalse('left' in gc._idle)
+
+  def test_heard_from(self):
+    gc = GroundControl(self.sat_map, self.event_sat_map, self.event_queue,
+                       self.signal, self.flag, heartbeat_timeout=60)
+    gc._listen_for_events()
+    gc._get_event(self.sat)
+    self.assertTrue(self.sat in gc._idle)
+    self.assertEqual(gc._idle.expire(), [])
@@ -0,0 +1,108 @@
+import os
+import socket
+import tempfile
+from threading import Thread
+import unittest
+
+import handoff
+from flag import Flag
+from handoff import HandoffError, HandoffPort, close_fds, confirm_handoff, \
+                    receive_handoff, send_handoff, supported
+
+
+@unittest.skipUnless(supported(), 'descriptor passing is not supported')
+class HandoffTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.old, self.new = socket.socketpair(socket.AF_UNIX)
+    self.addCleanup(self.old.close)
+    self.addCleanup(self.new.close)
+    self.errors = []
+
+  def _send(self, state, fds, timeout=2):
+    def send():
+      try:
+        send_handoff(self.old, state, fds, timeout=timeout)
+      except Exception as error:
+        self.errors.append(error)
+    thread = Thread(target=send)
+    thread.start()
+    return thread
+
+  def test_handoff(self):
+    rd, wr = os.pipe()
+    self.addCleanup(close_fds, [rd, wr])
+    # More descriptors than fit in one message.
+    fds = [os.dup(wr) for i in range(260)]
+    self.addCleanup(close_fds, fds)
+    thread = self._send({'sats': [1, 2]}, fds)
+    state, received = receive_handoff(self.new, timeout=2)
+    self.addCleanup(close_fds, received)
+    confirm_handoff(self.new)
+    thread.join(2)
+    self.assertEqual(self.errors, [])
+    self.assertEqual(state, {'sats': [1, 2]})
+    self.assertEqual(len(received), 260)
+    # The descriptors received are the same pipe.
+    os.write(received[-1], b'x')
+    self.assertEqual(os.read(rd, 1), b'x')
+
+  def test_not_confirmed(self):
+    thread = self._send({}, [])
+    receive_handoff(self.new, timeout=2)
+    self.new.close()
+    thread.join(2)
+    self.assertEqual(len(self.errors), 1)
+    self.assertTrue(isinstance(self.errors[0], HandoffError))
+
+  def test_predecessor_hung_up(self):
+    self.old.close()
+    self.assertRaises(HandoffError, receive_handoff, self.new, 2)
+
+  def test_late_confirm_fails(self):
+    thread = self._send({}, [], timeout=0.1)
+    receive_handoff(self.new, timeout=2)
+    thread.join(2)
+    self.assertTrue(isinstance(self.errors[0], HandoffError))
+    # The predecessor carries on, so the successor must not.
+    self.assertRaises((IOError, OSError), confirm_handoff, self.new)
+
+  def test_confirm_racing_timeout(self):
+    # Confirmed just as the wait gave up: the hand-off still counts.
+    def recvall(conn, size):
+      confirm_handoff(self.new)
+      raise socket.timeout('timed out')
+    self.addCleanup(setattr, handoff, 'recvall', handoff.recvall)
+    handoff.recvall = recvall
+    send_handoff(self.old, {}, [], timeout=2)
+
+
+@unittest.skipUnless(supported(), 'descriptor passing is not supported')
+class HandoffPortTestCase(unittest.TestCase):
+
+  def setUp(self):
+    path = os.path.join(tempfile.mkdtemp(), 'handoff')
+    self.addCleanup(os.rmdir, os.path.dirname(path))
+    self.addCleanup(os.unlink, path)
+    self.sock = socket.socket(socket.AF_UNIX)
+    self.addCleanup(self.sock.close)
+    self.sock.bind(path)
+    self.sock.listen(1)
+    self.sock.setblocking(False)
+    self.successors = []
+    self.port = HandoffPort(self.sock, Flag(), self.successors.append)
+    self.conn = socket.socket(socket.AF_UNIX)
+    self.addCleanup(self.conn.close)
+    self.conn.connect(path)
+
+  def test_same_user(self):
+    self.port._run_loop()
+    self.assertEqual(len(self.successors), 1)
+
+  def test_other_user(self):
+    self.addCleanup(setattr, handoff, 'peer_uid', handoff.peer_uid)
+    handoff.peer_uid = lambda sock: os.getuid() + 1
+    self.port._run_loop()
+    self.assertEqual(self.successors, [])
+    # Hung up on.
+    self.assertEqual(self.conn.recv(1), b'')
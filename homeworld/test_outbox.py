@@ -0,0 +1,123 @@
+import socket
+import unittest
+
+from six import b
+
+from events import Event
+from outbox import Outbox
+from sockutils import bytes2long
+
+
+class OutboxTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.sent = []
+    class DummySat(object):
+      def sendall(sat_self, data):
+        self.sent.append(data)
+    self.sat = DummySat()
+
+  def _reading(self, device, value):
+    return Event(type=b('temperature'),
+                  properties={b('device'): b(device), b('value'): b(value)})
+
+  def test_flush(self):
+    outbox = Outbox()
+    outbox.put(self._reading('a', '1'))
+    outbox.put(self._reading('a', '2'))
+    outbox.flush(self.sat)
+    # One whole frame per event.
+    self.assertEqual(len(self.sent), 2)
+    for frame in self.sent:
+      self.assertEqual(bytes2long(frame[:4]), len(frame) - 4)
+    self.assertEqual(len(outbox), 0)
+
+  def test_priority(self):
+    outbox = Outbox()
+    bulk = [self._reading('a', str(i)) for i in range(3)]
+    for event in bulk:
+      outbox.put(event)
+    alarm = Event(type=b('alarm'), priority=Event.high_priority)
+    outbox.put(alarm)
+    outbox.put(None)
+    outbox.flush(self.sat)
+    # The alarm and the heartbeat overtake the backlog.
+    self.assertEqual(Event().from_bytes(self.sent[0][4:]).type, b('alarm'))
+    self.assertEqual(self.sent[1], b('\0\0\0\0'))
+    values = [Event().from_bytes(frame[4:]).properties[b('value')]
+              for frame in self.sent[2:]]
+    self.assertEqual(values, [b('0'), b('1'), b('2')])
+
+  def test_conflate(self):
+    outbox = Outbox({b('temperature'): b('device')})
+    outbox.put(self._reading('a', '1'))
+    outbox.put(self._reading('b', '1'))
+    outbox.put(self._reading('a', '2'))
+    self.assertEqual(len(outbox), 2)
+    self.assertEqual(outbox.conflated, 1)
+    outbox.flush(self.sat)
+    event = Event().from_bytes(self.sent[0][4:])
+    self.assertEqual(event.properties[b('value')], b('2'))
+
+  def test_flush_in_progress(self):
+    outbox = Outbox()
+    outbox._writing = True
+    outbox.put(self._reading('a', '1'))
+    outbox.flush(self.sat)
+    self.assertEqual(len(self.sent), 0)
+    self.assertEqual(len(outbox), 1)
+
+  def test_closed_satellite(self):
+    class ClosedSat(object):
+      shut_down = False
+      def sendall(self, data):
+        raise OSError('broken pipe')
+      def shutdown(self, how):
+        self.shut_down = True
+    sat = ClosedSat()
+    outbox = Outbox()
+    outbox.put(self._reading('a', '1'))
+    outbox.flush(sat)
+    self.assertEqual(len(outbox), 0)
+    self.assertTrue(outbox.failed)
+    self.assertTrue(sat.shut_down)
+    # Nothing more is queued for a satellite that is going away.
+    outbox.put(self._reading('a', '2'))
+    self.assertEqual(len(outbox), 0)
+
+  def test_heartbeat(self):
+    outbox = Outbox({b('temperature'): b('device')})
+    outbox.put(None)
+    outbox.flush(self.sat)
+    self.assertEqual(self.sent, [b('\0\0\0\0')])
+
+  def test_trace(self):
+    traces = []
+    outbox = Outbox(trace_hook=traces.append)
+    event = self._reading('a', '1')
+    event.trace = [(Event.stage_send, 1.0)]
+    outbox.put(event)
+    outbox.flush(self.sat)
+    written = Event().from_bytes(self.sent[0][4:])
+    self.assertEqual([stage for stage, when in written.trace],
+                     [Event.stage_send, Event.stage_socket_write])
+    self.assertEqual(traces[0].trace, written.trace)
+    # The queued event, which may be going elsewhere too, is left alone.
+    self.assertEqual(event.trace, [(Event.stage_send, 1.0)])
+
+  def test_send_timeout(self):
+    class SlowSat(object):
+      shut_down = False
+      def sendall(self, data):
+        raise socket.timeout('timed out')
+      def shutdown(self, how):
+        self.shut_down = True
+    sat = SlowSat()
+    outbox = Outbox()
+    outbox.put(self._reading('a', '1'))
+    outbox.put(self._reading('b', '1'))
+    outbox.flush(sat)
+    # A satellite left with part of a frame is dropped.
+    self.assertTrue(outbox.failed)
+    self.assertTrue(sat.shut_down)
+    self.assertEqual(len(outbox), 0)
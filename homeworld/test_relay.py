@@ -0,0 +1,199 @@
+from threading import Condition
+import unittest
+
+from six import b
+
+from events import Event, ReceivedEvent
+from eventqueue import EventQueue
+from flag import Flag
+from relay import Relay
+from subscriptions import Subscriptions
+
+
+class RelayTestCase(unittest.TestCase):
+
+  def setUp(self):
+    # Set up a dummy satellite object that counts calls to send.
+    self.sat_send_called = 0
+    class DummySat(object):
+      def sendall(sat_self, data):
+        self.sat_send_called += 1
+    self.sat = DummySat()
+    self.queue = EventQueue()
+    self.signal = Condition()
+    self.ev_sat_map = Subscriptions()
+    self.ev_sat_map.add(self.sat, [b('all')])
+    self.flag = Flag()
+    self.relay = Relay(self.queue, self.signal, self.ev_sat_map, self.flag)
+
+  def test_send_all(self):
+    # Create event to process.
+    ev = Event(type=b('test'))
+    rec_ev = ReceivedEvent(ev, self.sat)
+    self.relay._process_event(rec_ev)
+    self.assertEqual(self.sat_send_called, 1)
+
+  def test_add_sat(self):
+    self.assertFalse(b('test') in self.ev_sat_map.data)
+    self.relay._add_sat_event(self.sat, b('test'))
+    self.assertTrue(b('test') in self.ev_sat_map.data)
+
+  def test_remove_sat(self):
+    self.ev_sat_map.add(self.sat, [b('test')])
+    self.assertTrue(self.sat in self.ev_sat_map.data[b('test')])
+    self.relay._remove_sat_event(self.sat, b('test'))
+    self.assertFalse(self.sat in self.ev_sat_map.data.get(b('test'), []))
+
+  def test_register_event(self):
+    # Create register event to process.
+    ev = Event(type=b('register'),
+                   properties={b('type'): b('test')})
+    rec_ev = ReceivedEvent(ev, self.sat)
+    self.assertFalse(not hasattr(ev, 'properties'))
+    self.assertFalse(b('type') not in ev.properties)
+    self.assertFalse(b('test') in self.ev_sat_map.data)
+    self.relay._process_register_event(rec_ev)
+    self.assertEqual(self.sat_send_called, 0)
+    self.assertTrue(b('test') in self.ev_sat_map.data)
+
+  def test_register(self):
+    # Create register event to process.
+    ev = Event(type=b('register'),
+                   properties={b('type'): b('test')})
+    rec_ev = ReceivedEvent(ev, self.sat)
+    self.assertFalse(b('test') in self.ev_sat_map.data)
+    self.relay._process_event(rec_ev)
+    self.assertEqual(self.sat_send_called, 0)
+    self.assertTrue(b('test') in self.ev_sat_map.data)
+
+  def test_bulk_register(self):
+    ev = Event(type=b('register'),
+                   properties={b('types'): b('one\0two')})
+    self.relay._process_event(ReceivedEvent(ev, self.sat))
+    self.assertEqual(self.sat_send_called, 0)
+    self.assertTrue(self.sat in self.ev_sat_map.data[b('one')])
+    self.assertTrue(self.sat in self.ev_sat_map.data[b('two')])
+
+  def test_relay(self):
+    # Add sat to b'test' types.
+    self.ev_sat_map.add(self.sat, [b('test')])
+    # Create test event to relay.
+    ev = Event(type=b('test'),
+                   properties={b('type'): b('test')})
+    rec_ev = ReceivedEvent(ev, self.sat)
+    self.assertEqual(self.sat_send_called, 0)
+    self.relay._process_event(rec_ev)
+    self.assertEqual(self.sat_send_called, 1)
+
+  def test_run_loop(self):
+    # Create test event and add to queue.
+    ev = Event(type=b('test'),
+                   properties={b('type'): b('test')})
+    rec_ev = ReceivedEvent(ev, self.sat)
+    self.queue.put([rec_ev])
+    self.assertEqual(self.sat_send_called, 0)
+    self.relay._run_loop()
+    self.assertEqual(self.sat_send_called, 1)
+
+  def test_urgent_events(self):
+    # A high priority event waiting globally jumps ahead of the local batch.
+    low = ReceivedEvent(Event(type=b('test'),
+                                      priority=Event.low_priority),
+                            self.sat)
+    high = ReceivedEvent(Event(type=b('test'),
+                                       priority=Event.high_priority),
+                             self.sat)
+    self.relay._queue.put([low])
+    self.queue.put([high])
+    self.relay._get_urgent_events()
+    self.assertEqual(len(self.queue), 0)
+    self.assertEqual(self.relay._queue.take(), [high, low])
+
+  def test_wait_recorded(self):
+    ev = Event(type=b('test'), priority=Event.high_priority)
+    self.queue.put([ReceivedEvent(ev, self.sat)])
+    self.relay._run_loop()
+    self.assertEqual(self.queue.lane_stats[Event.high_priority].count, 1)
+
+  def test_heartbeat(self):
+    sent = []
+    self.sat.sendall = sent.append
+    ev = Event(type=b('heartbeat'))
+    self.relay._process_event(ReceivedEvent(ev, self.sat))
+    self.assertEqual(sent, [b('\0\0\0\0')])
+
+  def test_untyped_event(self):
+    self.relay._process_event(ReceivedEvent(Event(), self.sat))
+    self.assertEqual(self.sat_send_called, 1)
+
+  def _named_sat(self, name):
+    sent = []
+    class NamedSat(object):
+      def sendall(sat_self, data):
+        sent.append(data)
+    sat = NamedSat()
+    self.ev_sat_map.add_name(sat, b(name))
+    return sat, sent
+
+  def test_request_reply(self):
+    lamp, lamp_sent = self._named_sat('lamp')
+    ev = Event(type=b('on'), recipient=b('lamp'), correlation=b('7'))
+    self.relay._process_event(ReceivedEvent(ev, self.sat))
+    # Only the named satellite gets the request, under the Core's token.
+    self.assertEqual(self.sat_send_called, 0)
+    request = Event().from_bytes(lamp_sent[0][4:])
+    self.assertEqual(request.type, b('on'))
+    self.assertNotEqual(request.correlation, None)
+    sent = []
+    self.sat.sendall = sent.append
+    reply = Event(type=b('done'), correlation=request.correlation, reply=True)
+    self.relay._process_event(ReceivedEvent(reply, lamp))
+    answer = Event().from_bytes(sent[0][4:])
+    self.assertEqual(answer.type, b('done'))
+    self.assertEqual(answer.correlation, b('7'))
+    self.assertTrue(answer.reply)
+    # The token is spent, so a second reply goes nowhere.
+    del sent[:]
+    self.relay._process_event(ReceivedEvent(reply, lamp))
+    self.assertEqual(sent, [])
+
+  def test_spoofed_reply(self):
+    lamp, lamp_sent = self._named_sat('lamp')
+    mallory, mallory_sent = self._named_sat('mallory')
+    ev = Event(type=b('on'), recipient=b('lamp'), correlation=b('7'))
+    self.relay._process_event(ReceivedEvent(ev, self.sat))
+    token = Event().from_bytes(lamp_sent[0][4:]).correlation
+    sent = []
+    self.sat.sendall = sent.append
+    reply = Event(type=b('done'), correlation=token, reply=True)
+    self.relay._process_event(ReceivedEvent(reply, mallory))
+    self.assertEqual(sent, [])
+    # The real answer still gets through.
+    self.relay._process_event(ReceivedEvent(reply, lamp))
+    self.assertEqual(len(sent), 1)
+
+  def test_undeliverable_request(self):
+    sent = []
+    self.sat.sendall = sent.append
+    ev = Event(type=b('on'), recipient=b('nobody'), correlation=b('7'))
+    self.relay._process_event(ReceivedEvent(ev, self.sat))
+    answer = Event().from_bytes(sent[0][4:])
+    self.assertEqual(answer.type, b('undeliverable'))
+    self.assertEqual(answer.recipient, b('nobody'))
+    self.assertEqual(answer.correlation, b('7'))
+    self.assertTrue(answer.reply)
+
+  def test_register_name(self):
+    ev = Event(type=b('register'), properties={b('name'): b('lamp')})
+    self.relay._process_event(ReceivedEvent(ev, self.sat))
+    self.assertTrue(self.ev_sat_map.lookup(b('lamp')) is self.sat)
+    ev = Event(type=b('unregister'), properties={b('name'): b('lamp')})
+    self.relay._process_event(ReceivedEvent(ev, self.sat))
+    self.assertEqual(self.ev_sat_map.lookup(b('lamp')), None)
+
+  def test_trace(self):
+    ev = Event(type=b('test'), trace=[])
+    self.queue.put([ReceivedEvent(ev, self.sat)])
+    self.relay._run_loop()
+    self.assertEqual([stage for stage, when in ev.trace],
+                     [Event.stage_enqueue, Event.stage_relay_dequeue])
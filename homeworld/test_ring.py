@@ -0,0 +1,80 @@
+import os
+import unittest
+
+from ring import RingBuffer, _length
+
+
+class RingBufferTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.writer = RingBuffer.create(size=64)
+    self.reader = RingBuffer(self.writer.path)
+
+  def tearDown(self):
+    self.writer.unlink()
+    self.writer.close()
+    self.reader.close()
+
+  def _frame(self, payload):
+    return _length.pack(len(payload)) + payload
+
+  def test_round_trip(self):
+    self.assertTrue(self.writer.write(self._frame(b'hello')))
+    self.assertTrue(self.writer.write(self._frame(b'world')))
+    self.assertEqual(self.reader.read(), [b'hello', b'world'])
+    self.assertEqual(len(self.reader), 0)
+
+  def test_full(self):
+    self.assertTrue(self.writer.write(self._frame(b'x' * 40)))
+    self.assertFalse(self.writer.write(self._frame(b'y' * 40)))
+    self.assertEqual(self.reader.read(), [b'x' * 40])
+    self.assertTrue(self.writer.write(self._frame(b'y' * 40)))
+
+  def test_wrap(self):
+    for i in range(10):
+      payload = (b'%d' % i) * 20
+      self.assertTrue(self.writer.write(self._frame(payload)))
+      self.assertEqual(self.reader.read(), [payload])
+
+  def test_max_frames(self):
+    for payload in (b'a', b'b', b'c'):
+      self.writer.write(self._frame(payload))
+    self.assertEqual(self.reader.read(2), [b'a', b'b'])
+    self.assertEqual(self.reader.read(2), [b'c'])
+
+  def test_corrupt(self):
+    self.writer.write(_length.pack(100) + b'short')
+    with self.assertRaises(ValueError):
+      self.reader.read()
+
+  def test_too_small(self):
+    with open(self.writer.path, 'wb') as short:
+      short.write(b'x' * 10)
+    with self.assertRaises(ValueError):
+      RingBuffer(self.writer.path)
+
+  def test_wakeup(self):
+    self.assertFalse(self.writer.take_wakeup())
+    self.reader.read()
+    self.writer.write(self._frame(b'a'))
+    self.assertTrue(self.writer.take_wakeup())
+    self.assertFalse(self.writer.take_wakeup())
+
+  def test_bypassed(self):
+    self.assertEqual(self.writer.bypassed(), 0)
+    self.reader.count_bypass()
+    self.reader.count_bypass()
+    self.assertEqual(self.writer.bypassed(), 2)
+
+  def test_fd_outlives_file(self):
+    self.writer.unlink()
+    ring = RingBuffer(self.writer.path, os.dup(self.reader.fileno()))
+    self.addCleanup(ring.close)
+    self.assertTrue(self.writer.write(self._frame(b'hello')))
+    self.assertEqual(ring.read(), [b'hello'])
+
+  def test_locked(self):
+    # As on processors that reorder stores.
+    self.writer._locked = self.reader._locked = True
+    self.assertTrue(self.writer.write(self._frame(b'hello')))
+    self.assertEqual(self.reader.read(), [b'hello'])
@@ -0,0 +1,109 @@
+import unittest
+
+from six import b
+
+from events import Event
+from rpc import Outstanding, PendingRequests, Reply, RequestTimeout, \
+                UndeliverableError
+
+
+class CorrelationTestCase(unittest.TestCase):
+
+  def test_round_trip(self):
+    ev = Event(type=b('done'), recipient=b('lamp'), correlation=b('2a'),
+               reply=True)
+    decoded = Event().from_bytes(ev.to_bytes())
+    self.assertEqual(decoded.correlation, b('2a'))
+    self.assertTrue(decoded.reply)
+    decoded = Event().from_bytes(Event(type=b('on')).to_bytes())
+    self.assertEqual(decoded.correlation, None)
+    self.assertFalse(decoded.reply)
+
+
+class ReplyTestCase(unittest.TestCase):
+
+  def test_result(self):
+    reply = Reply()
+    done = []
+    reply.add_done_callback(done.append)
+    self.assertRaises(RequestTimeout, reply.result, 0)
+    event = Event(type=b('done'))
+    self.assertTrue(reply._finish(event))
+    self.assertFalse(reply._finish(error=RequestTimeout()))
+    self.assertTrue(reply.result() is event)
+    self.assertEqual(done, [reply])
+
+  def test_deadline(self):
+    reply = Reply(deadline=0)
+    self.assertRaises(RequestTimeout, reply.result)
+
+
+class OutstandingTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.outstanding = Outstanding()
+
+  def test_resolve(self):
+    first, first_reply = self.outstanding.add()
+    second, second_reply = self.outstanding.add()
+    self.assertNotEqual(first, second)
+    event = Event(type=b('done'), correlation=second, reply=True)
+    self.assertTrue(self.outstanding.resolve(event))
+    self.assertTrue(second_reply.result(0) is event)
+    self.assertFalse(first_reply.done())
+    self.assertFalse(self.outstanding.resolve(event))
+    self.assertEqual(len(self.outstanding), 1)
+
+  def test_undeliverable(self):
+    correlation, reply = self.outstanding.add()
+    self.outstanding.resolve(Event(type=b('undeliverable'),
+                                   recipient=b('lamp'),
+                                   correlation=correlation, reply=True))
+    self.assertRaises(UndeliverableError, reply.result, 0)
+
+  def test_expire(self):
+    correlation, reply = self.outstanding.add(timeout=1)
+    kept, kept_reply = self.outstanding.add()
+    self.outstanding.expire(now=reply._deadline + 1)
+    self.assertRaises(RequestTimeout, reply.result, 0)
+    self.assertFalse(kept_reply.done())
+    self.assertEqual(len(self.outstanding), 1)
+
+  def test_fail_all(self):
+    replies = [self.outstanding.add()[1] for i in range(3)]
+    self.outstanding.fail_all(RuntimeError('gone'))
+    for reply in replies:
+      self.assertRaises(RuntimeError, reply.result, 0)
+    self.assertEqual(len(self.outstanding), 0)
+
+
+class PendingRequestsTestCase(unittest.TestCase):
+
+  def test_pop(self):
+    pending = PendingRequests(timeout=10)
+    first = pending.add('a', b('1'), 'lamp', now=0)
+    second = pending.add('b', b('1'), 'lamp', now=0)
+    self.assertNotEqual(first, second)
+    self.assertEqual(pending.pop(second, 'lamp'), ('b', b('1')))
+    self.assertEqual(pending.pop(second, 'lamp'), None)
+    self.assertEqual(len(pending), 1)
+
+  def test_pop_other_responder(self):
+    pending = PendingRequests(timeout=10)
+    token = pending.add('a', b('1'), 'lamp', now=0)
+    self.assertEqual(pending.pop(token, 'mallory'), None)
+    self.assertEqual(pending.pop(token, 'lamp'), ('a', b('1')))
+
+  def test_expire(self):
+    pending = PendingRequests(timeout=10)
+    token = pending.add('a', b('1'), 'lamp', now=0)
+    pending.add('a', b('2'), 'lamp', now=20)
+    self.assertEqual(pending.pop(token, 'lamp'), None)
+    self.assertEqual(pending.expired, 1)
+
+  def test_no_timeout(self):
+    pending = PendingRequests(timeout=None)
+    token = pending.add('a', b('1'), 'lamp', now=0)
+    pending.add('a', b('2'), 'lamp', now=1e9)
+    self.assertEqual(pending.pop(token, 'lamp'), ('a', b('1')))
+    self.assertEqual(pending.expired, 0)
@@ -0,0 +1,222 @@
+import socket
+import unittest
+from threading import Thread
+from time import sleep, time
+
+from six import b
+
+from events import Event
+from satellite import (Backoff, BackpressureError, NotConnectedError,
+                       Satellite)
+from sockutils import bytes2long, recvall
+
+
+class BackoffTestCase(unittest.TestCase):
+
+  def test_bounds(self):
+    backoff = Backoff(initial=0.5, maximum=4.0, multiplier=2.0)
+    for attempt, ceiling in ((0, 0.5), (1, 1.0), (3, 4.0), (10, 4.0)):
+      for i in range(50):
+        delay = backoff.delay(attempt)
+        self.assertTrue(0 <= delay <= ceiling)
+
+  def test_huge_attempt(self):
+    self.assertTrue(Backoff(maximum=1.0).delay(10000) <= 1.0)
+
+
+class _FixedBackoff(Backoff):
+
+  def __init__(self, delay):
+    Backoff.__init__(self)
+    self.__delay = delay
+
+  def delay(self, attempt):
+    return self.__delay
+
+
+def _wait_for(condition, timeout=2.0):
+  deadline = time() + timeout
+  while not condition() and time() < deadline:
+    sleep(0.01)
+  return condition()
+
+
+class _FakeCoreTestCase(unittest.TestCase):
+
+  def setUp(self):
+    # A bare listening socket stands in for the Core.
+    self.listener = socket.socket()
+    self.addCleanup(self.listener.close)
+    self.listener.bind(('127.0.0.1', 0))
+    self.listener.listen(1)
+
+  def _launch(self, **kwargs):
+    self.sat = Satellite(**kwargs)
+    self.sat.launch(address='tcp://127.0.0.1:%d'
+                    % self.listener.getsockname()[1])
+    self.addCleanup(self.sat.terminate)
+    self.conn = self._accept()
+
+  def _accept(self):
+    conn = self.listener.accept()[0]
+    self.addCleanup(conn.close)
+    conn.settimeout(2)
+    return conn
+
+  def _received(self):
+    event_len = bytes2long(recvall(self.conn, 4))
+    return Event().from_bytes(recvall(self.conn, event_len))
+
+
+class TraceTestCase(_FakeCoreTestCase):
+
+  def setUp(self):
+    _FakeCoreTestCase.setUp(self)
+    self._launch(trace_sample=1.0)
+
+  def test_caller_event_untouched(self):
+    event = Event(type=b('test'))
+    self.sat.send_event(event)
+    self.sat.send_event(event)
+    self.assertEqual(event.trace, None)
+    for i in range(2):
+      self.assertEqual(len(self._received().trace), 1)
+
+  def test_requests_own_trace(self):
+    event = Event(type=b('test'), recipient=b('other'), trace=[])
+    self.sat.request(event, timeout=1)
+    self.sat.request(event, timeout=1)
+    self.assertEqual(event.trace, [])
+    for i in range(2):
+      self.assertEqual(len(self._received().trace), 1)
+
+
+class ReconnectTestCase(_FakeCoreTestCase):
+
+  def _drop(self):
+    self.conn.close()
+    self.assertTrue(_wait_for(lambda: self.sat.reconnecting))
+
+  def test_replay(self):
+    self._launch(reconnect=_FixedBackoff(0.2), buffer_size=10)
+    self.sat.register('one')
+    self.sat.register('two')
+    for i in range(2):
+      self._received()
+    self._drop()
+    for i in range(3):
+      self.sat.send_event(Event(type=b('test'), properties={b('i'): b(str(i))}))
+    self.conn = self._accept()
+    # A single bulk registration, then the held events in order.
+    event = self._received()
+    self.assertEqual(event.type, b('register'))
+    self.assertEqual(event.properties, {b('types'): b('one\0two')})
+    for i in range(3):
+      self.assertEqual(self._received().properties[b('i')], b(str(i)))
+    self.assertTrue(_wait_for(lambda: self.sat.reconnects == 1))
+    self.assertFalse(self.sat.reconnecting)
+    self.sat.send_event(Event(type=b('after')))
+    self.assertEqual(self._received().type, b('after'))
+
+  def test_buffer_full(self):
+    self._launch(reconnect=_FixedBackoff(10), buffer_size=2)
+    self._drop()
+    for i in range(2):
+      self.sat.send_event(Event(type=b('test')))
+    self.assertRaises(BackpressureError, self.sat.send_event,
+                      Event(type=b('test')))
+
+  def test_no_buffer(self):
+    self._launch(reconnect=_FixedBackoff(10))
+    self._drop()
+    self.assertRaises(NotConnectedError, self.sat.send_event,
+                      Event(type=b('test')))
+
+  def test_terminate_while_reconnecting(self):
+    self._launch(reconnect=_FixedBackoff(0.5), buffer_size=10)
+    self._drop()
+    self.sat.send_event(Event(type=b('test')))
+    started = time()
+    self.sat.terminate()
+    self.assertTrue(time() - started < 0.5)
+    self.assertFalse(self.sat.reconnecting)
+    # The reconnect is abandoned: the fake Core is never dialled again.
+    self.listener.settimeout(1)
+    self.assertRaises(socket.timeout, self.listener.accept)
+
+
+class BackpressureTestCase(_FakeCoreTestCase):
+
+  def setUp(self):
+    _FakeCoreTestCase.setUp(self)
+    # A small window, so a Core that never reads is quickly backed up.
+    self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    self._launch()
+    self.event = Event(type=b('test'), properties={b('data'): b('x') * 1024})
+
+  def _fill(self, **kwargs):
+    # Send until the satellite refuses, and return how many events went and
+    # how long the refused send took.
+    for sent in range(100000):
+      started = time()
+      try:
+        self.sat.send_event(self.event, **kwargs)
+      except BackpressureError:
+        return sent, time() - started
+    self.fail('the Core never applied backpressure')
+
+  def _assert_whole(self, count):
+    # Exactly count whole events reached the Core, and nothing more.
+    for i in range(count):
+      self.assertEqual(self._received().properties, self.event.properties)
+    self.conn.settimeout(0.2)
+    self.assertRaises(socket.timeout, self.conn.recv, 1)
+
+  def test_no_block(self):
+    sent, waited = self._fill(block=False)
+    self.assertTrue(waited < 0.1)
+    self._assert_whole(sent)
+
+  def test_timeout(self):
+    sent, waited = self._fill(timeout=0.1)
+    self.assertTrue(waited >= 0.1)
+    self._assert_whole(sent)
+
+
+class HeartbeatTestCase(_FakeCoreTestCase):
+  # The fake Core never answers, so the satellite hears nothing from it.
+
+  def test_idle(self):
+    self._launch(heartbeat=0.05, heartbeat_timeout=5)
+    for i in range(2):
+      self.assertEqual(self._received().type, b('heartbeat'))
+
+  def test_silent_core(self):
+    self._launch(heartbeat=0.05)
+    started = time()
+    while len(self.conn.recv(4096)):
+      pass
+    # Dropped within the default timeout of three heartbeats, give or take a
+    # tick.
+    self.assertTrue(time() - started < 0.3)
+
+  def test_send_in_progress(self):
+    # A send stuck on a Core that never reads holds the send lock, which the
+    # listener must not wait on.
+    self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    self._launch(heartbeat=0.05, heartbeat_timeout=0.5)
+    event = Event(type=b('test'), properties={b('data'): b('x') * 1024})
+    errors = []
+
+    def send():
+      try:
+        while True:
+          self.sat.send_event(event)
+      except (IOError, OSError) as error:
+        errors.append(error)
+
+    sender = Thread(target=send)
+    sender.start()
+    sender.join(2)
+    self.assertFalse(sender.is_alive())
+    self.assertEqual(len(errors), 1)
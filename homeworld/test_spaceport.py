@@ -0,0 +1,96 @@
+from errno import EAGAIN, EMFILE
+import unittest
+
+from flag import Flag
+from lockeddata import LockedData
+import spaceport
+from spaceport import Spaceport
+
+
+class SpaceportTestCase(unittest.TestCase):
+
+  def setUp(self):
+    class DummySat(object):
+      def __init__(sat_self, addr):
+        sat_self.addr = addr
+      def setblocking(sat_self, flag):
+        pass
+      def setsockopt(sat_self, *args):
+        pass
+    class DummySocket(object):
+      def __init__(sock_self):
+        sock_self.pending = []
+        sock_self.error = None
+      def accept(sock_self):
+        if sock_self.error is not None:
+          raise IOError(sock_self.error, 'cannot accept')
+        if not len(sock_self.pending):
+          raise IOError(EAGAIN, 'no pending connections')
+        addr = sock_self.pending.pop(0)
+        return (DummySat(addr), addr)
+    class DummyWakeup(object):
+      rung = 0
+      def ring(wakeup_self):
+        wakeup_self.rung += 1
+    self.sock = DummySocket()
+    def select(rd_list, wr_list, ex_list, timeout=None):
+      return [sock for sock in rd_list if sock is self.sock], [], []
+    self.addCleanup(setattr, spaceport, 'select', spaceport.select)
+    spaceport.select = select
+    self.sat_map = LockedData(dict())
+    self.flag = Flag()
+    self.wakeup = DummyWakeup()
+    self.spaceport = Spaceport(self.sock, self.sat_map, self.flag,
+                               wakeup=self.wakeup)
+
+  def test_run_loop(self):
+    self.sock.pending = [1]
+    self.assertEqual(len(self.sat_map.data), 0)
+    self.spaceport._run_loop()
+    self.assertEqual(len(self.sat_map.data), 1)
+    self.assertEqual(list(self.sat_map.data.values()), [1])
+    self.assertEqual(self.wakeup.rung, 1)
+
+  def test_drain_burst(self):
+    self.sock.pending = list(range(10))
+    self.spaceport._run_loop()
+    self.assertEqual(len(self.sat_map.data), 10)
+    self.assertEqual(len(self.sock.pending), 0)
+    self.assertEqual(self.wakeup.rung, 1)
+
+  def test_max_accepts(self):
+    self.spaceport._max_accepts = 4
+    self.sock.pending = list(range(10))
+    self.spaceport._run_loop()
+    self.assertEqual(len(self.sat_map.data), 4)
+    self.spaceport._run_loop()
+    self.assertEqual(len(self.sat_map.data), 8)
+
+  def test_nothing_pending(self):
+    self.spaceport._run_loop()
+    self.assertEqual(len(self.sat_map.data), 0)
+    self.assertEqual(self.wakeup.rung, 0)
+
+  def test_back_off_on_error(self):
+    self.sock.pending = [1]
+    self.sock.error = EMFILE
+    with self.assertLogs('spaceport', 'WARNING'):
+      self.spaceport._run_loop()
+    self.assertEqual(len(self.sat_map.data), 0)
+    # Still backing off, so the socket is not tried again.
+    self.sock.error = None
+    self.spaceport._run_loop()
+    self.assertEqual(len(self.sat_map.data), 0)
+    self.spaceport._resume_at = 0
+    self.spaceport._run_loop()
+    self.assertEqual(len(self.sat_map.data), 1)
+    self.assertEqual(self.spaceport._backoff, 0)
+
+  def test_on_accept(self):
+    joined = []
+    self.spaceport._on_accept = joined.extend
+    self.sock.pending = [1, 2]
+    self.spaceport._run_loop()
+    self.assertEqual(sorted(self.sat_map.data.values()),
+                     sorted(self.sat_map.data[sat] for sat in joined))
+    self.assertEqual(len(joined), 2)
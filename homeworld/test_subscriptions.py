@@ -0,0 +1,50 @@
+import unittest
+
+from six import b
+
+from subscriptions import Subscriptions
+
+
+class SubscriptionsTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.subs = Subscriptions()
+
+  def test_add(self):
+    self.subs.add('a', [b('one'), b('two')])
+    self.subs.add('b', [b('one'), b('one')])
+    self.assertEqual(self.subs.data[b('one')], ['a', 'b'])
+    self.assertEqual(self.subs.data[b('two')], ['a'])
+    self.assertEqual(self.subs.types_of('a'), set([b('one'), b('two')]))
+
+  def test_remove(self):
+    self.subs.add('a', [b('one'), b('two')])
+    self.subs.remove('a', [b('one'), b('three')])
+    self.assertFalse(b('one') in self.subs.data)
+    self.assertEqual(self.subs.types_of('a'), set([b('two')]))
+
+  def test_remove_sat(self):
+    self.subs.add('a', [b('all'), b('one'), b('two')])
+    self.subs.add('b', [b('one')])
+    self.subs.remove_sat('a')
+    self.assertEqual(self.subs.data, {b('all'): [], b('one'): ['b']})
+    self.assertEqual(self.subs.types_of('a'), set())
+
+  def test_copy_on_write(self):
+    self.subs.add('a', [b('one')])
+    routing = self.subs.data[b('one')]
+    self.subs.add('b', [b('one')])
+    self.subs.remove_sat('a')
+    self.assertEqual(routing, ['a'])
+
+  def test_names(self):
+    self.subs.add_name('a', b('lamp'))
+    self.assertEqual(self.subs.lookup(b('lamp')), 'a')
+    self.assertEqual(self.subs.names_of('a'), set([b('lamp')]))
+    # The latest registration of a name wins.
+    self.subs.add_name('b', b('lamp'))
+    self.assertEqual(self.subs.lookup(b('lamp')), 'b')
+    self.subs.remove_sat('a')
+    self.assertEqual(self.subs.lookup(b('lamp')), 'b')
+    self.subs.remove_sat('b')
+    self.assertEqual(self.subs.lookup(b('lamp')), None)
@@ -0,0 +1,47 @@
+import unittest
+
+from timerwheel import TimerWheel
+
+
+class TimerWheelTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.wheel = TimerWheel(tick=1.0, slots=8)
+    self.wheel.expire(now=0)
+
+  def test_expire(self):
+    self.wheel.schedule('a', 3, now=0)
+    self.wheel.schedule('b', 5, now=0)
+    self.assertEqual(self.wheel.expire(now=2.5), [])
+    self.assertEqual(self.wheel.expire(now=3), ['a'])
+    self.assertFalse('a' in self.wheel)
+    self.assertEqual(self.wheel.expire(now=5), ['b'])
+    self.assertEqual(len(self.wheel), 0)
+
+  def test_reschedule_later(self):
+    self.wheel.schedule('a', 2, now=0)
+    self.wheel.schedule('a', 2, now=1.5)
+    self.assertEqual(self.wheel.expire(now=3), [])
+    self.assertEqual(self.wheel.expire(now=4), ['a'])
+
+  def test_reschedule_earlier(self):
+    self.wheel.schedule('a', 6, now=0)
+    self.wheel.schedule('a', 1, now=0)
+    self.assertEqual(self.wheel.expire(now=1), ['a'])
+    self.assertEqual(self.wheel.expire(now=7), [])
+
+  def test_cancel(self):
+    self.wheel.schedule('a', 1, now=0)
+    self.wheel.cancel('a')
+    self.assertEqual(self.wheel.expire(now=2), [])
+
+  def test_beyond_one_round(self):
+    self.wheel.schedule('a', 20, now=0)
+    self.assertEqual(self.wheel.expire(now=10), [])
+    self.assertEqual(self.wheel.expire(now=19), [])
+    self.assertEqual(self.wheel.expire(now=20), ['a'])
+
+  def test_long_gap(self):
+    for i in range(5):
+      self.wheel.schedule(i, i + 1, now=0)
+    self.assertEqual(sorted(self.wheel.expire(now=100)), list(range(5)))
@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from six import b
+
+from events import Event
+from tracing import FileHook, histogram, read_traces, stage_latencies, \
+                    trace_record
+
+
+class TracingTestCase(unittest.TestCase):
+
+  def _traced(self):
+    return Event(type=b('switch'), trace=[(Event.stage_send, 1.0),
+                                          (Event.stage_core_receive, 1.002),
+                                          (Event.stage_client_receive, 1.01)])
+
+  def test_round_trip(self):
+    decoded = Event().from_bytes(self._traced().to_bytes())
+    self.assertEqual(decoded.trace, self._traced().trace)
+    self.assertEqual(Event().from_bytes(Event().to_bytes()).trace, None)
+
+  def test_trace_record(self):
+    record = trace_record(self._traced())
+    self.assertEqual(record['type'], 'switch')
+    self.assertEqual([stage for stage, when in record['stamps']],
+                     ['send', 'core-receive', 'client-receive'])
+
+  def test_stage_latencies(self):
+    latencies = stage_latencies([trace_record(self._traced())])
+    self.assertAlmostEqual(latencies['send > core-receive'][0], 0.002)
+    self.assertAlmostEqual(latencies['core-receive > client-receive'][0],
+                           0.008)
+    self.assertAlmostEqual(latencies['total'][0], 0.01)
+
+  def test_histogram(self):
+    counts = histogram([0.0005, 0.001, 0.0015, 5.0], bounds_ms=(1, 2))
+    self.assertEqual(counts, [2, 1, 1])
+
+  def test_file_hook(self):
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpdir)
+    path = os.path.join(tmpdir, 'traces.jsonl')
+    hook = FileHook(path)
+    hook(self._traced())
+    hook(self._traced())
+    hook.close()
+    records = list(read_traces([path]))
+    self.assertEqual(len(records), 2)
+    self.assertEqual(records[0], trace_record(self._traced()))
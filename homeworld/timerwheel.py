@@ -0,0 +1,78 @@
+from math import ceil
+from time import time
+
+
+class TimerWheel(object):
+  """
+  Hashed timing wheel of per-key deadlines.
+
+  Deadlines are rounded up to a whole tick and kept in one of a fixed number
+  of slots, so scheduling, rescheduling and cancelling a key are O(1) and
+  expire() only looks at the slots of the ticks that have passed.  A key
+  whose deadline moves later is not moved straight away; it is re-slotted
+  when its old slot comes round.  A key expires at most one tick after its
+  deadline.
+  """
+
+  def __init__(self, tick=0.1, slots=64):
+    self.tick = tick
+    self._slots = [set() for i in range(slots)]
+    # Map from key to the tick its deadline falls in.
+    self._due = dict()
+    # Next tick whose slot expire() has yet to look at.
+    self._next_tick = None
+
+  def __len__(self):
+    return len(self._due)
+
+  def __contains__(self, key):
+    return key in self._due
+
+  def schedule(self, key, delay, now=None):
+    """
+    Set the key to expire delay seconds from now, replacing any deadline.
+    """
+    now = time() if now is None else now
+    due = int(ceil((now + delay) / self.tick))
+    old = self._due.get(key)
+    self._due[key] = due
+    # A later deadline is picked up when the old slot comes round.
+    if old is None or due < old:
+      self._place(key, due)
+
+  def cancel(self, key):
+    self._due.pop(key, None)
+
+  def expire(self, now=None):
+    """
+    Remove and return the keys whose deadlines have passed.
+    """
+    now = time() if now is None else now
+    now_tick = int(now / self.tick)
+    if self._next_tick is None:
+      self._next_tick = now_tick
+    # After a long gap, every slot is looked at once.
+    first = max(self._next_tick, now_tick - len(self._slots) + 1)
+    expired = []
+    for tick in range(first, now_tick + 1):
+      index = tick % len(self._slots)
+      slot = self._slots[index]
+      self._slots[index] = set()
+      for key in slot:
+        due = self._due.get(key)
+        if due is None:
+          # Cancelled, or already expired through an earlier slot.
+          continue
+        if due <= now_tick:
+          del self._due[key]
+          expired.append(key)
+        else:
+          self._slots[due % len(self._slots)].add(key)
+    self._next_tick = max(self._next_tick, now_tick + 1)
+    return expired
+
+  def _place(self, key, due):
+    # Never behind the slots expire() has already passed.
+    if self._next_tick is not None:
+      due = max(due, self._next_tick)
+    self._slots[due % len(self._slots)].add(key)
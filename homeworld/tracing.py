@@ -0,0 +1,108 @@
+"""
+Hooks that collect traced events, and the latency profile of the traces.
+
+A trace hook is any callable taking a traced event.  The Core and the
+satellites call theirs on I/O threads, so a hook should be quick.  FileHook
+appends each trace to a file, one JSON object per line:
+
+  from tracing import FileHook
+
+  sat = Satellite(trace_hook=FileHook('traces.jsonl'))
+
+and bench.py trace turns such files into per-stage latency histograms.
+
+Stamps are taken from each host's wall clock, so the stages across a network
+hop are only as accurate as the hosts' clocks agree.
+"""
+from bisect import bisect_left
+import json
+from threading import Lock
+
+from events import Event
+
+# Upper bounds in milliseconds of the histogram buckets.  The last bucket
+# holds everything above them.
+default_bounds_ms = (0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500,
+                     1000)
+
+
+def trace_record(event):
+  """
+  Return the trace of an event as a dict ready for JSON.
+  """
+  stamps = []
+  for stage, when in event.trace:
+    if stage < len(Event.stage_names):
+      stage = Event.stage_names[stage]
+    stamps.append([str(stage), when])
+  event_type = None
+  if event.type is not None:
+    event_type = event.type.decode('utf-8', 'replace')
+  return {'type': event_type, 'stamps': stamps}
+
+
+class FileHook(object):
+  """
+  Trace hook appending each trace to a file as a line of JSON.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self._lock = Lock()
+    self._file = open(path, 'a')
+
+  def __call__(self, event):
+    line = json.dumps(trace_record(event)) + '\n'
+    with self._lock:
+      self._file.write(line)
+
+  def flush(self):
+    with self._lock:
+      self._file.flush()
+
+  def close(self):
+    with self._lock:
+      self._file.close()
+
+
+def read_traces(paths):
+  """
+  Yield the trace records saved in the given files by FileHook.
+  """
+  for path in paths:
+    with open(path) as traces:
+      for line in traces:
+        line = line.strip()
+        if line:
+          yield json.loads(line)
+
+
+def stage_latencies(records):
+  """
+  Return a dict from each stage-to-stage hop to its latencies in seconds.
+
+  Hops are between consecutive stamps of a trace, so stages a trace skips
+  are folded into the next hop.  'total' is from each trace's first stamp to
+  its last.
+  """
+  latencies = dict()
+  for record in records:
+    stamps = record['stamps']
+    for (stage, start), (next_stage, end) in zip(stamps, stamps[1:]):
+      hop = '%s > %s' % (stage, next_stage)
+      latencies.setdefault(hop, []).append(end - start)
+    if len(stamps) > 1:
+      latencies.setdefault('total', []).append(stamps[-1][1] - stamps[0][1])
+  return latencies
+
+
+def histogram(latencies, bounds_ms=default_bounds_ms):
+  """
+  Count latencies in seconds into buckets with the given upper bounds.
+
+  Returns one count per bound, then the count above the last.
+  """
+  counts = [0] * (len(bounds_ms) + 1)
+  for latency in latencies:
+    counts[bisect_left(bounds_ms, latency * 1000.0)] += 1
+  return counts